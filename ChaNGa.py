@@ -34,6 +34,26 @@ def get_input_file(file_name):
     input_file_basename, _ = os.path.splitext(input_name)
     return input_file_basename
 
+def convert_units(gadget_params):
+    """ChaNGa length and mass units, and the factor converting GADGET masses to ChaNGa masses
+    
+    ChaNGa takes G = 1, so its mass unit follows from the GADGET length and
+    velocity units.
+    """
+    # convert cm to kpc
+    unitlength = float(gadget_params['UnitLength_in_cm']) * u.cm
+    dKpcUnit = unitlength.to(u.kpc) / u.kpc
+        
+    # convert mass to solar masses
+    unitvelocity = float(gadget_params['UnitVelocity_in_cm_per_s']) * u.cm / u.s
+    unittime = unitlength / unitvelocity
+    m = (dKpcUnit * u.kpc).to(u.m) ** 3 / unittime ** 2 / G_u
+    dMsolUnit = m.to(u.Msun) / u.Msun
+    unitmass = float(gadget_params['UnitMass_in_g']) * u.g
+    mass_convert_factor = (dMsolUnit * u.Msun) / unitmass.to(u.Msun)
+    
+    return dKpcUnit, dMsolUnit, mass_convert_factor
+
 def convert_parameter_file(gadget_params, args, do_gas):
     """Convert parameter values"""
     
@@ -81,18 +101,8 @@ def convert_parameter_file(gadget_params, args, do_gas):
     # disable density outputs by default
     changa_params['bDoDensity'] = 0
 
-    # convert cm to kpc
-    unitlength = float(gadget_params['UnitLength_in_cm']) * u.cm
-    dKpcUnit = unitlength.to(u.kpc) / u.kpc
+    dKpcUnit, dMsolUnit, mass_convert_factor = convert_units(gadget_params)
     changa_params['dKpcUnit'] = dKpcUnit
-        
-    # convert mass to solar masses
-    unitvelocity = float(gadget_params['UnitVelocity_in_cm_per_s']) * u.cm / u.s
-    unittime = unitlength / unitvelocity
-    m = (dKpcUnit * u.kpc).to(u.m) ** 3 / unittime ** 2 / G_u
-    dMsolUnit = m.to(u.Msun) / u.Msun
-    unitmass = float(gadget_params['UnitMass_in_g']) * u.g
-    mass_convert_factor = (dMsolUnit * u.Msun) / unitmass.to(u.Msun)
     changa_params['dMsolUnit'] = dMsolUnit
     
     if do_gas:
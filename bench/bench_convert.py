@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+"""
+    Time and memory-profile each stage of converting a synthetic GADGET snapshot
+
+    The stages are
+        read        read every field of every particle type from the HDF5 file
+        units       convert the parameters and the gas internal energies
+        write       write the tipsy file from particles already in memory
+        tipsy_read  read the tipsy file back
+        convert     the whole conversion, as gadget2changa.py does it
+
+    Each stage runs in a fresh process so that its peak RSS is not hidden by an
+    earlier one. The RSS reported is the peak over the RSS of the process once
+    its inputs are ready, i.e. the memory used by the stage itself. The results
+    are printed as a table and written as JSON so that runs can be compared
+    across versions.
+
+    usage: bench_convert.py [-h] [snapshot options] [--repeats N] [--json FILE] ...
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# Where results are written unless --json is given
+results_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, root)
+import ChaNGa
+import gadget
+import gadget2changa
+import tipsy
+
+import make_snapshot
+
+stages = ('read', 'units', 'write', 'tipsy_read', 'convert')
+
+def peak_rss():
+    """Peak resident set size of this process in bytes since reset_peak_rss()"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    
+    # Linux reports kB
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def reset_peak_rss():
+    """Make the peak RSS the current RSS, where the OS allows it. Returns the current RSS in bytes
+    
+    Otherwise the peak includes whatever the imports needed.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return peak_rss()
+
+def particles_of(gadget_file):
+    """The particle types present in 'gadget_file'"""
+    types = (gadget_file.gas, gadget_file.halo, gadget_file.disk, gadget_file.bulge, gadget_file.stars,
+             gadget_file.boundary)
+    return [p for p in types if p is not None]
+
+def read_all(gadget_file, keep=False):
+    """Read every field of every particle, dropping each slab after it is read unless 'keep'"""
+    for particles in particles_of(gadget_file):
+        for slab in gadget2changa.slabs(particles) if not keep else [particles]:
+            for name in slab.field_names():
+                getattr(slab, name)
+
+def conversion_arguments(snapshot, out_dir, extra):
+    """The gadget2changa options for converting 'snapshot' into 'out_dir'"""
+    parser = argparse.ArgumentParser()
+    gadget2changa.add_conversion_arguments(parser)
+    args = parser.parse_args(extra)
+    args.gadget_file = snapshot
+    args.out_dir = out_dir
+    return args
+
+def run_stage(stage, snapshot, param_file, out_dir, chunk_size, extra, repeats):
+    """Run 'stage' 'repeats' times. Returns its mean time and peak RSS in bytes"""
+    gadget_params = gadget.Parameter_file(param_file)
+    args = conversion_arguments(snapshot, out_dir, extra)
+    args.chunk_size = chunk_size
+    basename = gadget2changa.input_file_name(snapshot, out_dir)
+
+    # Inputs that are not part of the stage are made before the baseline is taken
+    with contextlib.redirect_stdout(io.StringIO()):
+        if stage == 'units':
+            gadget_file = gadget.File(snapshot)
+            gas = gadget_file.gas
+            inputs = [] if gas is None else [gas.internal_energy, gas.mass, gas.metals, gas.electron_density]
+            out = None if gas is None else np.zeros(gas.size, dtype=np.float32)
+        elif stage == 'write':
+            # Particles are read into memory before each run, so the whole snapshot is one slab
+            gadget_file = gadget.File(snapshot)
+            read_all(gadget_file, keep=True)
+            args.chunk_size = None
+        elif stage == 'tipsy_read' and not os.path.exists(basename):
+            with gadget.File(snapshot, chunk_size) as gadget_file:
+                changa_params, mass_scale = ChaNGa.convert_parameter_file(gadget_params, args, gadget_file.gas is not None)
+                gadget2changa.convert(gadget_file, gadget_params, changa_params, mass_scale, basename, args)
+
+    base = reset_peak_rss()
+    elapsed = 0.0
+    for i in range(repeats):
+        if stage == 'write' and i > 0:
+            # The conversion releases each particle type once it is written
+            read_all(gadget_file, keep=True)
+        
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if stage == 'read':
+                with gadget.File(snapshot, chunk_size) as gadget_file:
+                    read_all(gadget_file)
+            elif stage == 'units':
+                ChaNGa.convert_parameter_file(gadget_params, args, gas is not None)
+                if gas is not None:
+                    gadget2changa.temperature_converter(gadget_params, 1.0)(*inputs, out=out)
+            elif stage == 'write':
+                changa_params, mass_scale = ChaNGa.convert_parameter_file(gadget_params, args, gadget_file.gas is not None)
+                gadget2changa.convert(gadget_file, gadget_params, changa_params, mass_scale, basename, args)
+            elif stage == 'tipsy_read':
+                with tipsy.File(basename) as f:
+                    for particles in (f.gas, f.darkmatter, f.stars):
+                        pass
+            elif stage == 'convert':
+                with gadget.File(snapshot, chunk_size) as gadget_file:
+                    changa_params, mass_scale = ChaNGa.convert_parameter_file(gadget_params, args, gadget_file.gas is not None)
+                    gadget2changa.convert(gadget_file, gadget_params, changa_params, mass_scale, basename, args)
+        elapsed += time.perf_counter() - start
+
+    return elapsed / repeats, max(peak_rss() - base, 0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the GADGET to tipsy conversion',
+                                     allow_abbrev=False)
+    make_snapshot.add_snapshot_arguments(parser)
+    parser.add_argument('--chunk-size', type=int, metavar='N', help='Read and convert at most N particles at a time')
+    parser.add_argument('--stages', default=','.join(stages), help='Comma-separated stages to run (default: all)')
+    parser.add_argument('--repeats', type=int, default=3, metavar='N', help='Runs of each stage to average over')
+    parser.add_argument('--json', metavar='FILE', help='Write the results to FILE instead of bench/bench_convert.json')
+    parser.add_argument('--workdir', metavar='DIR', help='Keep the snapshot and tipsy file in DIR')
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    args, extra = parser.parse_known_args()
+
+    if args.stage is not None:
+        # Run by the parent process below; 'extra' holds the paths and conversion options
+        snapshot, param_file, out_dir = extra[:3]
+        seconds, rss = run_stage(args.stage, snapshot, param_file, out_dir, args.chunk_size, extra[3:], args.repeats)
+        print(json.dumps({'seconds': seconds, 'peak_rss_bytes': rss}))
+        return
+
+    for stage in args.stages.split(','):
+        if stage not in stages:
+            parser.error('unknown stage "{0:s}"'.format(stage))
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='bench-convert-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        snapshot = os.path.join(workdir, 'synthetic.hdf5')
+        param_file = os.path.join(workdir, 'synthetic.params')
+        counts = make_snapshot.make_from_arguments(snapshot, param_file, args)
+
+        results = {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'version': version(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'snapshot': {
+                'particles': dict(zip(make_snapshot.species, counts)),
+                'mass_table': args.mass_table,
+                'metals': not args.no_metals,
+                'cooling': not args.no_cooling,
+                'potential': not args.no_potential,
+                'compression': args.compression,
+                'bytes': os.path.getsize(snapshot)
+            },
+            'chunk_size': args.chunk_size,
+            'options': extra,
+            'repeats': args.repeats,
+            'stages': {}
+        }
+
+        n = sum(counts)
+        print('{0:d} particles'.format(n))
+        print('{0:12s} {1:>10s} {2:>12s} {3:>10s} {4:>16s}'.format('stage', 's', 's / Mpart', 'MiB RSS',
+                                                                     'MiB RSS / Mpart'))
+        for stage in args.stages.split(','):
+            command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--repeats', str(args.repeats)]
+            if args.chunk_size is not None:
+                command += ['--chunk-size', str(args.chunk_size)]
+            output = subprocess.check_output(command + [snapshot, param_file, workdir] + extra, cwd=root)
+            r = json.loads(output.decode().strip().splitlines()[-1])
+
+            r['seconds_per_mpart'] = r['seconds'] / n * 1e6
+            r['peak_rss_mib'] = r['peak_rss_bytes'] / 2**20
+            r['rss_mib_per_mpart'] = r['peak_rss_mib'] / n * 1e6
+            results['stages'][stage] = r
+            print('{0:12s} {1:10.4f} {2:12.4f} {3:10.1f} {4:16.1f}'.format(stage, r['seconds'], r['seconds_per_mpart'],
+                                                                         r['peak_rss_mib'], r['rss_mib_per_mpart']))
+            sys.stdout.flush()
+
+        fname = args.json if args.json is not None else os.path.join(results_dir, 'bench_convert.json')
+        with open(fname, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to {0:s}'.format(fname))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def version():
+    """The git revision of the converter, if it is known"""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    main()
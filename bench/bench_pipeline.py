@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+    Compare the ways gadget2changa can overlap reading and writing on a
+    synthetic GADGET snapshot
+
+    The modes are
+        sequential     read, convert, and write each slab in turn
+        threads        --pipeline: reader and converter threads in this process
+        processes:N    --pipeline-processes N: N reader processes filling
+                       shared-memory slots that are written in place
+
+    Each mode runs in a fresh process. The time is the mean over the repeats
+    of the whole conversion, and the RSS is the peak over the RSS of the
+    converting process once the snapshot is open, alongside the largest peak
+    RSS of its reader processes, if any. The tipsy file of every mode is
+    checked to be identical to that of the sequential conversion.
+
+    usage: bench_pipeline.py [-h] [snapshot options] [--processes N[,N...]] [--repeats N] [--json FILE] ...
+"""
+
+import argparse
+import contextlib
+import datetime
+import filecmp
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import bench_convert
+from bench_convert import results_dir, root
+import ChaNGa
+import gadget
+import gadget2changa
+
+import make_snapshot
+
+def mode_options(mode):
+    """The gadget2changa options selecting 'mode'"""
+    if mode == 'sequential':
+        return []
+    if mode == 'threads':
+        return ['--pipeline']
+    return ['--pipeline-processes', mode.split(':')[1]]
+
+def run_mode(mode, snapshot, param_file, out_dir, chunk_size, extra, repeats):
+    """Convert 'snapshot' 'repeats' times in 'mode'. Returns the mean time and the peak RSS of this process and of its
+    readers in bytes
+    """
+    gadget_params = gadget.Parameter_file(param_file)
+    args = bench_convert.conversion_arguments(snapshot, out_dir, extra + mode_options(mode))
+    args.chunk_size = chunk_size
+    basename = gadget2changa.input_file_name(snapshot, out_dir)
+
+    base = bench_convert.reset_peak_rss()
+    elapsed = 0.0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            with gadget.File(snapshot, chunk_size) as gadget_file:
+                changa_params, mass_scale = ChaNGa.convert_parameter_file(gadget_params, args, gadget_file.gas is not None)
+                gadget2changa.convert(gadget_file, gadget_params, changa_params, mass_scale, basename, args)
+        elapsed += time.perf_counter() - start
+
+    readers = None
+    if mode.startswith('processes'):
+        # Linux reports kB
+        readers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        readers = readers if sys.platform == 'darwin' else readers * 1024
+    return elapsed / repeats, max(bench_convert.peak_rss() - base, 0), readers
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the in-process and multi-process conversion pipelines',
+                                     allow_abbrev=False)
+    make_snapshot.add_snapshot_arguments(parser)
+    parser.add_argument('--chunk-size', type=int, default=1 << 18, metavar='N',
+                        help='Read and convert at most N particles at a time (default: %(default)s)')
+    parser.add_argument('--processes', default='1,2', metavar='N[,N...]',
+                        help='Numbers of reader processes to try (default: %(default)s)')
+    parser.add_argument('--repeats', type=int, default=3, metavar='N', help='Runs of each mode to average over')
+    parser.add_argument('--json', metavar='FILE', help='Write the results to FILE instead of bench/bench_pipeline.json')
+    parser.add_argument('--workdir', metavar='DIR', help='Keep the snapshot and tipsy files in DIR')
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    args, extra = parser.parse_known_args()
+
+    if args.mode is not None:
+        # Run by the parent process below; 'extra' holds the paths and conversion options
+        snapshot, param_file, out_dir = extra[:3]
+        seconds, rss, readers = run_mode(args.mode, snapshot, param_file, out_dir, args.chunk_size, extra[3:],
+                                         args.repeats)
+        print(json.dumps({'seconds': seconds, 'peak_rss_bytes': rss, 'reader_peak_rss_bytes': readers}))
+        return
+
+    modes = ['sequential', 'threads'] + ['processes:{0:d}'.format(int(n)) for n in args.processes.split(',')]
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='bench-pipeline-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        snapshot = os.path.join(workdir, 'synthetic.hdf5')
+        param_file = os.path.join(workdir, 'synthetic.params')
+        counts = make_snapshot.make_from_arguments(snapshot, param_file, args)
+
+        results = {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'version': bench_convert.version(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'snapshot': {
+                'particles': dict(zip(make_snapshot.species, counts)),
+                'compression': args.compression,
+                'bytes': os.path.getsize(snapshot)
+            },
+            'chunk_size': args.chunk_size,
+            'options': extra,
+            'repeats': args.repeats,
+            'modes': {}
+        }
+
+        n = sum(counts)
+        print('{0:d} particles in slabs of {1:d}'.format(n, args.chunk_size))
+        print('{0:14s} {1:>10s} {2:>12s} {3:>9s} {4:>16s} {5:>10s}'.format('mode', 's', 's / Mpart', 'MiB RSS',
+                                                                           'MiB reader RSS', 'identical'))
+        reference = None
+        for mode in modes:
+            out_dir = os.path.join(workdir, mode.replace(':', '-'))
+            os.makedirs(out_dir, exist_ok=True)
+            command = [sys.executable, os.path.abspath(__file__), '--mode', mode, '--repeats', str(args.repeats),
+                       '--chunk-size', str(args.chunk_size)]
+            output = subprocess.check_output(command + [snapshot, param_file, out_dir] + extra, cwd=root)
+            r = json.loads(output.decode().strip().splitlines()[-1])
+
+            tipsy_file = gadget2changa.input_file_name(snapshot, out_dir)
+            if reference is None:
+                reference = tipsy_file
+            r['identical'] = filecmp.cmp(reference, tipsy_file, shallow=False)
+            r['seconds_per_mpart'] = r['seconds'] / n * 1e6
+            r['peak_rss_mib'] = r['peak_rss_bytes'] / 2**20
+            readers = r['reader_peak_rss_bytes']
+            r['reader_peak_rss_mib'] = None if readers is None else readers / 2**20
+            results['modes'][mode] = r
+            print('{0:14s} {1:10.4f} {2:12.4f} {3:9.1f} {4:>16s} {5:>10s}'.format(
+                  mode, r['seconds'], r['seconds_per_mpart'], r['peak_rss_mib'],
+                  '-' if readers is None else '{0:.1f}'.format(r['reader_peak_rss_mib']),
+                  'yes' if r['identical'] else 'NO'))
+            sys.stdout.flush()
+
+        fname = args.json if args.json is not None else os.path.join(results_dir, 'bench_pipeline.json')
+        with open(fname, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to {0:s}'.format(fname))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
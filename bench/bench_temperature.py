@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+    Measure the time and peak memory of converting GADGET internal energies
+    to temperatures, per million gas particles.
+
+    Each method runs in a fresh process so that its peak RSS is not hidden by
+    an earlier run. The RSS reported is the peak over the RSS of the process
+    once the inputs have been made, i.e. the memory used by the conversion.
+
+    usage: bench_temperature.py [-h] [--particles N] [--repeats N] [--method {legacy,blocked}]
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gadget2changa
+
+params = {
+    'UnitLength_in_cm'        : '3.085678e21',
+    'UnitMass_in_g'           : '1.989e43',
+    'UnitVelocity_in_cm_per_s': '1e5',
+    'MinGasTemp'              : '10'
+}
+
+def make_gas(n):
+    rng = np.random.default_rng(42)
+    gas = {}
+    gas['internal_energy'] = rng.uniform(1.0, 1e4, n).astype(np.float32)
+    gas['mass'] = rng.uniform(1e-4, 1e-3, n).astype(np.float32)
+    gas['metals'] = (gas['mass'] * rng.uniform(0.0, 0.02, n)).astype(np.float32)
+    gas['electron_density'] = rng.uniform(0.0, 1.2, n).astype(np.float32)
+    return gas
+
+def legacy(gas, hubble=1.0):
+    """The conversion before it was done in blocks, for comparison"""
+    units = {}
+    units['Length_in_cm'] = float(params['UnitLength_in_cm']) / hubble
+    units['Mass_in_g'] = float(params['UnitMass_in_g']) / hubble
+    units['Velocity_in_cm_per_s'] = float(params['UnitVelocity_in_cm_per_s'])
+    units['Time_in_s'] = units['Length_in_cm'] / units['Velocity_in_cm_per_s']
+    units['Energy_in_cgs'] = units['Mass_in_g'] * units['Length_in_cm'] ** 2 / units['Time_in_s'] ** 2
+
+    boltzmann, protonmass = 1.380649e-16, 1.67262192369e-24
+    X = gas['metals'] / gas['mass']
+    mask = X > 0.0
+    Y = np.zeros(X.shape)
+    Y[mask] = (1.0 - X[mask]) / (4.0 * X[mask])
+    mean_weight = (1.0 + 4.0 * Y) / (1.0 + Y + gas['electron_density'])
+
+    gas_temp = (2.0 / 3.0) / boltzmann * gas['internal_energy'] / gas['mass']
+    gas_temp *= protonmass * mean_weight * units['Energy_in_cgs'] / units['Mass_in_g']
+    gas_temp[gas_temp < float(params['MinGasTemp'])] = float(params['MinGasTemp'])
+    return gas_temp.astype(np.float32, copy=False)
+
+def blocked(gas, out):
+    convert = gadget2changa.temperature_converter(params, 1.0)
+    return convert(gas['internal_energy'], gas['mass'], gas['metals'], gas['electron_density'], out)
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (Linux reports kB)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def run(method, n, repeats):
+    gas = make_gas(n)
+    out = np.zeros(n, dtype=np.float32)  # touch the pages now so they count as inputs
+    base = peak_rss()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        if method == 'legacy':
+            legacy(gas)
+        else:
+            blocked(gas, out)
+    elapsed = (time.perf_counter() - start) / repeats
+
+    print('{0:10s} {1:12.4f} {2:14.1f}'.format(method, elapsed / n * 1e6, (peak_rss() - base) / n * 1e6 / 2**20))
+
+methods = ('legacy', 'blocked')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark converting internal energies to temperatures')
+    parser.add_argument('--particles', type=int, default=4000000, metavar='N', help='Number of gas particles (default: %(default)s)')
+    parser.add_argument('--repeats', type=int, default=3, metavar='N', help='Runs of each method to average over (default: %(default)s)')
+    parser.add_argument('--method', choices=methods, help='Only run this method, in this process (default: each method in a fresh process)')
+    args = parser.parse_args()
+
+    if args.method is not None:
+        run(args.method, args.particles, args.repeats)
+        return
+
+    print('{0:d} gas particles'.format(args.particles))
+    print('{0:10s} {1:>12s} {2:>14s}'.format('method', 's / Mpart', 'MiB RSS / Mpart'))
+    for method in methods:
+        sys.stdout.flush()
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--method', method,
+                               '--particles', str(args.particles), '--repeats', str(args.repeats)])
+
+if __name__ == '__main__':
+    main()
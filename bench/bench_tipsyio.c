@@ -0,0 +1,115 @@
+#define _POSIX_C_SOURCE 200809L
+
+#include "../tipsyio.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+
+/**
+ *	Measure tipsyio write and read throughput for several staging buffer sizes.
+ *	A buffer size of zero is the one-call-per-particle path. The default buffer
+ *	size is also timed writing and reading big-endian "standard" files. Reads
+ *	are compared against plain fread()s of the whole file into a 16 MiB buffer.
+ *
+ *	usage: bench_tipsyio [file] [particles per species]
+ */
+
+static double now() {
+	struct timespec ts;
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (double)ts.tv_sec + 1e-9 * (double)ts.tv_nsec;
+}
+
+static float *make_array(size_t size) {
+	float *a = malloc(size * sizeof(float));
+	if (!a) {
+		perror("malloc");
+		exit(EXIT_FAILURE);
+	}
+	for (size_t i = 0; i < size; ++i) { a[i] = (float)i; }
+	return a;
+}
+
+static double raw_read(const char *fname) {
+	const size_t bufsize = 16u << 20;
+	char *       buf     = malloc(bufsize);
+	FILE *       fd      = fopen(fname, "rb");
+	if (!buf || !fd) {
+		perror("raw_read");
+		exit(EXIT_FAILURE);
+	}
+
+	const double start = now();
+	while (fread(buf, 1, bufsize, fd) == bufsize) {}
+	const double elapsed = now() - start;
+
+	fclose(fd);
+	free(buf);
+	return elapsed;
+}
+
+static void check(const tipsy_file *f, int err) {
+	if (err) {
+		fprintf(stderr, "%s: %s\n", tipsy_strerror(err), tipsy_error(f));
+		exit(EXIT_FAILURE);
+	}
+}
+
+int main(int argc, char **argv) {
+	const char * fname = (argc > 1) ? argv[1] : "bench.tipsy";
+	const size_t n     = (argc > 2) ? strtoul(argv[2], NULL, 10) : 4000000;
+
+	float *scalar = make_array(n);
+	float(*vec)[3] = (float(*)[3])make_array(3 * n);
+
+	const double nbytes = (double)(sizeof(tipsy_header) + n * (sizeof(tipsy_gas_particle) +
+								    sizeof(tipsy_dark_particle) +
+								    sizeof(tipsy_star_particle)));
+
+	const size_t         buffer_sizes[] = {0, 1u << 16, 1u << 20, 4u << 20, 16u << 20, TIPSY_DEFAULT_BUFFER_SIZE};
+	const size_t         nruns          = sizeof(buffer_sizes) / sizeof(buffer_sizes[0]);
+	const tipsy_format_t formats[]      = {TIPSY_NATIVE, TIPSY_NATIVE,  TIPSY_NATIVE,
+					       TIPSY_NATIVE, TIPSY_NATIVE,  TIPSY_STANDARD};
+
+	tipsy_gas_data  gas  = {scalar, vec, vec, scalar, scalar, scalar, scalar, scalar, 0.0f, n};
+	tipsy_dark_data dark = {scalar, vec, vec, scalar, 0.0f, n};
+	tipsy_star_data star = {scalar, vec, vec, scalar, scalar, scalar, 0.0f, n};
+
+	printf("%12s %9s %10s %10s %10s %10s\n", "buffer (B)", "format", "write (s)", "MB/s", "read (s)", "MB/s");
+	for (size_t k = 0; k < nruns; ++k) {
+		tipsy_set_buffer_size(buffer_sizes[k]);
+
+		tipsy_file *f;
+		check(f, tipsy_open(&f, fname, "wb"));
+		tipsy_set_file_format(f, formats[k]);
+		double start = now();
+		check(f, tipsy_file_write_header(f, 0.0, (int)n, (int)n, (int)n));
+		check(f, tipsy_file_write_gas_particles(f, scalar, 1, vec, vec, scalar, scalar, scalar, scalar, scalar, n));
+		check(f, tipsy_file_write_dark_particles(f, scalar, 1, vec, vec, scalar, 0.1f, n));
+		check(f, tipsy_file_write_star_particles(f, scalar, 1, vec, vec, scalar, scalar, scalar, 0.1f, n, 0));
+		tipsy_close(f);
+		const double write_time = now() - start;
+
+		tipsy_header h;
+		check(f, tipsy_open(&f, fname, "rb"));
+		start = now();
+		check(f, tipsy_file_read_header(f, &h));
+		check(f, tipsy_file_read_gas_particles(f, &gas));
+		check(f, tipsy_file_read_dark_particles(f, &dark));
+		check(f, tipsy_file_read_star_particles(f, &star));
+		tipsy_close(f);
+		const double read_time = now() - start;
+
+		printf("%12zu %9s %10.3f %10.1f %10.3f %10.1f\n", buffer_sizes[k],
+		       (formats[k] == TIPSY_STANDARD) ? "standard" : "native", write_time, nbytes / write_time / 1e6,
+		       read_time, nbytes / read_time / 1e6);
+	}
+
+	const double raw_time = raw_read(fname);
+	printf("%12s %9s %10s %10s %10.3f %10.1f\n", "raw fread", "", "", "", raw_time, nbytes / raw_time / 1e6);
+
+	remove(fname);
+	free(scalar);
+	free(vec);
+	return 0;
+}
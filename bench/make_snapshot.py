@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+    Write a synthetic GADGET HDF5 snapshot and a matching parameter file
+
+    Particles are uniformly distributed in the box with normally-distributed
+    velocities. The species mix and which optional fields are present (metals,
+    cooling, potentials, MassTable masses) are configurable, so the converter
+    can be exercised and timed without a GADGET build.
+
+    Datasets are written 'block_size' particles at a time, so snapshots much
+    larger than memory can be made.
+
+    usage: make_snapshot.py [-h] [--particles N] [--mix MIX] [...] snapshot params
+"""
+
+import argparse
+import h5py
+import numpy as np
+
+species = ('gas', 'halo', 'disk', 'bulge', 'stars', 'boundary')
+
+# Default fraction of the particles of each species
+default_mix = 'gas=0.3,halo=0.5,disk=0.1,bulge=0.05,stars=0.05'
+
+params = {
+    'InitCondFile'             : 'synthetic',
+    'SnapshotFileBase'         : 'synthetic',
+    'OutputDir'                : '.',
+    'TimeLimitCPU'             : '86400',
+    'ComovingIntegrationOn'    : '0',
+    'CoolingOn'                : '0',
+    'StarformationOn'          : '0',
+    'TimeBegin'                : '0.0',
+    'TimeMax'                  : '1.0',
+    'TimeBetSnapshot'          : '0.05',
+    'TimeBetStatistics'        : '0.05',
+    'MaxSizeTimestep'          : '0.001',
+    'Omega0'                   : '0',
+    'OmegaLambda'              : '0',
+    'OmegaBaryon'              : '0',
+    'HubbleParam'              : '1.0',
+    'PeriodicBoundariesOn'     : '1',
+    'ErrTolIntAccuracy'        : '0.025',
+    'ErrTolTheta'              : '0.7',
+    'ArtBulkViscConst'         : '0.75',
+    'MinGasTemp'               : '10.0',
+    'CourantFac'               : '0.15',
+    'DesNumNgb'                : '32',
+    'MinGasHsmlFractional'     : '0.0',
+    'UnitLength_in_cm'         : '3.085678e21',
+    'UnitMass_in_g'            : '1.989e43',
+    'UnitVelocity_in_cm_per_s' : '1e5',
+    'SofteningGas'             : '0.1',
+    'SofteningHalo'            : '0.1',
+    'SofteningDisk'            : '0.1',
+    'SofteningBulge'           : '0.1',
+    'SofteningStars'           : '0.1',
+    'SofteningBndry'           : '0.1'
+}
+
+def parse_mix(mix):
+    """Fractions of each species from a string like 'gas=0.3,halo=0.7'"""
+    fractions = dict.fromkeys(species, 0.0)
+    for item in mix.split(','):
+        name, _, value = item.partition('=')
+        if name.strip() not in fractions:
+            raise ValueError('unknown species "{0:s}"'.format(name.strip()))
+        fractions[name.strip()] = float(value)
+
+    total = sum(fractions.values())
+    if total <= 0.0:
+        raise ValueError('the species mix must contain some particles')
+    return [fractions[s] / total for s in species]
+
+def particle_counts(particles, mix=default_mix):
+    """Number of particles of each type, adding up to 'particles'"""
+    fractions = parse_mix(mix)
+    counts = [int(particles * f) for f in fractions]
+
+    # Give any rounding remainder to the most common species
+    counts[int(np.argmax(fractions))] += particles - sum(counts)
+    return counts
+
+def make_snapshot(fname, counts, box_size=100.0, mass_table=False, metals=True, cooling=True, potential=True,
+                  compression=None, block_size=1 << 20, seed=42):
+    """Write a snapshot with counts[i] particles of PartType<i>
+
+    With 'mass_table', every type but gas and stars has its mass in the header
+    MassTable rather than a Masses dataset.
+    """
+    rng = np.random.default_rng(seed)
+    masses = [0.0 if (not mass_table or t in (0, 4)) else 1e-3 * (t + 1) for t in range(6)]
+
+    with h5py.File(fname, 'w') as f:
+        h = f.create_group('Header')
+        h.attrs['NumPart_ThisFile'] = np.array(counts, dtype=np.uint32)
+        h.attrs['NumPart_Total'] = np.array(counts, dtype=np.uint32)
+        h.attrs['NumPart_Total_HighWord'] = np.zeros(6, dtype=np.uint32)
+        h.attrs['MassTable'] = np.array(masses, dtype=np.float64)
+        h.attrs['Time'] = 0.0
+        h.attrs['Redshift'] = 0.0
+        h.attrs['BoxSize'] = float(box_size)
+        h.attrs['NumFilesPerSnapshot'] = 1
+        h.attrs['Flag_Sfr'] = int(metals)
+        h.attrs['Flag_StellarAge'] = int(metals)
+        h.attrs['Flag_Metals'] = int(metals)
+        h.attrs['Flag_Feedback'] = 0
+        h.attrs['Flag_Cooling'] = int(cooling)
+
+        for t, n in enumerate(counts):
+            if n == 0:
+                continue
+
+            fields = {'Coordinates': lambda m: rng.uniform(0.0, box_size, (m, 3)),
+                      'Velocities' : lambda m: rng.normal(0.0, 100.0, (m, 3))}
+            if masses[t] == 0.0:
+                fields['Masses'] = lambda m: rng.uniform(5e-4, 5e-3, m)
+            if potential:
+                fields['Potential'] = lambda m: rng.normal(-1e4, 1e3, m)
+            if metals and t in (0, 3, 4):
+                fields['Metallicity'] = lambda m: rng.uniform(0.0, 0.02, m)
+                fields['StellarFormationTime'] = lambda m: rng.uniform(0.0, 1.0, m)
+            if t == 0:
+                fields['InternalEnergy'] = lambda m: rng.uniform(10.0, 1e4, m)
+                fields['Density'] = lambda m: rng.lognormal(-10.0, 1.0, m)
+                fields['SmoothingLength'] = lambda m: rng.uniform(0.05, 1.0, m)
+                if cooling:
+                    fields['ElectronAbundance'] = lambda m: rng.uniform(0.0, 1.2, m)
+                if metals:
+                    fields['StarFormationRate'] = lambda m: rng.exponential(1e-3, m)
+
+            group = f.create_group('PartType{0:d}'.format(t))
+            for name, make in fields.items():
+                shape = (n, 3) if name in ('Coordinates', 'Velocities') else (n,)
+                chunks = (min(n, 1 << 16),) + shape[1:] if compression else None
+                dataset = group.create_dataset(name, shape, dtype=np.float32, chunks=chunks, compression=compression)
+                for start in range(0, n, block_size):
+                    stop = min(start + block_size, n)
+                    dataset[start:stop] = make(stop - start).astype(np.float32)
+
+def write_parameter_file(fname, box_size=100.0):
+    """Write a GADGET parameter file for the synthetic snapshots"""
+    with open(fname, 'w') as f:
+        for k, v in sorted(dict(params, BoxSize=str(box_size)).items()):
+            f.write('{0:30s} {1:s}\n'.format(k, v))
+
+def add_snapshot_arguments(parser):
+    """Add the options describing a synthetic snapshot to 'parser'"""
+    parser.add_argument('--particles', type=int, default=1000000, metavar='N', help='Total number of particles')
+    parser.add_argument('--mix', default=default_mix, help='Fraction of each species (default: %(default)s)')
+    parser.add_argument('--box-size', type=float, default=100.0, help='Side of the periodic box')
+    parser.add_argument('--mass-table', action='store_true', help='Store non-gas, non-star masses in the MassTable')
+    parser.add_argument('--no-metals', action='store_true', help='Disable star formation and metals')
+    parser.add_argument('--no-cooling', action='store_true', help='Disable cooling (no electron abundances)')
+    parser.add_argument('--no-potential', action='store_true', help='Do not store potentials')
+    parser.add_argument('--compression', choices=('gzip', 'lzf'), help='Compress the datasets')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+
+def make_from_arguments(fname, param_fname, args):
+    """Write the snapshot and parameter file described by the options in 'args'"""
+    counts = particle_counts(args.particles, args.mix)
+    make_snapshot(fname, counts, args.box_size, args.mass_table, not args.no_metals, not args.no_cooling,
+                  not args.no_potential, args.compression, seed=args.seed)
+    write_parameter_file(param_fname, args.box_size)
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic GADGET HDF5 snapshot and parameter file')
+    parser.add_argument('snapshot', help='HDF5 file to write')
+    parser.add_argument('params', help='GADGET parameter file to write')
+    add_snapshot_arguments(parser)
+    args = parser.parse_args()
+
+    counts = make_from_arguments(args.snapshot, args.params, args)
+    print(' '.join('{0:s}={1:d}'.format(s, n) for s, n in zip(species, counts)))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import sys
+
+if sys.version_info.major < 3:
+    print('python3 required!')
+    exit()
+
+import gadget
+import gadget2changa
+import ChaNGa
+import tipsy
+import argparse
+import concurrent.futures
+import h5py
+import math
+import numpy as np
+import os
+import zlib
+
+def _deflate(chunk, level, shuffle):
+    """A chunk compressed as HDF5's shuffle and deflate filters would. For internal use only"""
+    if shuffle:
+        # Group the first bytes of every element, then the second bytes, ...
+        raw = chunk.reshape(-1).view(np.uint8).reshape(-1, chunk.dtype.itemsize).T.tobytes()
+    else:
+        raw = chunk.tobytes()
+    return zlib.compress(raw, level)
+
+class chunked_writer:
+    """Create chunked, optionally compressed datasets and write them in slabs
+
+    Slabs must start on a chunk boundary. With gzip compression, the chunks of
+    each slab are compressed by a pool of 'workers' threads (zlib releases the
+    GIL) and stored as they are with write_direct_chunk, so compression scales
+    with the number of cores. Other filters are applied by HDF5 as each slab is
+    written.
+    """
+    def __init__(self, chunk_size=1 << 16, compression=None, level=4, shuffle=False, workers=None):
+        if compression not in (None, 'gzip', 'lzf'):
+            raise ValueError('unknown compression "{0:s}"'.format(compression))
+        self.chunk_size = int(chunk_size)
+        self.compression = compression
+        self.level = level
+        self.shuffle = shuffle
+        self.pool = None
+        if compression == 'gzip':
+            self.pool = concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count() or 1)
+
+    def create(self, group, name, size, components=1):
+        """Create a float32 dataset of 'size' rows of 'components' values"""
+        shape = (size,) if components == 1 else (size, components)
+        chunks = (min(self.chunk_size, size),) + shape[1:]
+        options = {}
+        if self.compression == 'gzip':
+            options = {'compression': 'gzip', 'compression_opts': self.level}
+        elif self.compression == 'lzf':
+            options = {'compression': 'lzf'}
+        return group.create_dataset(name, shape, dtype=np.float32, chunks=chunks, shuffle=self.shuffle, **options)
+
+    def write(self, dataset, start, data):
+        """Write 'data' to the rows of 'dataset' from 'start' on"""
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if self.pool is None:
+            dataset[start:start + len(data)] = data
+            return
+
+        rows = dataset.chunks[0]
+        def compress(offset):
+            chunk = data[offset:offset + rows]
+            if len(chunk) < rows:
+                # Chunks at the end of the dataset are stored whole
+                chunk = np.concatenate([chunk, np.zeros((rows - len(chunk),) + chunk.shape[1:], np.float32)])
+            return _deflate(chunk, self.level, self.shuffle)
+
+        offsets = range(0, len(data), rows)
+        for offset, chunk in zip(offsets, self.pool.map(compress, offsets)):
+            dataset.id.write_direct_chunk((start + offset,) + (0,) * (data.ndim - 1), chunk)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False  # always re-raise exceptions
+
+def blocks(particles, block_size, select=None):
+    """Yield the particles of a tipsy section 'block_size' at a time, keeping only those 'select' accepts"""
+    for start in range(0, len(particles), block_size):
+        block = particles[start:start + block_size]
+        yield block if select is None else block[select(block)]
+
+def survey(particles, block_size, select=None, fields=()):
+    """Number of particles selected, their common mass (or 0 if their masses differ), and the set of 'fields' that
+    are not all zero
+    """
+    count, mass, nonzero = 0, None, set()
+    for block in blocks(particles, block_size, select):
+        if len(block) == 0:
+            continue
+        if mass is None:
+            mass = block['mass'][0]
+        if mass != 0.0 and np.any(block['mass'] != mass):
+            mass = 0.0
+        nonzero.update(name for name in fields if np.any(block[name] != 0.0))
+        count += len(block)
+    return count, 0.0 if mass is None else float(mass), nonzero
+
+def slabs(particles, slab_size, block_size, select=None):
+    """Yield the selected particles in slabs of exactly 'slab_size', except for the last"""
+    pending = []
+    size = 0
+    for block in blocks(particles, block_size, select):
+        pending.append(block)
+        size += len(block)
+        if size >= slab_size:
+            merged = np.concatenate(pending)
+            for start in range(0, size - slab_size + 1, slab_size):
+                yield merged[start:start + slab_size]
+            rest = merged[size - size % slab_size:]
+            pending, size = [rest], len(rest)
+    if size > 0:
+        yield np.concatenate(pending)
+
+def convert(tipsy_file, gadget_params, out_name, args):
+    """Write the particles of an open tipsy.File (opened with memmap=True) as a GADGET HDF5 snapshot
+
+    This undoes the unit conversions of gadget2changa using the GADGET parameters
+    'gadget_params'. Gas temperatures are turned back into internal energies
+    assuming a neutral gas, as electron abundances are not kept in tipsy files.
+    """
+    time = float(tipsy_file.header.time)
+    is_cosmological = int(gadget_params['ComovingIntegrationOn']) == 1
+
+    redshift = 0.0
+    hubble = 1.0
+    if is_cosmological:
+        redshift = 1.0 / time - 1.0 if time > 0.0 else 0.0
+        hubble = float(gadget_params['HubbleParam'])
+        if hubble == 0.0:
+            hubble = 1.0
+
+    # The inverses of the scales applied by gadget2changa
+    velocity_scale = 1.0 / math.sqrt(1.0 + redshift)
+    _, _, mass_scale = ChaNGa.convert_units(gadget_params)
+    mass_scale = 1.0 / float(mass_scale)
+    temperature = gadget2changa.temperature_converter(gadget_params, hubble)
+    energy_scale = 1.0 / (temperature.neutral_mean_weight * temperature.factor)
+
+    # Scaled in double precision, so the round trip loses at most an ulp
+    def scaled(a, scale):
+        return a.astype(np.float64) * scale
+    
+    def mass(slab):
+        return scaled(slab['mass'], mass_scale)
+
+    # GADGET datasets of each section, and the tipsy fields they come from
+    fields = {
+        'gas': {
+            'Coordinates'         : lambda s: s['pos'],
+            'Velocities'          : lambda s: scaled(s['vel'], velocity_scale),
+            'Density'             : lambda s: s['rho'],
+            'InternalEnergy'      : lambda s: scaled(s['temp'], energy_scale) * mass(s),
+            'SmoothingLength'     : lambda s: s['hsmooth'],
+            'Metallicity'         : lambda s: s['metals'],
+            'Potential'           : lambda s: s['phi']
+        },
+        'darkmatter': {
+            'Coordinates'         : lambda s: s['pos'],
+            'Velocities'          : lambda s: scaled(s['vel'], velocity_scale),
+            'Potential'           : lambda s: s['phi']
+        },
+        'stars': {
+            'Coordinates'         : lambda s: s['pos'],
+            'Velocities'          : lambda s: scaled(s['vel'], velocity_scale),
+            'Metallicity'         : lambda s: s['metals'],
+            'StellarFormationTime': lambda s: s['tform'],
+            'Potential'           : lambda s: s['phi']
+        }
+    }
+
+    # (GADGET particle type, tipsy section, selection) in file order. Black holes
+    # were written by gadget2changa as stars with a formation time of -1
+    types = [(0, 'gas', None), (1, 'darkmatter', None), (4, 'stars', None)]
+    if args.bh_to_boundary:
+        types = [(0, 'gas', None), (1, 'darkmatter', None), (4, 'stars', lambda b: b['tform'] >= 0.0),
+                 (5, 'stars', lambda b: b['tform'] < 0.0)]
+
+    counts = [0] * 6
+    mass_table = [0.0] * 6
+    has_metals = False
+    for index, section, select in types:
+        counts[index], uniform, nonzero = survey(getattr(tipsy_file, section), args.block_size, select,
+                                                 ('metals',) if section != 'darkmatter' else ())
+        mass_table[index] = uniform * mass_scale
+        has_metals = has_metals or 'metals' in nonzero
+
+    # Only claim the physics the particles show: metals if any are non-zero, and
+    # stellar ages if there are stars. Datasets the flags disable are not written
+    has_ages = counts[4] > 0
+    for section in ('gas', 'stars'):
+        if not has_metals:
+            del fields[section]['Metallicity']
+    if not has_ages:
+        del fields['stars']['StellarFormationTime']
+
+    writer = chunked_writer(args.chunk_size, None if args.compression == 'none' else args.compression,
+                            args.compression_level, args.shuffle, args.workers)
+    with writer, h5py.File(out_name, 'w') as f:
+        h = f.create_group('Header')
+        h.attrs['NumPart_ThisFile'] = np.array(counts, dtype=np.uint32)
+        h.attrs['NumPart_Total'] = np.array(counts, dtype=np.uint32)
+        h.attrs['NumPart_Total_HighWord'] = np.zeros(6, dtype=np.uint32)
+        h.attrs['MassTable'] = np.array(mass_table, dtype=np.float64)
+        h.attrs['Time'] = time
+        h.attrs['Redshift'] = redshift
+        h.attrs['BoxSize'] = float(gadget_params.data.get('BoxSize', 0.0))
+        h.attrs['NumFilesPerSnapshot'] = 1
+        h.attrs['Omega0'] = float(gadget_params.data.get('Omega0', 0.0))
+        h.attrs['OmegaLambda'] = float(gadget_params.data.get('OmegaLambda', 0.0))
+        h.attrs['HubbleParam'] = float(gadget_params.data.get('HubbleParam', 1.0))
+        h.attrs['Flag_Sfr'] = int(has_metals or has_ages)
+        h.attrs['Flag_Metals'] = int(has_metals)
+        h.attrs['Flag_StellarAge'] = int(has_ages)
+        # Electron abundances are not kept in tipsy files
+        h.attrs['Flag_Cooling'] = 0
+        h.attrs['Flag_Feedback'] = 0
+        h.attrs['Flag_DoublePrecision'] = 0
+
+        slab_size = args.chunk_size * max(args.workers or os.cpu_count() or 1, 1)
+        for index, section, select in types:
+            if counts[index] == 0:
+                continue
+            print('GADGET: Writing PartType{0:d}...'.format(index))
+
+            group = f.create_group('PartType{0:d}'.format(index))
+            datasets = {name: writer.create(group, name, counts[index], 3 if name in ('Coordinates', 'Velocities') else 1)
+                        for name in fields[section]}
+            if mass_table[index] == 0.0:
+                datasets['Masses'] = writer.create(group, 'Masses', counts[index])
+
+            start = 0
+            for slab in slabs(getattr(tipsy_file, section), slab_size, args.block_size, select):
+                for name, dataset in datasets.items():
+                    writer.write(dataset, start, mass(slab) if name == 'Masses' else fields[section][name](slab))
+                start += len(slab)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert ChaNGa (tipsy) files to GADGET2 HDF5 files')
+    parser.add_argument('tipsy_file', metavar='TIPSY', help='tipsy file to convert')
+    parser.add_argument('param_file', metavar='Parameter', help='GADGET2 parameter file giving the units to convert to')
+    parser.add_argument('out_file', metavar='GADGET', help='GADGET2 HDF5 file to write')
+    parser.add_argument('--bh-to-boundary', action='store_true', help='Write black holes as boundary (PartType5) particles')
+    parser.add_argument('--compression', choices=('gzip', 'lzf', 'none'), default='gzip', help='Compression filter (default: %(default)s)')
+    parser.add_argument('--compression-level', type=int, default=4, choices=range(10), metavar='N', help='gzip compression level (default: %(default)s)')
+    parser.add_argument('--shuffle', action='store_true', help='Apply the shuffle filter before compressing')
+    parser.add_argument('--chunk-size', type=int, default=1 << 16, metavar='N', help='Particles per HDF5 chunk (default: %(default)s)')
+    parser.add_argument('--workers', type=int, metavar='N', help='Compress with N threads (default: number of CPUs)')
+    parser.add_argument('--block-size', type=int, default=1 << 20, metavar='N', help='Read at most N tipsy particles at a time (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.chunk_size < 1 or args.block_size < 1:
+        parser.error('--chunk-size and --block-size must be positive')
+
+    try:
+        gadget_params = gadget.Parameter_file(args.param_file)
+    except Exception as e:
+        print('\nERROR: {0:s}\n\n'.format(str(e)))
+        parser.print_help()
+        exit()
+
+    with tipsy.File(args.tipsy_file, memmap=True) as tipsy_file:
+        convert(tipsy_file, gadget_params, args.out_file, args)
+
+if __name__ == '__main__':
+    main()
@@ -1,116 +1,421 @@
 import numpy as np
 import h5py
+import os
+import re
+import tempfile
+import concurrent.futures
+import multiprocessing
 
-class gadget_particle:
-    def __init__(self, data, mass, header):
-        self.positions = np.empty(data['Coordinates'].shape, data['Coordinates'].dtype)
-        data['Coordinates'].read_direct(self.positions)
-        
-        self.velocities = np.empty(data['Velocities'].shape, data['Velocities'].dtype)
-        data['Velocities'].read_direct(self.velocities)
+def snapshot_files(fname):
+    """The files making up the snapshot containing 'fname'
+    
+    Multi-file snapshots are named 'base.0.hdf5' ... 'base.N-1.hdf5', with N given
+    by the NumFilesPerSnapshot header entry. 'fname' may name any of the pieces
+    or be just 'base'.
+    """
+    match = re.match(r'^(.*?)(\.\d+)?\.hdf5$', fname)
+    base = match.group(1) if match else fname
+    first = fname if os.path.exists(fname) else base + '.0.hdf5'
+    
+    with h5py.File(first, 'r') as file:
+        nfiles = int(file['Header'].attrs.get('NumFilesPerSnapshot', 1))
+    
+    if nfiles <= 1:
+        return [first]
+    return ['{0:s}.{1:d}.hdf5'.format(base, i) for i in range(nfiles)]
+
+def _shared_empty(shape, dtype):
+    """An uninitialized array that worker processes can write into. For internal use only
+    
+    The array is backed by a file (in /dev/shm where available) whose name is
+    returned alongside it. Unlinking the name does not invalidate the array.
+    """
+    if int(np.prod(shape)) == 0:
+        return np.empty(shape, dtype), None
+    
+    shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, path = tempfile.mkstemp(prefix='gadget-', dir=shm)
+    os.close(fd)
+    return np.asarray(np.memmap(path, dtype=dtype, mode='w+', shape=shape)), path
+
+# The HDF5 file last opened by each worker process, kept open for its next read, as (name, file)
+_worker_file = [None, None]
+
+def _open_piece(fname):
+    """The open HDF5 file 'fname', closing the one opened before it. For internal use only"""
+    if _worker_file[0] != fname:
+        if _worker_file[1] is not None:
+            _worker_file[1].close()
+        # Forget the old file before opening, so a failed open is not mistaken for it
+        _worker_file[:] = [None, None]
+        _worker_file[:] = [fname, h5py.File(fname, 'r')]
+    return _worker_file[1]
+
+def _read_piece(fname, path, start, stop, out_path, out_shape, out_dtype, offset):
+    """Read rows [start, stop) of dataset 'path' into rows starting at 'offset' of a shared array.
+    For internal use only
+    """
+    out = np.memmap(out_path, dtype=out_dtype, mode='r+', shape=out_shape)
+    _open_piece(fname)[path].read_direct(out, source_sel=np.s_[start:stop], dest_sel=np.s_[offset:offset + stop - start])
+    out.flush()
+
+class _multi_dataset:
+    """A dataset split across the pieces of a snapshot. For internal use only
+    
+    With a pool of 'workers' processes, each piece is further split into
+    hyperslabs of at least 'slab_size' rows that are read concurrently, so even
+    a single large (or compressed) dataset is read by all of the workers.
+    """
+    def __init__(self, name, pieces, pool, workers=1, slab_size=1 << 16):
+        self.name = name
+        self.pieces = pieces
+        self.pool = pool
+        self.workers = workers
+        self.slab_size = slab_size
         
-        self.size = self.positions.shape[0]
+        first = pieces[0][1][name]
+        self.dtype = first.dtype
+        self.shape = (sum(count for _, _, _, count in pieces),) + first.shape[1:]
+    
+    def read(self, start, stop, out=None):
+        """Read rows [start, stop), into 'out' if given
         
-        if (float(mass) <= 0.0):
-            self.mass = np.empty(data['Masses'].shape, data['Masses'].dtype)
-            data['Masses'].read_direct(self.mass)
+        With a pool, the workers read into shared memory, which is then copied
+        into 'out'.
+        """
+        if out is not None and self.pool is None:
+            data, path = out, None
+        elif self.pool is None:
+            data, path = np.empty((stop - start,) + self.shape[1:], self.dtype), None
         else:
-            self.mass = float(mass) * np.ones(self.size, dtype=np.float32)
+            data, path = _shared_empty((stop - start,) + self.shape[1:], self.dtype)
+        
+        futures = []
+        for fname, group, offset, count in self.pieces:
+            # The part of this piece that falls within [start, stop)
+            lo, hi = max(start, offset), min(stop, offset + count)
+            if lo >= hi:
+                continue
+            
+            dataset = group[self.name]
+            if path is None:
+                dataset.read_direct(data, source_sel=np.s_[lo - offset:hi - offset],
+                                    dest_sel=np.s_[lo - start:hi - start])
+                continue
+            
+            for a, b in self._hyperslabs(dataset, lo - offset, hi - offset, stop - start):
+                futures.append(self.pool.submit(_read_piece, fname, dataset.name, a, b,
+                                                path, data.shape, data.dtype, a + offset - start))
+        
+        try:
+            for f in futures:
+                f.result()
+        finally:
+            if path is not None:
+                os.unlink(path)
         
-        self.potential = None
-        if 'Potential' in data.keys():
-             self.potential = np.empty(data['Potential'].shape, data['Potential'].dtype)
-             data['Potential'].read_direct(self.potential)
+        if out is not None and data is not out:
+            out[...] = data
+            return out
+        return data
+
+    def _hyperslabs(self, dataset, lo, hi, total):
+        """Split rows [lo, hi) of 'dataset' into ranges for the workers. For internal use only
+        
+        The rows of a read of 'total' rows are shared evenly between the workers.
+        Boundaries fall on the dataset's chunks, so no chunk is decompressed twice.
+        """
+        rows = max(-(-total // self.workers), self.slab_size)
+        if dataset.chunks is not None:
+            chunk = dataset.chunks[0]
+            rows = -(-rows // chunk) * chunk
+        
+        # Keep the boundaries at multiples of 'rows' from the start of the dataset
+        first = lo - lo % rows
+        return [(max(a, lo), min(a + rows, hi)) for a in range(first, hi, rows)]
+
+class _multi_group:
+    """A PartType group split across the pieces of a snapshot. For internal use only
+    
+    'pieces' holds (file name, group, offset, count) for each piece, where
+    'offset' is the index of the piece's first particle in the whole snapshot.
+    """
+    def __init__(self, pieces, pool, workers=1, slab_size=1 << 16):
+        self.pieces = pieces
+        self.pool = pool
+        self.workers = workers
+        self.slab_size = slab_size
+    
+    def __getitem__(self, name):
+        return _multi_dataset(name, self.pieces, self.pool, self.workers, self.slab_size)
+    
+    def keys(self):
+        return self.pieces[0][1].keys()
+
+def _read_dataset(dataset, start=0, stop=None, out=None):
+    """Read the particles [start, stop) of a dataset, into 'out' if given. For internal use only"""
+    size = dataset.shape[0]
+    stop = size if stop is None else min(stop, size)
+    if isinstance(dataset, _multi_dataset):
+        return dataset.read(start, stop, out)
+    data = np.empty((stop - start,) + dataset.shape[1:], dataset.dtype) if out is None else out
+    if stop > start:
+        dataset.read_direct(data, source_sel=np.s_[start:stop])
+    return data
+
+class _field:
+    """A particle field read from its dataset on first access. For internal use only
+    
+    If 'enabled' returns False for the snapshot header, or the dataset is absent
+    and not 'required', the field is None. 'missing' is printed in the latter case.
+    """
+    def __init__(self, dataset, enabled=None, required=True, missing=None):
+        self.dataset = dataset
+        self.enabled = enabled
+        self.required = required
+        self.missing = missing
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+    
+    def load(self, particle, out=None):
+        if self.enabled is not None and not self.enabled(particle.header):
+            return None
+        if not self.required and self.dataset not in particle.data.keys():
+            if self.missing is not None:
+                print(self.missing)
+            return None
+        return _read_dataset(particle.data[self.dataset], particle.start, particle.stop, out)
+    
+    def __get__(self, particle, owner):
+        if particle is None:
+            return self
+        value = self.load(particle)
+        if particle.cache:
+            # Shadows this descriptor until the cache is dropped
+            particle.__dict__[self.name] = value
+        return value
+
+class _mass_field(_field):
+    """Masses are either per-particle or a single value from the MassTable. For internal use only
+    
+    A MassTable mass is a float32 scalar rather than an array of identical values.
+    """
+    def load(self, particle, out=None):
+        if float(particle.mass_table_entry) <= 0.0:
+            return super().load(particle, out)
+        return np.float32(particle.mass_table_entry)
+
+def _flags(*names):
+    """Enable a field only if all of the header flags 'names' are set. For internal use only"""
+    return lambda header: all(header[n] for n in names)
+
+class gadget_particle:
+    """The particles [start, stop) of one particle type
+    
+    Each field is read from the open snapshot the first time it is used. If
+    'cache' is True, it is then kept until drop_cache() is called; otherwise,
+    it is re-read on every access.
+    """
+    positions  = _field('Coordinates')
+    velocities = _field('Velocities')
+    mass       = _mass_field('Masses')
+    potential  = _field('Potential', required=False)
+    
+    def __init__(self, data, mass, header, start=0, stop=None, cache=True):
+        self.data = data
+        self.mass_table_entry = mass
+        self.header = header
+        self.cache = cache
+        
+        nparts = data['Coordinates'].shape[0]
+        self.start = start
+        self.stop = nparts if stop is None else min(stop, nparts)
+        self.size = max(self.stop - self.start, 0)
+    
+    @classmethod
+    def field_names(cls):
+        """Names of the fields of this particle type"""
+        return [name for c in reversed(cls.__mro__) for name, attr in vars(c).items() if isinstance(attr, _field)]
+    
+    def drop_cache(self):
+        """Release all fields read so far"""
+        for name in self.field_names():
+            self.__dict__.pop(name, None)
+    
+    def read(self, name, out=None):
+        """Read the field 'name' now, bypassing the cache
+        
+        Array fields are read into 'out', if given, which must be a C-contiguous
+        array of the shape and type of the dataset's rows. Without read workers
+        the rows are read directly into it; with them, they are read in
+        parallel and then copied.
+        """
+        return getattr(type(self), name).load(self, out)
 
 class gadget_particle_with_metals(gadget_particle):
-    def __init__(self, data, mass, header):
-        super().__init__(data, mass, header)
-        self.t_form = None
-        if header['Flag_Sfr'] and header['Flag_StellarAge']:
-            if 'StellarFormationTime' in data.keys():
-                self.t_form = np.empty(data['StellarFormationTime'].shape, data['StellarFormationTime'].dtype)
-                data['StellarFormationTime'].read_direct(self.t_form)
-            else:
-                print('Stellar evolution enabled, but StellarFormationTime is not present. Skipping...')
-        
-        self.metals = None
-        if header['Flag_Sfr'] and header['Flag_Metals']:
-            if 'Metallicity' in data.keys():
-                self.metals = np.empty(data['Metallicity'].shape, data['Metallicity'].dtype)
-                data['Metallicity'].read_direct(self.metals)
-            else:
-                print('Star formation and metals enabled, but no stellar metals found. Skipping...')
+    t_form = _field('StellarFormationTime', enabled=_flags('Flag_Sfr', 'Flag_StellarAge'), required=False,
+                    missing='Stellar evolution enabled, but StellarFormationTime is not present. Skipping...')
+    metals = _field('Metallicity', enabled=_flags('Flag_Sfr', 'Flag_Metals'), required=False,
+                    missing='Star formation and metals enabled, but no stellar metals found. Skipping...')
 
 class gadget_gas_particle(gadget_particle_with_metals):
-    def __init__(self, data, mass, header):
-        super().__init__(data, mass, header)
-        # If not using traditional SPH, then this is really
-        #
-        #    meanweight = 4.0 / (1 + 3 * HYDROGEN_MASSFRAC)
-        #    All.MinEgySpec = 1 / meanweight * (1.0 / GAMMA_MINUS1) * (BOLTZMANN / PROTONMASS) * All.MinGasTemp
-        #    All.MinEgySpec *= All.UnitMass_in_g / All.UnitEnergy_in_cgs
-        #
-        #    max(All.MinEgySpec,
-        #        SphP[pindex].Entropy / GAMMA_MINUS1 * pow(SphP[pindex].d.Density * a3inv, GAMMA_MINUS1))
-        #
-        self.internal_energy = np.empty(data['InternalEnergy'].shape, data['InternalEnergy'].dtype)
-        data['InternalEnergy'].read_direct(self.internal_energy)
-        
-        self.density = np.empty(data['Density'].shape, data['Density'].dtype)
-        data['Density'].read_direct(self.density)
-        
-        self.hsml = np.empty(data['SmoothingLength'].shape, data['SmoothingLength'].dtype)
-        data['SmoothingLength'].read_direct(self.hsml)
-
-        
-        self.electron_density = None
-        if header['Flag_Cooling']:
-            self.electron_density = np.empty(data['ElectronAbundance'].shape, data['ElectronAbundance'].dtype)
-            data['ElectronAbundance'].read_direct(self.electron_density)
-        
-        self.sfr = None
-        if header['Flag_Sfr']:
-            self.sfr = np.empty(data['StarFormationRate'].shape, data['StarFormationRate'].dtype)
-            data['StarFormationRate'].read_direct(self.sfr)
+    # If not using traditional SPH, then this is really
+    #
+    #    meanweight = 4.0 / (1 + 3 * HYDROGEN_MASSFRAC)
+    #    All.MinEgySpec = 1 / meanweight * (1.0 / GAMMA_MINUS1) * (BOLTZMANN / PROTONMASS) * All.MinGasTemp
+    #    All.MinEgySpec *= All.UnitMass_in_g / All.UnitEnergy_in_cgs
+    #
+    #    max(All.MinEgySpec,
+    #        SphP[pindex].Entropy / GAMMA_MINUS1 * pow(SphP[pindex].d.Density * a3inv, GAMMA_MINUS1))
+    #
+    internal_energy  = _field('InternalEnergy')
+    density          = _field('Density')
+    hsml             = _field('SmoothingLength')
+    electron_density = _field('ElectronAbundance', enabled=_flags('Flag_Cooling'))
+    sfr              = _field('StarFormationRate', enabled=_flags('Flag_Sfr'))
+
+class particle_stream:
+    """Read a particle type in fixed-size slabs of at most 'chunk_size' particles.
+    
+    Iterating yields particle objects of type 'kind' covering consecutive
+    slabs from particle 'start' on, so only one slab is held in memory at a time.
+    """
+    def __init__(self, kind, data, mass, header, chunk_size, cache=True, start=0):
+        if int(chunk_size) <= 0:
+            raise ValueError('chunk size must be positive')
+        self.kind = kind
+        self.data = data
+        self.mass_table_entry = mass
+        self.header = header
+        self.chunk_size = int(chunk_size)
+        self.cache = cache
+        self.size = data['Coordinates'].shape[0]
+        self.start = int(start)
+    
+    def __iter__(self):
+        for start in range(self.start, self.size, self.chunk_size):
+            yield self.kind(self.data, self.mass_table_entry, self.header, start, start + self.chunk_size,
+                            self.cache)
 
 class File:
-    def __init__(self, fname):
-        with h5py.File(fname, 'r') as file:
-            self.header = {}
-            
-            # copy.deepcopy was failing, so just do it manually
-            for k, v in file['Header'].attrs.items():
-                self.header[k] = v
-
-            self.gas = None
-            if file.__contains__('PartType0'):
-                print('GADGET: Reading gas...')
-                self.gas = gadget_gas_particle(file['PartType0'], self.header['MassTable'][()][0], self.header)
-
-            self.halo = None
-            if file.__contains__('PartType1'):
-                print('GADGET: Reading halo...')
-                self.halo = gadget_particle(file['PartType1'], self.header['MassTable'][()][1], self.header)
-                
-            self.disk = None
-            if file.__contains__('PartType2'):
-                print('GADGET: Reading disk...')
-                self.disk = gadget_particle(file['PartType2'], self.header['MassTable'][()][2], self.header)
-            
-            self.bulge = None
-            if file.__contains__('PartType3'):
-                print('GADGET: Reading bulge...')
-                self.bulge = gadget_particle_with_metals(file['PartType3'], self.header['MassTable'][()][3], self.header)
+    """A GADGET HDF5 snapshot
+    
+    The files are kept open until close() is called. Each field of a particle type
+    is only read when it is first used (see gadget_particle); with 'cache' False,
+    fields are not kept after being read. If 'chunk_size' is given, each particle
+    type is a 'particle_stream' that reads at most 'chunk_size' particles at a time.
+    
+    Snapshots split across several files (see snapshot_files) are read as one.
+    Each piece is placed at the offset given by the NumPart_ThisFile entries of
+    the pieces before it.
+    
+    If 'workers' is given, datasets are read concurrently by that many processes
+    directly into shared memory. Each read is split into hyperslabs of at least
+    'slab_size' particles, aligned to the HDF5 chunks, so this also speeds up
+    reading single-file snapshots, especially compressed ones.
+    """
+    def __init__(self, fname, chunk_size=None, workers=None, cache=True, slab_size=1 << 16):
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.fnames = snapshot_files(fname)
+        self.files = [h5py.File(f, 'r') for f in self.fnames]
+        file = self.files[0]
+        
+        self.pool = None
+        self.workers = 1 if workers is None else max(int(workers), 1)
+        self.slab_size = int(slab_size)
+        if self.workers > 1:
+            # Workers must not inherit the HDF5 library state of this process
+            self.pool = concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'))
+        
+        self.header = {}
+        
+        # copy.deepcopy was failing, so just do it manually
+        for k, v in file['Header'].attrs.items():
+            self.header[k] = v
+        
+        # Make the header describe the whole snapshot
+        if len(self.files) > 1:
+            self.header['NumPart_ThisFile'] = sum(f['Header'].attrs['NumPart_ThisFile'].astype(np.int64)
+                                                  for f in self.files)
+
+        self.gas = None
+        if self._contains('PartType0'):
+            print('GADGET: Found gas...')
+            self.gas = self._read(gadget_gas_particle, 'PartType0', 0)
+
+        self.halo = None
+        if self._contains('PartType1'):
+            print('GADGET: Found halo...')
+            self.halo = self._read(gadget_particle, 'PartType1', 1)
             
-            self.stars = None
-            if file.__contains__('PartType4'):
-                print('GADGET: Reading star...')
-                self.stars = gadget_particle_with_metals(file['PartType4'], self.header['MassTable'][()][4], self.header)
-
-            self.boundary = None
-            if file.__contains__('PartType5'):
-                print('GADGET: Reading boundary...')
-                self.boundary = gadget_particle(file['PartType5'], self.header['MassTable'][()][5], self.header)
+        self.disk = None
+        if self._contains('PartType2'):
+            print('GADGET: Found disk...')
+            self.disk = self._read(gadget_particle, 'PartType2', 2)
+        
+        self.bulge = None
+        if self._contains('PartType3'):
+            print('GADGET: Found bulge...')
+            self.bulge = self._read(gadget_particle_with_metals, 'PartType3', 3)
+        
+        self.stars = None
+        if self._contains('PartType4'):
+            print('GADGET: Found star...')
+            self.stars = self._read(gadget_particle_with_metals, 'PartType4', 4)
+
+        self.boundary = None
+        if self._contains('PartType5'):
+            print('GADGET: Found boundary...')
+            self.boundary = self._read(gadget_particle, 'PartType5', 5)
+    
+    def _contains(self, group):
+        """For internal use only"""
+        return any(f.__contains__(group) for f in self.files)
+    
+    def _group(self, group, index):
+        """For internal use only"""
+        if len(self.files) == 1 and self.pool is None:
+            return self.files[0][group]
+        
+        pieces = []
+        offset = 0
+        for fname, f in zip(self.fnames, self.files):
+            count = int(f['Header'].attrs['NumPart_ThisFile'][index])
+            if f.__contains__(group):
+                pieces.append((fname, f[group], offset, count))
+            offset += count
+        return _multi_group(pieces, self.pool, self.workers, self.slab_size)
+    
+    def _read(self, kind, group, index):
+        """For internal use only"""
+        mass = self.header['MassTable'][()][index]
+        data = self._group(group, index)
+        if self.chunk_size is None:
+            return kind(data, mass, self.header, cache=self.cache)
+        return particle_stream(kind, data, mass, self.header, self.chunk_size, self.cache)
+    
+    def drop_cache(self):
+        """Release all particle fields read so far"""
+        for p in (self.gas, self.halo, self.disk, self.bulge, self.stars, self.boundary):
+            if isinstance(p, gadget_particle):
+                p.drop_cache()
+    
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False  # always re-raise exceptions
 
 class Parameter_file():
     def __init__(self, fname):
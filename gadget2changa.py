@@ -8,175 +8,744 @@ if sys.version_info.major < 3:
 
 import gadget
 import ChaNGa
+import journal
+import profiling
+import sfc
 import tipsy
 import argparse
 import astropy.units as apu
 import astropy.constants as apc
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
 import math
+import multiprocessing
+import multiprocessing.shared_memory
 import numpy as np
+import os
+import queue
+import threading
+import time
+import zlib
 
-def convert_U_to_temperature(gadget_params, gadget_file, hubble):
-    # TODO: Check these units wrt the mass conversion between GADGET and ChaNGa
-    units = {}
-    units['Length_in_cm'] = float(gadget_params['UnitLength_in_cm']) / hubble
-    units['Mass_in_g'] = float(gadget_params['UnitMass_in_g']) / hubble
-    units['Velocity_in_cm_per_s'] = float(gadget_params['UnitVelocity_in_cm_per_s'])
-    units['Time_in_s'] = units['Length_in_cm'] / units['Velocity_in_cm_per_s']
-    units['Energy_in_cgs'] = units['Mass_in_g'] * units['Length_in_cm'] ** 2 / units['Time_in_s'] ** 2
-    
-    constants = {
-        'boltzmann'     : apc.k_B.cgs.value,
-        'protonmass'    : apc.m_p.cgs.value,
-        'gamma_minus1'  : (5.0 / 3.0) - 1.0,
-        'h_massfrac'    : 0.76
-    }
+class temperature_converter:
+    """Convert GADGET specific internal energies to temperatures in Kelvin
+    
+    The unit conversion is worked out once, so one converter can be applied
+    to any number of slabs. Particles are converted 'block_size' at a time
+    using scratch buffers owned by the converter, so the memory used beyond
+    the output does not grow with the number of particles.
+    """
+    def __init__(self, gadget_params, hubble, block_size=1 << 16):
+        # TODO: Check these units wrt the mass conversion between GADGET and ChaNGa
+        units = {}
+        units['Length_in_cm'] = float(gadget_params['UnitLength_in_cm']) / hubble
+        units['Mass_in_g'] = float(gadget_params['UnitMass_in_g']) / hubble
+        units['Velocity_in_cm_per_s'] = float(gadget_params['UnitVelocity_in_cm_per_s'])
+        units['Time_in_s'] = units['Length_in_cm'] / units['Velocity_in_cm_per_s']
+        units['Energy_in_cgs'] = units['Mass_in_g'] * units['Length_in_cm'] ** 2 / units['Time_in_s'] ** 2
+        
+        constants = {
+            'boltzmann'     : apc.k_B.cgs.value,
+            'protonmass'    : apc.m_p.cgs.value,
+            'gamma_minus1'  : (5.0 / 3.0) - 1.0,
+            'h_massfrac'    : 0.76
+        }
+        
+        # See GADGET3/density.c:1426  for details on these calculations
+        self.neutral_mean_weight = 4.0 / (1.0 + 3.0 * constants['h_massfrac'])
+        self.factor = constants['gamma_minus1'] / constants['boltzmann'] * constants['protonmass']
+        self.factor *= units['Energy_in_cgs'] / units['Mass_in_g']
+        self.min_temp = float(gadget_params['MinGasTemp'])
+        
+        self.block_size = int(block_size)
+        self.mean_weight = np.empty(self.block_size)
+        self.temp = np.empty(self.block_size)
+        self.mask = np.empty(self.block_size, dtype=bool)
+    
+    def __call__(self, internal_energy, mass, metals=None, electron_density=None, out=None):
+        """Temperatures of the particles as float32, written into 'out' if given
+        
+        'mass' may be a scalar. The mean molecular weight accounts for metals and
+        free electrons only if both 'metals' and 'electron_density' are given.
+        """
+        size = len(internal_energy)
+        if out is None:
+            out = np.empty(size, dtype=np.float32)
+        
+        for start in range(0, size, self.block_size):
+            block = slice(start, min(start + self.block_size, size))
+            n = block.stop - block.start
+            
+            def part(a):
+                return a if np.ndim(a) == 0 else a[block]
+            
+            mean_weight, temp, mask = self.mean_weight[:n], self.temp[:n], self.mask[:n]
+            
+            if metals is not None and electron_density is not None:
+                # Y = (1 - X) / (4 X) where X = metals / mass > 0, and 0 elsewhere
+                np.divide(part(metals), part(mass), out=temp)
+                np.greater(temp, 0.0, out=mask)
+                np.subtract(1.0, temp, out=mean_weight)
+                np.multiply(temp, 4.0, out=temp)
+                np.divide(mean_weight, temp, out=mean_weight, where=mask)
+                np.logical_not(mask, out=mask)
+                np.copyto(mean_weight, 0.0, where=mask)
+                
+                # mean weight = (1 + 4 Y) / (1 + Y + n_e)
+                np.add(mean_weight, 1.0, out=temp)
+                np.add(temp, part(electron_density), out=temp)
+                np.multiply(mean_weight, 4.0, out=mean_weight)
+                np.add(mean_weight, 1.0, out=mean_weight)
+                np.divide(mean_weight, temp, out=mean_weight)
+            else:
+                mean_weight.fill(self.neutral_mean_weight)
+            
+            np.divide(part(internal_energy), part(mass), out=temp)
+            np.multiply(temp, mean_weight, out=temp)
+            np.multiply(temp, self.factor, out=temp)
+            np.maximum(temp, self.min_temp, out=temp)
+            np.copyto(out[block], temp, casting='same_kind')
+        
+        return out
+
+def convert_U_to_temperature(gadget_params, gas, hubble, out=None):
+    """Temperatures in Kelvin of the gas particles 'gas', written into 'out' if given"""
+    convert = temperature_converter(gadget_params, hubble)
+    return convert(gas.internal_energy, gas.mass, gas.metals, gas.electron_density, out)
+
+# Fields of the GADGET particles that end up in the tipsy file
+written_fields = ('positions', 'velocities', 'mass', 'potential', 'metals', 't_form', 'internal_energy', 'density',
+                  'hsml', 'electron_density')
+
+def slabs(particles, sorter=None):
+    """Yield the particles in slabs. A whole particle type is a single slab
+    
+    The fields read for each slab are released once it has been written. If
+    'sorter' is given, the slabs are those it yields in spatial order instead.
+    """
+    if isinstance(particles, gadget.particle_stream):
+        parts = iter(particles)
+    else:
+        parts = [particles]
+    if sorter is not None:
+        yield from sorter(parts)
+        return
+    for p in parts:
+        yield p
+        p.drop_cache()
+
+def load(slab):
+    """Read the written fields of 'slab' now. Returns the number of bytes they hold"""
+    return loaded_slab(slab).nbytes
+
+def bounding_cube(particles):
+    """Origin and side of a cube containing all of 'particles'"""
+    lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+    for p in (particles if isinstance(particles, gadget.particle_stream) else [particles]):
+        if p.size > 0:
+            lo = np.minimum(lo, p.positions.min(axis=0))
+            hi = np.maximum(hi, p.positions.max(axis=0))
+    if not np.all(hi >= lo):
+        return np.zeros(3), 1.0
+    
+    # Pad the cube slightly so the largest coordinates do not sit on its face
+    side = float(np.max(hi - lo)) * (1.0 + 1e-6)
+    return lo, side if side > 0.0 else 1.0
+
+def make_sorter(particles, header, args):
+    """A sfc.sorter for 'particles', or None if they are not to be sorted
+    
+    Keys cover the periodic box if there is one, and otherwise a cube
+    containing the particles.
+    """
+    if args.sort is None:
+        return None
+    
+    box_size = float(header['BoxSize'])
+    origin = np.zeros(3)
+    if box_size <= 0.0:
+        origin, box_size = bounding_cube(particles)
+    
+    kind = particles.kind if isinstance(particles, gadget.particle_stream) else type(particles)
+    fields = [f for f in kind.field_names() if f in written_fields]
+    return sfc.sorter(args.sort, origin, box_size, fields, tmpdir=args.sort_dir)
+
+class loaded_slab:
+    """The written fields of a slab, read into memory
+    
+    They are kept by this object, so they outlive the cache of the slab they
+    were read from and can be handed to another thread.
+    """
+    def __init__(self, slab):
+        self.size = slab.size
+        self.nbytes = 0
+        for name in written_fields:
+            value = getattr(slab, name, None)
+            setattr(self, name, value)
+            if np.ndim(value) > 0:
+                self.nbytes += value.nbytes
+
+class buffer_pool:
+    """Reusable float32 output buffers
+    
+    Buffers given back with release() are handed out again by get(), from any
+    thread. With 'reuse' False, get() always returns a new buffer.
+    """
+    def __init__(self, reuse=True):
+        self.reuse = reuse
+        self.free = queue.SimpleQueue()
     
-    # Convert temperature to Kelvin
-    print('Converting internal energy to temperature assuming a neutral hydrogen-only gamma=5/3 gas and non-traditional SPH')
+    def get(self, size):
+        if self.reuse:
+            try:
+                buffer = self.free.get_nowait()
+                if len(buffer) >= size:
+                    return buffer[:size]
+            except queue.Empty:
+                pass
+        return np.empty(size, dtype=np.float32)
     
-    # See GADGET3/density.c:1426  for details on these calculations
-    mean_weight = 4.0 / (1.0 + 3.0 * constants['h_massfrac'])
+    def release(self, buffer):
+        if self.reuse and buffer is not None:
+            self.free.put(buffer if buffer.base is None else buffer.base)
+
+def run_job_slab(name, itemsize, extra, write, file, slab, buffers, profile):
+    """Convert and write one slab of a job in the calling thread. For internal use only"""
+    out = None
+    if extra is not None:
+        with profile.stage('units', name, particles=slab.size):
+            out = extra(slab, buffers.get(slab.size))
+    with profile.stage('write', name, particles=slab.size, bytes_written=slab.size * itemsize):
+        write(file, slab, out)
+    buffers.release(out)
+
+def run_pipeline(jobs, file, species, buffers, profile, depth=2):
+    """Read, convert, and write the slabs of 'jobs' concurrently
+    
+    A reader thread reads each slab into memory and a converter thread computes
+    its extra fields, while the calling thread writes the slabs, in order, to
+    'file'. The stages are connected by queues of at most 'depth' slabs, so
+    reading and writing overlap with at most 2 * depth + 3 slabs in memory. The
+    C writers and HDF5 reads release the GIL, so the conversion time approaches
+    that of the slowest stage rather than the sum of them all.
+    """
+    loaded = queue.Queue(depth)
+    converted = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+    
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return done
+    
+    def reader():
+        try:
+            for index, (name, particles, _, _, _) in enumerate(jobs):
+                for slab in species(particles, name):
+                    if not put(loaded, (index, loaded_slab(slab))):
+                        return
+            put(loaded, done)
+        except BaseException as e:
+            put(loaded, e)
+    
+    def converter():
+        try:
+            while True:
+                item = get(loaded)
+                if item is done or isinstance(item, BaseException):
+                    put(converted, item)
+                    return
+                index, slab = item
+                name, _, _, extra, _ = jobs[index]
+                out = None
+                if extra is not None:
+                    with profile.stage('units', name, particles=slab.size):
+                        out = extra(slab, buffers.get(slab.size))
+                if not put(converted, (index, slab, out)):
+                    return
+        except BaseException as e:
+            put(converted, e)
+    
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=converter, daemon=True)]
+    for t in threads:
+        t.start()
+    
+    try:
+        while True:
+            item = converted.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            index, slab, out = item
+            name, _, itemsize, _, write = jobs[index]
+            with profile.stage('write', name, particles=slab.size, bytes_written=slab.size * itemsize):
+                write(file, slab, out)
+            buffers.release(out)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+def slab_layout(particles, rows):
+    """Where the written fields of a slab of at most 'rows' of 'particles' go in a shared-memory slot
+    
+    Returns the (name, dtype, row shape, offset) of each array field, the values
+    of the fields that are the same for every slab (None, or a MassTable mass),
+    and the size in bytes of the slot.
+    """
+    kind = particles.kind if isinstance(particles, gadget.particle_stream) else type(particles)
+    
+    # Reading no particles finds the type and shape of each field without reading any data
+    probe = kind(particles.data, particles.mass_table_entry, particles.header, 0, 0, cache=False)
+    layout, constants, offset = [], {}, 0
+    for name in written_fields:
+        value = probe.read(name) if name in kind.field_names() else None
+        if np.ndim(value) == 0:
+            constants[name] = value
+            continue
+        layout.append((name, value.dtype, value.shape[1:], offset))
+        # Keep each field cache-line aligned
+        offset += -(-rows * int(np.prod(value.shape[1:], dtype=np.int64)) * value.dtype.itemsize // 64) * 64
+    return layout, constants, offset
+
+# The snapshot and shared-memory slots of a reader process
+_reader = {}
+
+def _open_reader(fname, slot_names):
+    """Open the snapshot and attach the slots in a reader process. For internal use only"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        _reader['file'] = gadget.File(fname)
+    _reader['slots'] = [multiprocessing.shared_memory.SharedMemory(name) for name in slot_names]
+
+def _read_slab(slot, name, start, stop, layout):
+    """Read particles [start, stop) of 'name' into slot 'slot' in a reader process. For internal use only
+    
+    Returns the time taken.
+    """
+    begin = time.perf_counter()
+    particles = getattr(_reader['file'], name)
+    slab = type(particles)(particles.data, particles.mass_table_entry, particles.header, start, stop, cache=False)
+    buffer = _reader['slots'][slot].buf
+    for field, dtype, shape, offset in layout:
+        slab.read(field, np.ndarray((slab.size,) + shape, dtype, buffer=buffer, offset=offset))
+    return time.perf_counter() - begin
+
+class shared_slab:
+    """The written fields of a slab, as views of the shared-memory slot a reader process filled"""
+    def __init__(self, size, layout, constants, buffer):
+        self.size = size
+        self.nbytes = 0
+        for name, value in constants.items():
+            setattr(self, name, value)
+        for name, dtype, shape, offset in layout:
+            value = np.ndarray((size,) + shape, dtype, buffer=buffer, offset=offset)
+            setattr(self, name, value)
+            self.nbytes += value.nbytes
+
+def run_process_pipeline(jobs, gadget_file, file, buffers, profile, processes, depth=2):
+    """Read the slabs of 'jobs' in reader processes while the calling thread converts and writes them
     
-    if gadget_file.gas.metals is not None and gadget_file.gas.electron_density is not None:
-        X = gadget_file.gas.metals / gadget_file.gas.mass
-        mask = X > 0.0
-        Y = np.zeros(X.shape)
-        Y[mask] = (1.0 - X[mask]) / (4.0 * X[mask])
-        mean_weight = (1.0 + 4.0 * Y) / (1.0 + Y + gadget_file.gas.electron_density)
+    The readers decode each slab straight into one of a ring of shared-memory
+    slots, from which it is converted and handed to the C writer in place, so
+    no particle data is pickled or copied between processes. There are
+    'processes' + 'depth' slots: one being read by each reader and up to
+    'depth' read ahead of the writer. Slabs are written in order, and a slot is
+    reused once its slab is written, so 'file' must not hold on to its arrays
+    (i.e. be a tipsy.streaming_writer).
+    """
+    tasks = []
+    layouts = []
+    slot_size = 1
+    for index, (name, particles, _, _, _) in enumerate(jobs):
+        rows = particles.chunk_size if isinstance(particles, gadget.particle_stream) else particles.size
+        layout, constants, size = slab_layout(particles, max(min(rows, particles.size), 1))
+        layouts.append((layout, constants))
+        slot_size = max(slot_size, size)
+        tasks += [(index, start, min(start + rows, particles.size))
+                  for start in range(particles.start, particles.size, rows)]
     
-    gas_temp = constants['gamma_minus1'] / constants['boltzmann'] * gadget_file.gas.internal_energy / gadget_file.gas.mass
-    gas_temp *= constants['protonmass'] * mean_weight * units['Energy_in_cgs'] / units['Mass_in_g']
-    gas_temp[gas_temp < float(gadget_params['MinGasTemp'])] = float(gadget_params['MinGasTemp']) 
+    slots = []
+    try:
+        for _ in range(processes + depth):
+            slots.append(multiprocessing.shared_memory.SharedMemory(create=True, size=slot_size))
+        
+        # Readers must not inherit the HDF5 library state of this process
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(processes, context, initializer=_open_reader,
+                                                    initargs=(gadget_file.fnames[0], [s.name for s in slots])) as pool:
+            pending = collections.deque()
+            remaining = iter(tasks)
+            
+            def submit(slot):
+                task = next(remaining, None)
+                if task is not None:
+                    index, start, stop = task
+                    pending.append((slot, task, pool.submit(_read_slab, slot, jobs[index][0], start, stop,
+                                                            layouts[index][0])))
+            
+            try:
+                for slot in range(len(slots)):
+                    submit(slot)
+                
+                while pending:
+                    slot, (index, start, stop), future = pending.popleft()
+                    name, _, itemsize, extra, write = jobs[index]
+                    seconds = future.result()
+                    
+                    slab = shared_slab(stop - start, *layouts[index], slots[slot].buf)
+                    profile.add('read', name, seconds, slab.size, slab.nbytes)
+                    run_job_slab(name, itemsize, extra, write, file, slab, buffers, profile)
+                    
+                    # The views must be gone before the slot can be closed
+                    del slab
+                    submit(slot)
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
+    finally:
+        for s in slots:
+            s.close()
+            s.unlink()
 
-    return gas_temp
+def count_particles(gadget_file, is_cosmological, convert_bh):
+    """Number of gas, dark matter, and star particles in the converted file"""
+    def size(particles):
+        return 0 if particles is None else particles.size
+    
+    ngas = size(gadget_file.gas)
+    ndark = size(gadget_file.halo)
+    nstar = size(gadget_file.stars)
+    
+    # In ChaNGa, cosmological simulations treat disk and bulge particles
+    # as dark matter particles
+    if is_cosmological:
+        ndark += size(gadget_file.disk) + size(gadget_file.bulge)
+    else:
+        nstar += size(gadget_file.disk) + size(gadget_file.bulge)
+    
+    if convert_bh:
+        nstar += size(gadget_file.boundary)
+    else:
+        ndark += size(gadget_file.boundary)
+    
+    return ngas, ndark, nstar
 
 #-----------------------------------------------------------------------------
 
-parser = argparse.ArgumentParser(description='Convert GADGET2 files to ChaNGa files')
-parser.add_argument('gadget_file', metavar='GADGET', help='GADGET2 HDF5 file to convert')
-parser.add_argument('param_file', metavar='Parameter', help='GADGET2 parameter file to convert')
-parser.add_argument('out_dir', metavar='out_dir', help='Location of output')
-parser.add_argument('--convert-bh', action='store_true', help='Treat boundary particles as black holes')
-parser.add_argument('--preserve-boundary-softening', action='store_true', help='Preserve softening lengths for boundary particles')
-parser.add_argument('--no-param-list', action='store_true', help='Do not store a complete list ChaNGa parameters in "param_file"')
-parser.add_argument('--generations', type=int, help='Number of generations of stars each gas particle can spawn (see GENERATIONS in Gadget)')
-parser.add_argument('--viscosity', action='store_true', help='Use artificial bulk viscosity')
-args = parser.parse_args()
-
-try:
-    gadget_params = gadget.Parameter_file(args.param_file)
-except Exception as e:
-    print('\nERROR: {0:s}\n\n'.format(str(e)))
-    parser.print_help()
-    exit()
+def add_conversion_arguments(parser):
+    """Add the options controlling the conversion of a snapshot to 'parser'"""
+    parser.add_argument('--convert-bh', action='store_true', help='Treat boundary particles as black holes')
+    parser.add_argument('--preserve-boundary-softening', action='store_true', help='Preserve softening lengths for boundary particles')
+    parser.add_argument('--no-param-list', action='store_true', help='Do not store a complete list ChaNGa parameters in "param_file"')
+    parser.add_argument('--generations', type=int, help='Number of generations of stars each gas particle can spawn (see GENERATIONS in Gadget)')
+    parser.add_argument('--viscosity', action='store_true', help='Use artificial bulk viscosity')
+    parser.add_argument('--chunk-size', type=int, metavar='N', help='Convert at most N particles of each type at a time')
+    parser.add_argument('--workers', type=int, metavar='N', help='Write the tipsy file in parallel using N threads')
+    parser.add_argument('--standard', action='store_true', help='Write a big-endian "standard" tipsy file')
+    parser.add_argument('--sort', choices=sfc.curves, help='Order each particle type along a space-filling curve')
+    parser.add_argument('--sort-dir', metavar='DIR', help='Directory for temporary files when sorting with --chunk-size')
+    parser.add_argument('--pipeline', action='store_true', help='Read, convert, and write slabs concurrently in separate threads')
+    parser.add_argument('--queue-depth', type=int, default=2, metavar='N', help='Slabs queued between pipeline stages (default: %(default)s)')
+    parser.add_argument('--pipeline-processes', type=int, metavar='N', help='Read slabs ahead in N processes, into shared memory, while converting and writing')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted conversion from the last slab recorded in its journal')
+    parser.add_argument('--journal-interval', type=float, default=60.0, metavar='SECONDS', help='Record the progress of the conversion at most every SECONDS seconds, and after each particle type (default: %(default)s)')
+
+# Conversion options that change the files written, rather than how they are written
+output_options = ('convert_bh', 'preserve_boundary_softening', 'no_param_list', 'generations', 'viscosity', 'standard',
+                  'sort')
+
+def parameters_checksum(gadget_params):
+    """CRC-32 of the values in a GADGET parameter file, ignoring its layout and comments"""
+    return zlib.crc32(json.dumps(sorted(gadget_params.items())).encode())
+
+def conversion_identity(gadget_file, gadget_params, jobs, time, args):
+    """What a journal records about a conversion to tell whether it is resuming the same one"""
+    return {
+        'snapshot': [[os.path.abspath(f), os.path.getsize(f), os.stat(f).st_mtime_ns] for f in gadget_file.fnames],
+        'parameters_crc32': parameters_checksum(gadget_params),
+        'time': time,
+        'jobs': [[name, int(particles.size)] for name, particles, _, _, _ in jobs],
+        # Resuming relies on the slabs being the same
+        'options': {name: getattr(args, name) for name in output_options + ('chunk_size',)}
+    }
 
-gadget_file = gadget.File(args.gadget_file)
-changa_params, mass_scale = ChaNGa.convert_parameter_file(gadget_params, args, gadget_file.gas is not None)
-basename = args.out_dir + '/' + ChaNGa.get_input_file(args.gadget_file) + '.tipsy'
+def input_file_name(gadget_file_name, out_dir):
+    """Name of the tipsy file converted from 'gadget_file_name'"""
+    return out_dir + '/' + ChaNGa.get_input_file(gadget_file_name) + '.tipsy'
 
-# Output the parameter file
-with open(basename + '.ChaNGa.params', 'w') as f:
-    for k in sorted(changa_params):
-         f.write('{0:20s} = {1:s}\n'.format(k, str(changa_params[k])))
+def write_parameter_file(basename, changa_params, no_param_list):
+    with open(basename + '.ChaNGa.params', 'w') as f:
+        for k in sorted(changa_params):
+             f.write('{0:20s} = {1:s}\n'.format(k, str(changa_params[k])))
 
-    if not args.no_param_list:
-        f.write('\n# Complete parameter list below\n')
-        f.write(ChaNGa.all_parameters)
+        if not no_param_list:
+            f.write('\n# Complete parameter list below\n')
+            f.write(ChaNGa.all_parameters)
 
-##################################################################################
-time = float(gadget_file.header['Time'])
-is_cosmological = int(gadget_params['ComovingIntegrationOn']) == 1
+def conversion_jobs(gadget_file, gadget_params, mass_scale, args):
+    """The jobs converting the particle types of an open gadget.File, in the order they are written
+    
+    Each job converts one GADGET particle type: (name, particles, tipsy record
+    size, conversion of a slab into its extra tipsy field (or None), and its
+    write of a slab and that field to a tipsy writer).
+    """
+    is_cosmological = int(gadget_params['ComovingIntegrationOn']) == 1
 
-# Gadget units have an extra sqrt(a) in the internal velocities
-velocity_scale = math.sqrt(1.0 + float(gadget_file.header['Redshift']))
+    # Gadget units have an extra sqrt(a) in the internal velocities
+    velocity_scale = math.sqrt(1.0 + float(gadget_file.header['Redshift']))
 
-hubble = 1.0
-if is_cosmological:
-    hubble = float(gadget_params['HubbleParam'])
-    if hubble == 0.0:
-        hubble = 1.0
+    hubble = 1.0
+    if is_cosmological:
+        hubble = float(gadget_params['HubbleParam'])
+        if hubble == 0.0:
+            hubble = 1.0
 
-with tipsy.streaming_writer(basename) as file:
-    ngas = ndark = nstar = 0
+    # Applied by the writer as each particle is packed
+    scales = {'mass_scale': mass_scale, 'velocity_scale': velocity_scale}
     
-    # just a placeholder
-    file.header(time, ngas, ndark, nstar)
+    jobs = []
+    gas_size, dark_size, star_size = (d.itemsize for d in (tipsy.tipsy_gas_dtype, tipsy.tipsy_dark_dtype,
+                                                           tipsy.tipsy_star_dtype))
+    
+    def darkmatter(eps):
+        def write(file, p, _):
+            file.darkmatter(p.mass, p.positions, p.velocities, p.potential, eps, p.size, **scales)
+        return write
+    
+    def stars(eps, metals=True, is_blackhole=False):
+        def write(file, p, _):
+            file.stars(p.mass, p.positions, p.velocities, p.metals if metals else None, p.t_form if metals else None,
+                       p.potential, eps, p.size, is_blackhole=is_blackhole, **scales)
+        return write
     
     if gadget_file.gas is not None:
-        gas = gadget_file.gas
-        ngas += gas.size
-        gas_temp = convert_U_to_temperature(gadget_params, gadget_file, hubble)
-        gas.mass *= mass_scale
-        gas.velocities *= velocity_scale
-        file.gas(gas.mass, gas.positions, gas.velocities, gas.density, gas_temp, gas.hsml, gas.metals, gas.potential, gas.size)
+        # Convert temperature to Kelvin
+        print('Converting internal energy to temperature assuming a neutral hydrogen-only gamma=5/3 gas and non-traditional SPH')
+        temperature = temperature_converter(gadget_params, hubble)
+        
+        def gas_temperature(gas, out):
+            return temperature(gas.internal_energy, gas.mass, gas.metals, gas.electron_density, out)
+        
+        def write_gas(file, gas, gas_temp):
+            file.gas(gas.mass, gas.positions, gas.velocities, gas.density, gas_temp, gas.hsml, gas.metals, gas.potential, gas.size, **scales)
+        jobs.append(('gas', gadget_file.gas, gas_size, gas_temperature, write_gas))
     
     if gadget_file.halo is not None:
-        halo = gadget_file.halo
-        ndark += halo.size
-        halo.mass *= mass_scale
-        halo.velocities *= velocity_scale
-        file.darkmatter(halo.mass, halo.positions, halo.velocities, halo.potential, gadget_params['SofteningHalo'], halo.size)
-        
+        jobs.append(('halo', gadget_file.halo, dark_size, None, darkmatter(gadget_params['SofteningHalo'])))
+    
     # In ChaNGa, cosmological simulations treat disk and bulge particles
     # as dark matter particles
     if is_cosmological:
         if gadget_file.disk is not None:
-            disk = gadget_file.disk
-            ndark += disk.size
-            disk.mass *= mass_scale
-            disk.velocities *= velocity_scale
-            file.darkmatter(disk.mass, disk.positions, disk.velocities, disk.potential, gadget_params['SofteningDisk'], disk.size)
-        
+            jobs.append(('disk', gadget_file.disk, dark_size, None, darkmatter(gadget_params['SofteningDisk'])))
         if gadget_file.bulge is not None:
-            bulge = gadget_file.bulge
-            ndark += bulge.size
-            bulge.mass *= mass_scale
-            bulge.velocities *= velocity_scale
-            file.darkmatter(bulge.mass, bulge.positions, bulge.velocities, bulge.potential, gadget_params['SofteningBulge'], bulge.size)
+            jobs.append(('bulge', gadget_file.bulge, dark_size, None, darkmatter(gadget_params['SofteningBulge'])))
     
     # Convert boundary particles to dark matter particles
-    if gadget_file.boundary is not None and not convert_bh:
-        boundary = gadget_file.boundary
-        ndark += boundary.size
-        boundary.mass *= mass_scale
-        boundary.velocities *= velocity_scale
+    if gadget_file.boundary is not None and not args.convert_bh:
         eps = gadget_params['SofteningBndry'] if args.preserve_boundary_softening else gadget_params['SofteningHalo']
-        file.darkmatter(boundary.mass, boundary.positions, boundary.velocities, boundary.potential, eps, boundary.size)
-        
+        jobs.append(('boundary', gadget_file.boundary, dark_size, None, darkmatter(eps)))
+    
     if not is_cosmological:
         if gadget_file.disk is not None:
-            disk = gadget_file.disk
-            nstar += disk.size
-            disk.mass *= mass_scale
-            disk.velocities *= velocity_scale
-            file.stars(disk.mass, disk.positions, disk.velocities, None, None, disk.potential,
-                      gadget_params['SofteningDisk'], disk.size)
-        
+            jobs.append(('disk', gadget_file.disk, star_size, None, stars(gadget_params['SofteningDisk'], metals=False)))
         if gadget_file.bulge is not None:
-            bulge = gadget_file.bulge
-            nstar += bulge.size
-            bulge.mass *= mass_scale
-            bulge.velocities *= velocity_scale
-            file.stars(bulge.mass, bulge.positions, bulge.velocities, bulge.metals, bulge.t_form, bulge.potential,
-                      gadget_params['SofteningBulge'], bulge.size)
-
+            jobs.append(('bulge', gadget_file.bulge, star_size, None, stars(gadget_params['SofteningBulge'])))
+    
     if gadget_file.stars is not None:
-        star = gadget_file.stars
-        nstar += star.size
-        star.mass *= mass_scale
-        star.velocities *= velocity_scale
-        file.stars(star.mass, star.positions, star.velocities, star.metals, star.t_form, star.potential,
-                   gadget_params['SofteningStars'], star.size)
+        jobs.append(('stars', gadget_file.stars, star_size, None, stars(gadget_params['SofteningStars'])))
     
     # Convert boundary particles to black holes
-    if gadget_file.boundary is not None and convert_bh:
-        boundary = gadget_file.boundary
-        nstar += boundary.size
-        boundary.mass *= mass_scale
-        boundary.velocities *= velocity_scale
-        file.stars(boundary.mass, boundary.positions, boundary.velocities, None, None, boundary.potential,
-                   gadget_params['SofteningBndry'], boundary.size, is_blackhole=True)
-
-# update the header
-with tipsy.streaming_writer(basename, 'r+b') as file:
-    file.header(time, ngas, ndark, nstar)
+    if gadget_file.boundary is not None and args.convert_bh:
+        jobs.append(('boundary', gadget_file.boundary, star_size, None,
+                     stars(gadget_params['SofteningBndry'], metals=False, is_blackhole=True)))
+    
+    return jobs
+
+def convert(gadget_file, gadget_params, changa_params, mass_scale, basename, args, profile=None):
+    """Write the ChaNGa parameter and tipsy files for an open gadget.File
+    
+    'changa_params' and 'mass_scale' are the results of ChaNGa.convert_parameter_file.
+    If 'profile' is given, the time spent reading, converting, and writing each
+    particle type is recorded in it (see profiling.profiler).
+    """
+    if profile is None:
+        profile = profiling.profiler(enabled=False)
+    
+    if args.pipeline_processes is not None:
+        if args.pipeline_processes < 1:
+            raise ValueError('--pipeline-processes must be positive')
+        if args.workers is not None or args.sort is not None:
+            raise ValueError('--pipeline-processes cannot be combined with --workers or --sort')
+    
+    # Output the parameter file
+    with profile.stage('parameters'):
+        write_parameter_file(basename, changa_params, args.no_param_list)
+
+    ##################################################################################
+    time = float(gadget_file.header['Time'])
+    is_cosmological = int(gadget_params['ComovingIntegrationOn']) == 1
+
+    ngas, ndark, nstar = count_particles(gadget_file, is_cosmological, args.convert_bh)
+    
+    def species(particles, name):
+        sorter = None
+        if args.sort is not None:
+            # Finding the bounding cube reads the positions
+            with profile.stage('sort', name):
+                sorter = make_sorter(particles, gadget_file.header, args)
+        
+        # Sorted slabs are read and sorted as they are produced
+        for slab in profile.iterate('read' if sorter is None else 'sort', name, slabs(particles, sorter)):
+            if profile.enabled:
+                with profile.stage('read', name, particles=slab.size) as counts:
+                    counts['bytes_read'] = load(slab)
+            yield slab
+    
+    jobs = conversion_jobs(gadget_file, gadget_params, mass_scale, args)
+    gas_size, dark_size, star_size = (d.itemsize for d in (tipsy.tipsy_gas_dtype, tipsy.tipsy_dark_dtype,
+                                                           tipsy.tipsy_star_dtype))
+    
+    # Record which particles are on disk as the conversion goes, so it can be resumed
+    progress = journal.journal(basename + '.journal', basename,
+                               conversion_identity(gadget_file, gadget_params, jobs, time, args), len(jobs),
+                               args.journal_interval)
+    itemsizes = [itemsize for _, _, itemsize, _, _ in jobs]
+    start = None
+    if not args.resume:
+        progress.remove()
+    else:
+        with tipsy.File(basename, memmap=True) as f:
+            h = f.header
+            if (h.time, h.ngas, h.ndark, h.nstar) != (time, ngas, ndark, nstar) or f.standard != args.standard or \
+               os.path.getsize(basename) != tipsy.file_size(ngas, ndark, nstar):
+                raise ValueError('{0:s} does not have the header and size of this conversion'.format(basename))
+        
+        start = [0, 0, 0]
+        for itemsize, count in zip(itemsizes, progress.resume()):
+            # Record sizes differ, so they tell which section of the file a job writes to
+            start[(gas_size, dark_size, star_size).index(itemsize)] += count
+        print('Resuming {0:s} after {1:d} gas, {2:d} dark matter, and {3:d} star particles'.format(basename, *start))
+    
+    def end_of_committed():
+        return tipsy.file_size(0, 0, 0) + sum(count * itemsize for count, itemsize in zip(progress.committed, itemsizes))
+    
+    def journaled(index, size, write):
+        # Sorted slabs are only known once their whole particle type has been sorted,
+        # so such types are only committed once they are complete
+        def write_and_commit(file, slab, out):
+            write(file, slab, out)
+            progress.committed[index] += slab.size
+            if progress.committed[index] == size or (args.sort is None and progress.commit_due()):
+                progress.commit(file, end_of_committed())
+        return write_and_commit
+    
+    resumed = []
+    for index, (name, particles, itemsize, extra, write) in enumerate(jobs):
+        count = progress.committed[index]
+        if count == particles.size:
+            continue
+        if count > 0:
+            particles = gadget.particle_stream(particles.kind, particles.data, particles.mass_table_entry,
+                                               particles.header, particles.chunk_size, particles.cache, count)
+        resumed.append((name, particles, itemsize, extra, journaled(index, particles.size, write)))
+    jobs = resumed
+    
+    if args.workers is None:
+        writer = tipsy.streaming_writer(basename, 'wb' if start is None else 'r+b', standard=args.standard,
+                                        header=(time, ngas, ndark, nstar), start=start)
+    else:
+        writer = tipsy.parallel_writer(basename, time, ngas, ndark, nstar, workers=args.workers,
+                                       standard=args.standard, start=start)
+    
+    # The parallel writer holds on to each slab until it is closed, so
+    # output buffers can only be reused when streaming
+    buffers = buffer_pool(reuse=args.workers is None)
+    
+    with writer as file:
+        if args.pipeline_processes is not None:
+            run_process_pipeline(jobs, gadget_file, file, buffers, profile, args.pipeline_processes, args.queue_depth)
+        elif args.pipeline:
+            run_pipeline(jobs, file, species, buffers, profile, args.queue_depth)
+        else:
+            for name, particles, itemsize, extra, write in jobs:
+                for slab in species(particles, name):
+                    run_job_slab(name, itemsize, extra, write, file, slab, buffers, profile)
+        
+        # Writes still pending in the parallel writer are waited for here
+        with profile.stage('write'):
+            file.close()
+    
+    progress.remove()
+    profile.add_io('tipsy', writer.io_stats())
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert GADGET2 files to ChaNGa files')
+    parser.add_argument('gadget_file', metavar='GADGET', help='GADGET2 HDF5 file to convert')
+    parser.add_argument('param_file', metavar='Parameter', help='GADGET2 parameter file to convert')
+    parser.add_argument('out_dir', metavar='out_dir', help='Location of output')
+    add_conversion_arguments(parser)
+    parser.add_argument('--read-workers', type=int, metavar='N', help='Read the GADGET file in parallel using N processes (with --verify, compare using N processes)')
+    parser.add_argument('--verify', action='store_true', help='Instead of converting, check the tipsy file in out_dir against GADGET, converted with the same options')
+    parser.add_argument('--rtol', type=float, default=1e-6, metavar='X', help='Relative error allowed by --verify (default: %(default)s)')
+    parser.add_argument('--atol', type=float, default=0.0, metavar='X', help='Absolute error allowed by --verify (default: %(default)s)')
+    parser.add_argument('--profile', action='store_true', help='Report the time and throughput of each stage of the conversion')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write the times and throughputs of the conversion to FILE as JSON')
+    args = parser.parse_args()
+
+    try:
+        gadget_params = gadget.Parameter_file(args.param_file)
+    except Exception as e:
+        print('\nERROR: {0:s}\n\n'.format(str(e)))
+        parser.print_help()
+        exit()
+
+    profile = profiling.profiler(enabled=args.profile or args.stats_json is not None)
+    with profile.stage('open'):
+        # --verify reads the snapshot in its own pool of --read-workers processes
+        gadget_file = gadget.File(args.gadget_file, args.chunk_size, None if args.verify else args.read_workers)
+    with gadget_file:
+        with profile.stage('parameters'):
+            changa_params, mass_scale = ChaNGa.convert_parameter_file(gadget_params, args, gadget_file.gas is not None)
+        basename = input_file_name(args.gadget_file, args.out_dir)
+        
+        if args.verify:
+            # verify builds on this module, so it is only imported when needed
+            import verify
+            if args.sort is not None:
+                raise ValueError('--verify cannot check files reordered by --sort')
+            result = verify.verify(gadget_file, gadget_params, mass_scale, basename, args, args.read_workers,
+                                   args.chunk_size or 1 << 20, args.rtol, args.atol)
+        else:
+            convert(gadget_file, gadget_params, changa_params, mass_scale, basename, args, profile)
+            with profile.stage('close'):
+                gadget_file.close()
+    
+    if args.verify:
+        verify.report(result)
+        exit(0 if result['ok'] else 1)
+    
+    if args.profile:
+        profile.report()
+    if args.stats_json is not None:
+        profile.write_json(args.stats_json)
+
+if __name__ == '__main__':
+    main()
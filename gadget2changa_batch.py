@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import sys
+
+if sys.version_info.major < 3:
+    print('python3 required!')
+    exit()
+
+import gadget
+import gadget2changa
+import ChaNGa
+import argparse
+import concurrent.futures
+import copy
+import datetime
+import glob
+import h5py
+import hashlib
+import json
+import multiprocessing
+import numpy as np
+import os
+import time
+import traceback
+
+def expand_files(patterns):
+    """Expand the glob patterns in 'patterns', keeping names that match nothing as-is"""
+    files = []
+    for p in patterns:
+        matches = sorted(glob.glob(p))
+        files.extend(matches if matches else [p])
+    return files
+
+def has_gas(pieces):
+    """Does the snapshot made up of the files 'pieces' have gas particles?"""
+    for piece in pieces:
+        with h5py.File(piece, 'r') as file:
+            if file.__contains__('PartType0'):
+                return True
+    return False
+
+def header_hash(fname):
+    """A hash of the Header attributes of the HDF5 file 'fname'"""
+    h = hashlib.blake2b(digest_size=16)
+    with h5py.File(fname, 'r') as file:
+        for name, value in sorted(file['Header'].attrs.items()):
+            h.update(name.encode())
+            h.update(np.asarray(value).tobytes())
+    return h.hexdigest()
+
+def file_state(fname):
+    """The size and modification time of 'fname', or None if it does not exist"""
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def output_files(fname, out_dir):
+    """The files written by converting the snapshot 'fname' into 'out_dir'"""
+    basename = gadget2changa.input_file_name(fname, out_dir)
+    return [basename, basename + '.ChaNGa.params']
+
+class manifest:
+    """What was converted by earlier runs into an output directory, stored as JSON in 'fname'
+    
+    Each snapshot is recorded under the name of its first file with a key
+    describing its inputs: the size, modification time, and Header hash of
+    each of its files, the GADGET parameters, and the conversion options. The
+    size and modification time of each of its outputs are recorded alongside,
+    so a snapshot is up to date if its key is unchanged and its outputs are as
+    they were written. Checking this needs a few stat calls and one read of
+    each file's header, rather than a conversion.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.entries = {}
+        try:
+            with open(fname, 'r') as f:
+                self.entries = json.load(f).get('snapshots', {})
+        except FileNotFoundError:
+            pass
+    
+    @staticmethod
+    def key(pieces, gadget_params, args):
+        """The key of the snapshot made up of the files 'pieces'"""
+        return {
+            'files': [[os.path.abspath(p)] + file_state(p) + [header_hash(p)] for p in pieces],
+            'parameters_crc32': gadget2changa.parameters_checksum(gadget_params),
+            'options': {name: getattr(args, name) for name in gadget2changa.output_options}
+        }
+    
+    def up_to_date(self, name, key, outputs):
+        """Were the files 'outputs' converted from the snapshot 'name' with this key, and are unchanged since?"""
+        entry = self.entries.get(name)
+        if entry is None or entry['key'] != json.loads(json.dumps(key)):
+            return False
+        # A journal is only left by an incomplete conversion
+        if os.path.exists(outputs[0] + '.journal'):
+            return False
+        return entry['outputs'] == [[o] + (file_state(o) or []) for o in outputs]
+    
+    def record(self, name, key, outputs):
+        """Record that 'outputs' have just been converted from the snapshot 'name'"""
+        self.entries[name] = {
+            'key': key,
+            'outputs': [[o] + file_state(o) for o in outputs],
+            'date': datetime.datetime.now().isoformat(timespec='seconds')
+        }
+    
+    def forget(self, name):
+        self.entries.pop(name, None)
+    
+    def save(self):
+        """Write the manifest, atomically replacing the previous one"""
+        partial = self.fname + '.partial'
+        with open(partial, 'w') as f:
+            json.dump({'snapshots': self.entries}, f, indent=2, sort_keys=True)
+        os.replace(partial, self.fname)
+
+def convert_one(fname, gadget_params, changa_params, mass_scale, args):
+    """Convert a single snapshot. Returns the elapsed time"""
+    start = time.time()
+    basename = gadget2changa.input_file_name(fname, args.out_dir)
+
+    changa_params = dict(changa_params)
+    changa_params['achInFile'] = basename
+
+    # Snapshots the interrupted batch had not started, or had already finished, have no journal
+    if args.resume and not os.path.exists(basename + '.journal'):
+        args = copy.copy(args)
+        args.resume = False
+
+    with gadget.File(fname, args.chunk_size) as gadget_file:
+        gadget2changa.convert(gadget_file, gadget_params, changa_params, mass_scale, basename, args)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a series of GADGET2 files to ChaNGa files')
+    parser.add_argument('param_file', metavar='Parameter', help='GADGET2 parameter file to convert')
+    parser.add_argument('out_dir', metavar='out_dir', help='Location of output')
+    parser.add_argument('gadget_files', metavar='GADGET', nargs='+', help='GADGET2 HDF5 files or glob patterns to convert')
+    gadget2changa.add_conversion_arguments(parser)
+    parser.add_argument('--processes', type=int, metavar='N', help='Convert up to N files at once (default: number of CPUs)')
+    parser.add_argument('--manifest', metavar='FILE', help='Record what has been converted in FILE (default: out_dir/gadget2changa.manifest.json)')
+    parser.add_argument('--force', action='store_true', help='Convert every snapshot, even those that are up to date')
+    args = parser.parse_args()
+
+    try:
+        gadget_params = gadget.Parameter_file(args.param_file)
+    except Exception as e:
+        print('\nERROR: {0:s}\n\n'.format(str(e)))
+        parser.print_help()
+        exit()
+
+    files = expand_files(args.gadget_files)
+    
+    # Snapshots whose inputs and outputs are unchanged since they were last converted are skipped
+    history = manifest(args.manifest if args.manifest is not None else
+                       os.path.join(args.out_dir, 'gadget2changa.manifest.json'))
+    names, keys = {}, {}
+    skipped = 0
+
+    # The parameters only depend on the snapshot through whether it has gas,
+    # so convert them at most once for each case
+    converted = {}
+    jobs = []
+    failed = []
+    seen = set()
+    for fname in files:
+        try:
+            # Pieces of a multi-file snapshot are converted once, together
+            pieces = gadget.snapshot_files(fname)
+            if pieces[0] in seen:
+                continue
+            seen.add(pieces[0])
+            
+            names[fname] = os.path.abspath(pieces[0])
+            keys[fname] = manifest.key(pieces, gadget_params, args)
+            if not args.force and history.up_to_date(names[fname], keys[fname], output_files(fname, args.out_dir)):
+                skipped += 1
+                continue
+            
+            do_gas = has_gas(pieces)
+            if do_gas not in converted:
+                file_args = copy.copy(args)
+                file_args.gadget_file = fname
+                converted[do_gas] = ChaNGa.convert_parameter_file(gadget_params, file_args, do_gas)
+            jobs.append((fname, converted[do_gas]))
+        except Exception as e:
+            print('FAILED {0:s}: {1:s}'.format(fname, str(e)))
+            failed.append(fname)
+
+    # Workers must not inherit the HDF5 library state of this process
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(args.processes, context) as pool:
+        futures = {}
+        for fname, (changa_params, mass_scale) in jobs:
+            f = pool.submit(convert_one, fname, gadget_params, changa_params, mass_scale, args)
+            futures[f] = fname
+
+        for i, f in enumerate(concurrent.futures.as_completed(futures), 1):
+            fname = futures[f]
+            try:
+                elapsed = f.result()
+                print('[{0:d}/{1:d}] {2:s}: done in {3:.1f}s'.format(i, len(jobs), fname, elapsed))
+                history.record(names[fname], keys[fname], output_files(fname, args.out_dir))
+            except Exception:
+                print('[{0:d}/{1:d}] {2:s}: FAILED'.format(i, len(jobs), fname))
+                traceback.print_exc()
+                failed.append(fname)
+                history.forget(names[fname])
+            # Saved as each snapshot finishes, so an interrupted batch keeps what it did
+            history.save()
+
+    if skipped:
+        print('{0:d} snapshots already up to date'.format(skipped))
+
+    if failed:
+        print('\n{0:d} snapshots failed:'.format(len(failed)))
+        for fname in failed:
+            print('    ' + fname)
+        exit(1)
+
+if __name__ == '__main__':
+    main()
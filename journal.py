@@ -0,0 +1,97 @@
+"""
+    A journal of the progress of a conversion, kept next to its output
+
+    The journal records how many particles of each job (e.g. each particle
+    type) of a conversion are on disk, and describes the conversion so that
+    resuming it can check it is continuing the same one. The end of the part
+    of the output it covers is checksummed, so an output that was changed or
+    truncated since is detected too.
+
+    Each commit first syncs the output and then atomically replaces the
+    journal, so the journal never claims more than what survived a crash.
+"""
+
+import datetime
+import json
+import os
+import time
+import zlib
+
+# Bytes before the end of the committed part of the output that are checksummed
+tail_size = 1 << 20
+
+def tail_checksum(fname, end, size=tail_size):
+    """CRC-32 of the (at most) 'size' bytes of the file 'fname' before byte 'end'"""
+    start = max(end - size, 0)
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if len(data) != end - start:
+        raise ValueError('{0:s} is shorter than its journal records'.format(fname))
+    return zlib.crc32(data)
+
+class journal:
+    """The progress of the conversion writing 'output', recorded in the file 'fname'
+
+    'identity' is a dict, as stored in JSON, describing the conversion. The
+    number of particles of each of 'jobs' jobs that are on disk are kept in
+    'committed' and are written out by commit(). With commit_due(), commits
+    can be limited to one every 'interval' seconds.
+    """
+    def __init__(self, fname, output, identity, jobs, interval=60.0):
+        self.fname = fname
+        self.output = output
+        # Compared with the identity read back from the journal, so store it as JSON would
+        self.identity = json.loads(json.dumps(identity))
+        self.committed = [0] * jobs
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def resume(self):
+        """Read the progress recorded in the journal, checking it against the output. Returns 'committed'"""
+        try:
+            with open(self.fname, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            raise ValueError('no journal ({0:s}) to resume from'.format(self.fname)) from None
+
+        if state.get('identity') != self.identity:
+            raise ValueError('{0:s} was written by a different conversion (input or options)'.format(
+                             self.fname))
+        if len(state['committed']) != len(self.committed):
+            raise ValueError('{0:s} does not record every particle type'.format(self.fname))
+        if tail_checksum(self.output, state['end']) != state['crc32']:
+            raise ValueError('{0:s} does not match its journal {1:s}'.format(self.output, self.fname))
+
+        self.committed = state['committed']
+        self.last = time.monotonic()
+        return self.committed
+
+    def commit_due(self):
+        """Has 'interval' passed since the last commit?"""
+        return time.monotonic() - self.last >= self.interval
+
+    def commit(self, writer, end):
+        """Sync 'writer' and record 'committed', whose particles fill the first 'end' bytes of the output"""
+        writer.sync()
+        state = {
+            'identity': self.identity,
+            'committed': self.committed,
+            'end': end,
+            'crc32': tail_checksum(self.output, end),
+            'date': datetime.datetime.now().isoformat(timespec='seconds')
+        }
+
+        partial = self.fname + '.partial'
+        with open(partial, 'w') as f:
+            json.dump(state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.fname)
+        self.last = time.monotonic()
+
+    def remove(self):
+        """Remove the journal, e.g. once the conversion is complete"""
+        for fname in (self.fname, self.fname + '.partial'):
+            if os.path.exists(fname):
+                os.remove(fname)
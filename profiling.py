@@ -0,0 +1,133 @@
+"""
+    Wall time and throughput of the stages of a conversion
+
+    A profiler accumulates, for each stage (e.g. 'read', 'units', 'write') and
+    particle type, the wall time spent, the number of particles handled, the
+    bytes read and written, and the peak RSS of the process when the stage
+    last finished. The time and bytes of the C library's own fread/fwrite
+    calls can be added alongside (see tipsy_io_stats).
+"""
+
+import contextlib
+import json
+import resource
+import sys
+import time
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (Linux reports kB)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class profiler:
+    """Record the time spent in each stage of a conversion
+
+    A disabled profiler records nothing, so instrumented code can always be
+    given one.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = {}
+        self.io = {}
+        self.start = time.perf_counter()
+
+    def add(self, stage, species=None, seconds=0.0, particles=0, bytes_read=0, bytes_written=0):
+        """Add to the totals of 'stage' for 'species'"""
+        if not self.enabled:
+            return
+
+        key = (stage, species)
+        if key not in self.records:
+            self.records[key] = {'stage': stage, 'species': species, 'calls': 0, 'seconds': 0.0, 'particles': 0,
+                                 'bytes_read': 0, 'bytes_written': 0}
+        r = self.records[key]
+        r['calls'] += 1
+        r['seconds'] += seconds
+        r['particles'] += particles
+        r['bytes_read'] += bytes_read
+        r['bytes_written'] += bytes_written
+        r['peak_rss_bytes'] = peak_rss()
+
+    @contextlib.contextmanager
+    def stage(self, stage, species=None, particles=0, bytes_read=0, bytes_written=0):
+        """Time the body of the with statement as part of 'stage'
+
+        The counts yielded can be added to within the body, e.g. once the
+        number of bytes read is known.
+        """
+        counts = {'particles': particles, 'bytes_read': bytes_read, 'bytes_written': bytes_written}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(stage, species, time.perf_counter() - start, **counts)
+
+    def iterate(self, stage, species, iterable):
+        """Yield the items of 'iterable', timing the production of each as part of 'stage'"""
+        items = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            item = next(items, None)
+            self.add(stage, species, time.perf_counter() - start)
+            if item is None:
+                return
+            yield item
+
+    def add_io(self, name, stats):
+        """Record the tipsy_io_stats (as a dict) of the file 'name'"""
+        if self.enabled and stats is not None:
+            self.io[name] = dict(stats)
+
+    def summary(self):
+        """Everything recorded, with rates, as a dict suitable for JSON"""
+        stages = []
+        for r in self.records.values():
+            r = dict(r)
+            seconds = r['seconds'] if r['seconds'] > 0.0 else float('nan')
+            r['particles_per_second'] = r['particles'] / seconds if r['particles'] else None
+            r['mb_per_second'] = (r['bytes_read'] + r['bytes_written']) / seconds / 1e6 \
+                                 if r['bytes_read'] or r['bytes_written'] else None
+            stages.append(r)
+
+        totals = {}
+        for r in stages:
+            t = totals.setdefault(r['stage'], {'seconds': 0.0, 'particles': 0, 'bytes_read': 0, 'bytes_written': 0})
+            for k in t:
+                t[k] += r[k]
+
+        return {'wall_seconds': time.perf_counter() - self.start, 'peak_rss_bytes': peak_rss(), 'stages': stages,
+                'totals': totals, 'io': self.io}
+
+    def report(self, out=sys.stdout):
+        """Print the summary as tables"""
+        s = self.summary()
+        
+        def rate(value, scale):
+            return '-' if value is None else '{0:.2f}'.format(value / scale)
+
+        out.write('\n{0:12s} {1:10s} {2:>10s} {3:>12s} {4:>10s} {5:>10s} {6:>11s} {7:>10s} {8:>9s}\n'.format(
+                  'Stage', 'Type', 'Time (s)', 'Particles', 'Mpart/s', 'MB read', 'MB written', 'MB/s',
+                  'RSS (MB)'))
+        for r in s['stages']:
+            out.write('{0:12s} {1:10s} {2:10.3f} {3:12d} {4:>10s} {5:10.1f} {6:11.1f} {7:>10s} {8:9.1f}\n'.format(
+                      r['stage'], r['species'] or '-', r['seconds'], r['particles'],
+                      rate(r['particles_per_second'], 1e6), r['bytes_read'] / 1e6, r['bytes_written'] / 1e6,
+                      rate(r['mb_per_second'], 1.0), r['peak_rss_bytes'] / 1e6))
+
+        out.write('\n{0:12s} {1:>10s}\n'.format('Stage', 'Time (s)'))
+        for stage, t in s['totals'].items():
+            out.write('{0:12s} {1:10.3f}\n'.format(stage, t['seconds']))
+        out.write('{0:12s} {1:10.3f}\n'.format('wall', s['wall_seconds']))
+
+        for name, io in s['io'].items():
+            for op, seconds, nbytes, calls in (('read', io['read_seconds'], io['bytes_read'], io['reads']),
+                                                ('write', io['write_seconds'], io['bytes_written'], io['writes'])):
+                if calls:
+                    out.write('{0:s}: {1:d} {2:s}s of {3:.1f} MB in {4:.3f} s ({5:.1f} MB/s)\n'.format(
+                              name, calls, op, nbytes / 1e6, seconds, nbytes / 1e6 / max(seconds, 1e-9)))
+        out.write('Peak RSS: {0:.1f} MB\n'.format(s['peak_rss_bytes'] / 1e6))
+
+    def write_json(self, fname):
+        """Write the summary to the file 'fname'"""
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
@@ -0,0 +1,218 @@
+"""
+    Space-filling curve ordering of particles
+
+    ChaNGa builds its tree and domain decomposition much faster when its input is
+    already in spatial order, so particles can be reordered along a Morton
+    (Z-order) or Peano-Hilbert curve before they are written.
+"""
+
+import numpy as np
+import os
+import shutil
+import tempfile
+
+curves = ('morton', 'hilbert')
+
+# Bits per dimension, so that a key fits in 63 bits
+key_bits = 21
+
+def _quantize(pos, origin, box_size, bits):
+    """Integer coordinates in [0, 2**bits) of 'pos' within the box. For internal use only"""
+    scale = (1 << bits) / box_size
+    q = np.empty(pos.shape, dtype=np.uint64)
+    for d in range(3):
+        x = (np.asarray(pos[:, d], dtype=np.float64) - origin[d]) * scale
+        np.clip(x, 0, (1 << bits) - 1, out=x)
+        q[:, d] = x
+    return q
+
+def _spread(x):
+    """Put two zero bits between each of the low 21 bits of 'x'. For internal use only"""
+    x = x & np.uint64(0x1fffff)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return x
+
+def _interleave(x, y, z):
+    """For internal use only"""
+    return (_spread(x) << np.uint64(2)) | (_spread(y) << np.uint64(1)) | _spread(z)
+
+def morton_keys(pos, origin, box_size, bits=key_bits):
+    """Morton keys of the (N, 3) positions 'pos' in the cube of side 'box_size' at 'origin'"""
+    q = _quantize(pos, origin, box_size, bits)
+    return _interleave(q[:, 0], q[:, 1], q[:, 2])
+
+def hilbert_keys(pos, origin, box_size, bits=key_bits):
+    """Peano-Hilbert keys of the (N, 3) positions 'pos' in the cube of side 'box_size' at 'origin'
+
+    This is Skilling's transform (AIP Conf. Proc. 707, 381 (2004)) applied to
+    all particles at once, one bit level at a time.
+    """
+    q = _quantize(pos, origin, box_size, bits)
+    X = [q[:, 0].copy(), q[:, 1].copy(), q[:, 2].copy()]
+    zero = np.uint64(0)
+
+    # Inverse undo
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        P = np.uint64(Q - 1)
+        for i in range(3):
+            high = (X[i] & np.uint64(Q)) != 0
+            t = (X[0] ^ X[i]) & P
+            X[0] ^= np.where(high, P, t)
+            if i > 0:
+                X[i] ^= np.where(high, zero, t)
+        Q >>= 1
+
+    # Gray encode
+    X[1] ^= X[0]
+    X[2] ^= X[1]
+    t = np.zeros_like(X[0])
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        t ^= np.where((X[2] & np.uint64(Q)) != 0, np.uint64(Q - 1), zero)
+        Q >>= 1
+    for i in range(3):
+        X[i] ^= t
+
+    return _interleave(X[0], X[1], X[2])
+
+class sorted_slab:
+    """A block of particles in key order
+
+    It has the same fields as the particles it was sorted from. Fields that
+    are arrays are views of the columns of 'records'; others (None, or a
+    scalar mass) are taken from 'constants'.
+    """
+    def __init__(self, records, constants):
+        self.records = records
+        self.size = len(records)
+        for name in records.dtype.names:
+            if name != 'key':
+                setattr(self, name, records[name])
+        for name, value in constants.items():
+            setattr(self, name, value)
+
+class sorter:
+    """Reorder particles along a space-filling curve
+
+    Calling the sorter on the slabs of one particle type yields sorted_slabs
+    covering the particles in key order. Only the fields in 'fields' are kept.
+    A single slab is sorted in memory. Several slabs (i.e., a particle_stream)
+    are sorted externally: each slab is sorted and written to a run file in
+    'tmpdir', and the runs are then merged holding at most 'block_size'
+    particles (or one per run, if there are more runs) at a time.
+
+    'origin' and 'box_size' give the cube the keys cover; positions outside it
+    are clamped to its faces.
+    """
+    def __init__(self, curve, origin, box_size, fields, block_size=1 << 16, tmpdir=None):
+        if curve not in curves:
+            raise ValueError('unknown space-filling curve "{0:s}"'.format(curve))
+        if box_size <= 0:
+            raise ValueError('the box to sort particles in must have a positive size')
+        self.keys = morton_keys if curve == 'morton' else hilbert_keys
+        self.origin = origin
+        self.box_size = box_size
+        self.fields = fields
+        self.block_size = int(block_size)
+        self.tmpdir = tmpdir
+
+    def _records(self, slab):
+        """The kept fields of 'slab' as key-sorted records, and its constant fields. For internal use only"""
+        columns, constants = {}, {}
+        for name in self.fields:
+            value = getattr(slab, name)
+            if value is None or np.ndim(value) == 0:
+                constants[name] = value
+            else:
+                columns[name] = value
+
+        dtype = [('key', np.uint64)] + [(k, v.dtype, v.shape[1:]) for k, v in columns.items()]
+        records = np.empty(slab.size, dtype=dtype)
+        records['key'] = self.keys(slab.positions, self.origin, self.box_size)
+        for k, v in columns.items():
+            records[k] = v
+        return records[np.argsort(records['key'], kind='stable')], constants
+
+    def __call__(self, slabs):
+        slabs = iter(slabs)
+        first = next(slabs, None)
+        if first is None:
+            return
+
+        records, constants = self._records(first)
+        _release(first)
+        second = next(slabs, None)
+        if second is None:
+            yield sorted_slab(records, constants)
+            return
+
+        workdir = tempfile.mkdtemp(prefix='g2c-sort-', dir=self.tmpdir)
+        try:
+            runs = [self._write_run(workdir, 0, records)]
+            del records
+            for i, slab in enumerate(_chain(second, slabs), 1):
+                records, _ = self._records(slab)
+                _release(slab)
+                runs.append(self._write_run(workdir, i, records))
+                del records
+
+            for block in _merge(runs, self.block_size):
+                yield sorted_slab(block, constants)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _write_run(self, workdir, index, records):
+        """For internal use only"""
+        path = os.path.join(workdir, 'run{0:d}'.format(index))
+        records.tofile(path)
+        return path, records.dtype, len(records)
+
+def _chain(first, rest):
+    """For internal use only"""
+    yield first
+    yield from rest
+
+def _release(slab):
+    """Drop the fields read for 'slab', if it caches them. For internal use only"""
+    drop = getattr(slab, 'drop_cache', None)
+    if drop is not None:
+        drop()
+
+def _merge(runs, block_size):
+    """Merge sorted run files into blocks of records in key order. For internal use only
+
+    A window of each run is examined at a time, together holding at most
+    'block_size' records. Records are ordered by key and then by run, as a
+    stable sort of the runs in turn would order them. Every record ordered no
+    later than the smallest last record of the windows whose runs continue can
+    be emitted, as no later record can precede it.
+    """
+    maps = [np.memmap(path, dtype=dtype, mode='r', shape=(size,)) for path, dtype, size in runs if size > 0]
+    cursors = [0] * len(maps)
+    # The run whose window ends at the smallest key is consumed each step, so even windows of one record progress
+    block_size = max(1, block_size // max(len(maps), 1))
+
+    while True:
+        windows = [m[c:c + block_size] for m, c in zip(maps, cursors)]
+        limits = [(w['key'][-1], i) for i, (m, c, w) in enumerate(zip(maps, cursors, windows))
+                  if len(w) > 0 and c + len(w) < len(m)]
+        if not any(len(w) for w in windows):
+            return
+
+        parts = []
+        limit = min(limits) if limits else None
+        for i, w in enumerate(windows):
+            n = len(w)
+            if limit is not None:
+                # Records of earlier runs precede those of later runs with the same key
+                n = int(np.searchsorted(w['key'], limit[0], side='right' if i <= limit[1] else 'left'))
+            parts.append(w[:n])
+            cursors[i] += n
+
+        block = np.concatenate(parts)
+        yield block[np.argsort(block['key'], kind='stable')]
@@ -1,13 +1,39 @@
 import gadget
 import numpy as np
+import os
+import concurrent.futures
 from tipsy_c import *
 
 class File():
-    """Read or write a tipsy file using multiple streams of data."""
-    def __init__(self, filename, mode='rb'):
-        self.lib = load_tipsy()
-        self.lib.tipsy_open_file(ctypes.c_char_p(bytes(filename, 'utf-8')),
-                                 ctypes.c_char_p(bytes(mode, 'utf-8')))
+    """Read or write a tipsy file using multiple streams of data.
+    
+    If 'memmap' is True, the file is memory-mapped instead of read. The gas,
+    darkmatter, and stars properties are then structured arrays (see
+    tipsy_gas_dtype, tipsy_dark_dtype, and tipsy_star_dtype) viewing the
+    file directly, so fields like stars['pos'] are strided views that only
+    touch the pages they use. Use mode='r+b' to modify the file in place.
+    
+    Each File has its own handle into the C library, so several files can be
+    read concurrently from different threads.
+    
+    Both native and big-endian "standard" files can be read; the format is
+    detected from the header. Memory-mapped standard files are viewed with the
+    big-endian tipsy_standard_*_dtype structures.
+    """
+    def __init__(self, filename, mode='rb', memmap=False):
+        self.lib = None
+        self.handle = None
+        self.map = None
+        self.is_standard = None
+        self.closed_stats = None
+        
+        if memmap:
+            if mode not in ('rb', 'r+b'):
+                raise ValueError("memory-mapped tipsy files must be opened with mode 'rb' or 'r+b'")
+            self.map = np.memmap(filename, dtype=np.uint8, mode=mode.replace('b', ''))
+        else:
+            self.lib = load_tipsy()
+            self.handle = open_tipsy_file(filename, mode)
         
         self.hdr = None
         self.dark_particles = None
@@ -15,7 +41,19 @@ class File():
         self.gas_particles = None
 
     def close(self):
-        self.lib.tipsy_close_file()
+        if self.handle is not None:
+            self.closed_stats = get_io_stats(self.handle)
+            self.lib.tipsy_close(self.handle)
+            self.handle = None
+        # Views handed out remain valid until they are released
+        self.map = None
+    
+    def io_stats(self):
+        """Time and bytes of the reads made by the C library so far, as a dict (see tipsy_io_stats)
+        
+        Memory-mapped files are read by the OS, so they have no statistics.
+        """
+        return get_io_stats(self.handle) if self.handle is not None else self.closed_stats
 
     def __enter__(self):
         return self
@@ -26,71 +64,456 @@ class File():
     
     def _read_header(self):
         """For internal use only"""
+        if self.map is None:
+            self.hdr = tipsy_header()
+            self.lib.tipsy_file_read_header(self.handle, ctypes.byref(self.hdr))
+            self.is_standard = self.lib.tipsy_file_format(self.handle) == TIPSY_STANDARD
+            return
+        
+        # Files are always three-dimensional, which tells us their byte order
+        raw = self.map[:tipsy_header_dtype.itemsize]
+        h = raw.view(tipsy_header_dtype)[0]
+        self.is_standard = False
+        if h['ndim'] != 3 and raw.view(tipsy_standard_header_dtype)[0]['ndim'] == 3:
+            h = raw.view(tipsy_standard_header_dtype)[0]
+            self.is_standard = True
+        
         self.hdr = tipsy_header()
-        self.lib.tipsy_read_header(ctypes.byref(self.hdr))
+        for name in tipsy_header_dtype.names:
+            setattr(self.hdr, name, h[name].item())
+    
+    def _map_section(self, offset, count, dtype):
+        """For internal use only"""
+        if self.is_standard:
+            dtype = dtype.newbyteorder('>')
+        return self.map[offset:offset + count * dtype.itemsize].view(dtype)
+    
+    @property
+    def standard(self):
+        """Is this a big-endian "standard" tipsy file?"""
+        if self.hdr is None:
+            self._read_header()
+        return self.is_standard
     
     @property
     def header(self):
         if self.hdr is None:
-            _read_header()
+            self._read_header()
         return self.hdr
 
     @property
     def darkmatter(self):
         if self.hdr is None:
-            _read_header()
+            self._read_header()
             
+        if self.dark_particles is None and self.map is not None:
+            offset = tipsy_header_dtype.itemsize + self.hdr.ngas * tipsy_gas_dtype.itemsize
+            self.dark_particles = self._map_section(offset, self.hdr.ndark, tipsy_dark_dtype)
+        
         if self.dark_particles is None:
             self.dark_particles = tipsy_dark_data(self.hdr.ndark)
-            self.lib.tipsy_read_dark_particles(ctypes.byref(self.dark_particles))
+            self.lib.tipsy_file_read_dark_particles(self.handle, ctypes.byref(self.dark_particles))
         return self.dark_particles
         
     @property
     def stars(self):
         if self.hdr is None:
-            _read_header()
+            self._read_header()
 
+        if self.star_particles is None and self.map is not None:
+            offset = tipsy_header_dtype.itemsize + self.hdr.ngas * tipsy_gas_dtype.itemsize + \
+                     self.hdr.ndark * tipsy_dark_dtype.itemsize
+            self.star_particles = self._map_section(offset, self.hdr.nstar, tipsy_star_dtype)
+        
         if self.star_particles is None:
             self.star_particles = tipsy_star_data(self.hdr.nstar)
-            self.lib.tipsy_read_star_particles(ctypes.byref(self.star_particles))
+            self.lib.tipsy_file_read_star_particles(self.handle, ctypes.byref(self.star_particles))
         return self.star_particles
 
     @property
     def gas(self):
         if self.hdr is None:
-            _read_header()
+            self._read_header()
             
+        if self.gas_particles is None and self.map is not None:
+            offset = tipsy_header_dtype.itemsize
+            self.gas_particles = self._map_section(offset, self.hdr.ngas, tipsy_gas_dtype)
+        
         if self.gas_particles is None:
             self.gas_particles = tipsy_gas_data(self.hdr.ngas)
-            self.lib.tipsy_read_gas_particles(ctypes.byref(self.gas_particles))
+            self.lib.tipsy_file_read_gas_particles(self.handle, ctypes.byref(self.gas_particles))
         return self.gas_particles
 
+def _gas_fields(mass, pos, vel, rho, temp, hsmooth, metals, phi, size, mass_scale, velocity_scale):
+    """For internal use only"""
+    return tipsy_make_fields(tipsy_gas_fields, {'mass': mass_scale, 'vel': velocity_scale}, size, mass=mass, pos=pos,
+                             vel=vel, rho=rho, temp=temp, hsmooth=hsmooth, metals=metals, phi=phi)
+
+def _dark_fields(mass, pos, vel, phi, softening, size, mass_scale, velocity_scale):
+    """For internal use only"""
+    return tipsy_make_fields(tipsy_dark_fields, {'mass': mass_scale, 'vel': velocity_scale}, size, mass=mass, pos=pos,
+                             vel=vel, phi=phi, softening=np.array(softening, dtype=np.float32).item())
+
+def _star_fields(mass, pos, vel, metals, tform, phi, softening, is_blackhole, size, mass_scale, velocity_scale):
+    """For internal use only"""
+    return tipsy_make_fields(tipsy_star_fields, {'mass': mass_scale, 'vel': velocity_scale}, size, mass=mass, pos=pos,
+                             vel=vel, metals=metals, tform=tform, phi=phi,
+                             softening=np.array(softening, dtype=np.float32).item(), is_blackhole=is_blackhole)
+
+def file_size(ngas, ndark, nstars):
+    """Size in bytes of a tipsy file with these numbers of particles
+    
+    As each type of particle is stored after the ones before it, this is also
+    the offset of the particle that follows the first 'ngas', 'ndark', and
+    'nstars' particles written to a file.
+    """
+    return tipsy_header_dtype.itemsize + ngas * tipsy_gas_dtype.itemsize + ndark * tipsy_dark_dtype.itemsize + \
+           nstars * tipsy_star_dtype.itemsize
+
+def _preallocate(fd, ngas, ndark, nstars):
+    """Allocate the full size of a tipsy file with these counts. For internal use only"""
+    size = file_size(ngas, ndark, nstars)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not all platforms and filesystems support preallocation
+        os.ftruncate(fd, size)
+
 class streaming_writer():
-    def __init__(self, filename, mode='wb'):
+    """Write a tipsy file one block of particles at a time.
+    
+    Particles are packed into a staging buffer of 'buffer_size' bytes and
+    written with a single call per buffer. A size of zero writes each particle
+    individually.
+    
+    Each writer has its own handle into the C library, so several files can
+    be written concurrently from different threads.
+    
+    If 'standard' is True, the file is written in the big-endian "standard"
+    format read by ChaNGa and pynbody by default. Each block of particles is
+    byte-swapped as a whole just before it is written.
+    
+    Fields may be float32 or float64 arrays of any stride, and the masses may
+    be a scalar if all particles have the same mass. 'mass_scale' and
+    'velocity_scale' are applied as the particles are packed, so the input
+    arrays are neither copied nor modified.
+    
+    If 'header' is given as (time, ngas, ndark, nstars), the file is preallocated
+    to its final size and the header is written straight away, so the particles
+    can follow in a single pass. Writing more particles than declared is then an
+    error, as is closing the file after writing fewer. To continue writing such a file, open it with mode 'r+b' and give
+    the numbers of (gas, dark, star) particles already written as 'start'.
+    """
+    def __init__(self, filename, mode='wb', buffer_size=None, standard=False, header=None, start=None):
+        if start is not None and header is None:
+            raise ValueError('the header must be given to continue writing a file')
+        
         self.lib = load_tipsy()
-        self.lib.tipsy_open_file(ctypes.c_char_p(bytes(filename, 'utf-8')),
-                                 ctypes.c_char_p(bytes(mode, 'utf-8')))
+        self.handle = open_tipsy_file(filename, mode)
+        self.closed_stats = None
+        if buffer_size is not None:
+            self.lib.tipsy_set_file_buffer_size(self.handle, buffer_size)
+        if standard:
+            self.lib.tipsy_set_file_format(self.handle, TIPSY_STANDARD)
+        
+        # Particles of each type still to be written, if known
+        self.remaining = None
+        if header is not None:
+            time, ngas, ndark, nstars = header
+            if start is None:
+                _preallocate(self.lib.tipsy_fileno(self.handle), ngas, ndark, nstars)
+                self.header(time, ngas, ndark, nstars)
+                start = (0, 0, 0)
+            else:
+                self.lib.tipsy_file_seek(self.handle, file_size(*start))
+            self.remaining = {'gas': ngas - start[0], 'dark': ndark - start[1], 'star': nstars - start[2]}
+    
+    def _count(self, kind, size):
+        """For internal use only"""
+        if self.remaining is None:
+            return
+        if size > self.remaining[kind]:
+            raise ValueError('More {0:s} particles written than given at open'.format(kind))
+        self.remaining[kind] -= size
     
     def header(self, time, ngas, ndark, nstars):
-        self.lib.tipsy_write_header(time, ngas, ndark, nstars)
+        self.lib.tipsy_file_write_header(self.handle, time, ngas, ndark, nstars)
 
-    def gas(self, mass, pos, vel, rho, temp, hsmooth, metals, phi, size):
-        self.lib.tipsy_write_gas_particles(mass, pos, vel, rho, temp, hsmooth, metals, phi, size)
+    def gas(self, mass, pos, vel, rho, temp, hsmooth, metals, phi, size, mass_scale=1.0, velocity_scale=1.0):
+        fields = _gas_fields(mass, pos, vel, rho, temp, hsmooth, metals, phi, size, mass_scale, velocity_scale)
+        self._count('gas', size)
+        self.lib.tipsy_file_write_gas_fields(self.handle, fields, size)
+    
+    def darkmatter(self, mass, pos, vel, phi, softening, size, mass_scale=1.0, velocity_scale=1.0):
+        fields = _dark_fields(mass, pos, vel, phi, softening, size, mass_scale, velocity_scale)
+        self._count('dark', size)
+        self.lib.tipsy_file_write_dark_fields(self.handle, fields, size)
     
-    def darkmatter(self, mass, pos, vel, phi, softening, size):
-        softening = np.asscalar(np.array(softening, dtype=np.float32))
-        self.lib.tipsy_write_dark_particles(mass, pos, vel, phi, softening, size)    
+    def stars(self, mass, pos, vel, metals, tform, phi, softening, size, is_blackhole=False, mass_scale=1.0,
+              velocity_scale=1.0):
+        fields = _star_fields(mass, pos, vel, metals, tform, phi, softening, is_blackhole, size, mass_scale,
+                              velocity_scale)
+        self._count('star', size)
+        self.lib.tipsy_file_write_star_fields(self.handle, fields, size)
     
-    def stars(self, mass, pos, vel, metals, tform, phi, softening, size, is_blackhole=False):
-        softening = np.asscalar(np.array(softening, dtype=np.float32))
-        self.lib.tipsy_write_star_particles(mass, pos, vel, metals, tform, phi, softening, size, is_blackhole)
+    def sync(self):
+        """Make sure everything written so far is on disk"""
+        self.lib.tipsy_file_sync(self.handle)
 
     def close(self):
-        self.lib.tipsy_close_file()
+        self._close()
+        if self.remaining is not None:
+            _check_written(self.remaining)
+    
+    def _close(self):
+        """Close the file without checking that every particle was written. For internal use only"""
+        if self.handle is not None:
+            self.closed_stats = get_io_stats(self.handle)
+            self.lib.tipsy_close(self.handle)
+            self.handle = None
+    
+    def io_stats(self):
+        """Time and bytes of the writes made by the C library so far, as a dict (see tipsy_io_stats)"""
+        return get_io_stats(self.handle) if self.handle is not None else self.closed_stats
 
     def __enter__(self):
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
+        # An interrupted file is left as it is, to be resumed
+        if exc_type is None:
+            self.close()
+        else:
+            self._close()
+        return False  # always re-raise exceptions
+
+def _check_written(remaining):
+    """Raise if any particles of the header were not written. For internal use only"""
+    for kind, count in remaining.items():
+        if count > 0:
+            raise ValueError('{0:d} {1:s} particles given at open were not written'.format(count, kind))
+
+def _slab(a, start, stop):
+    """For internal use only"""
+    if a is None or np.ndim(a) == 0:
+        return a
+    return a[start:stop]
+
+class parallel_writer():
+    """Write a tipsy file from a pool of worker threads.
+    
+    The layout of the file is fixed by the particle counts, so the file is
+    preallocated and each call to gas, darkmatter, or stars is split into slabs
+    of 'slab_size' particles that are written concurrently at their final
+    offsets. As with streaming_writer, particles of each type are placed in the
+    order they are given. Arrays must not be modified until close() returns.
+    The fields, scale factors, and 'standard' are as for streaming_writer.
+    
+    If 'start' is given as the numbers of (gas, dark, star) particles already
+    written to an existing file, writing continues after them and the header
+    is left as it is. Closing the file before every particle has been written
+    is an error.
+    """
+    def __init__(self, filename, time, ngas, ndark, nstars, workers=None, slab_size=1 << 20, buffer_size=4 << 20,
+                 standard=False, start=None):
+        self.lib = load_tipsy()
+        self.standard = standard
+        self.slab_size = int(slab_size)
+        self.buffer_size = int(buffer_size)
+        self.counts = {'gas': ngas, 'dark': ndark, 'star': nstars}
+        
+        self.offsets = {}
+        self.offsets['gas'] = tipsy_header_dtype.itemsize
+        self.offsets['dark'] = self.offsets['gas'] + ngas * tipsy_gas_dtype.itemsize
+        self.offsets['star'] = self.offsets['dark'] + ndark * tipsy_dark_dtype.itemsize
+        
+        # Number of particles of each type handed out so far
+        self.cursor = dict(zip(('gas', 'dark', 'star'), (0, 0, 0) if start is None else start))
+        
+        self.handle = open_tipsy_file(filename, 'wb' if start is None else 'r+b')
+        self.closed_stats = None
+        self.fd = self.lib.tipsy_fileno(self.handle)
+        if standard:
+            self.lib.tipsy_set_file_format(self.handle, TIPSY_STANDARD)
+        if start is None:
+            _preallocate(self.fd, ngas, ndark, nstars)
+        
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = 2 * workers
+        self.pending = set()
+        
+        if start is None:
+            self.header(time, ngas, ndark, nstars)
+    
+    def _submit(self, kind, size, write):
+        """Queue write(offset, start, stop) for each slab. For internal use only"""
+        if self.cursor[kind] + size > self.counts[kind]:
+            raise ValueError('More {0:s} particles written than given at open'.format(kind))
+        
+        itemsize = {'gas': tipsy_gas_dtype, 'dark': tipsy_dark_dtype, 'star': tipsy_star_dtype}[kind].itemsize
+        first = self.offsets[kind] + self.cursor[kind] * itemsize
+        self.cursor[kind] += size
+        
+        for start in range(0, size, self.slab_size):
+            stop = min(start + self.slab_size, size)
+            if len(self.pending) >= self.max_pending:
+                self._wait(concurrent.futures.FIRST_COMPLETED)
+            self.pending.add(self.pool.submit(write, first + start * itemsize, start, stop))
+    
+    def _wait(self, return_when=concurrent.futures.ALL_COMPLETED):
+        """For internal use only"""
+        done, self.pending = concurrent.futures.wait(self.pending, return_when=return_when)
+        for f in done:
+            f.result()  # re-raise any errors from the workers
+    
+    def header(self, time, ngas, ndark, nstars):
+        dtype = tipsy_standard_header_dtype if self.standard else tipsy_header_dtype
+        # Start from zeros so the structure padding is reproducible
+        h = np.zeros(1, dtype=dtype)
+        h[0] = (time, ngas + ndark + nstars, 3, ngas, ndark, nstars)
+        os.pwrite(self.fd, h.tobytes(), 0)
+
+    def gas(self, mass, pos, vel, rho, temp, hsmooth, metals, phi, size, mass_scale=1.0, velocity_scale=1.0):
+        def write(offset, start, stop):
+            s = lambda a: _slab(a, start, stop)
+            fields = _gas_fields(s(mass), s(pos), s(vel), s(rho), s(temp), s(hsmooth), s(metals), s(phi),
+                                 stop - start, mass_scale, velocity_scale)
+            self.lib.tipsy_pwrite_gas_fields(self.handle, offset, fields, stop - start, self.buffer_size)
+        self._submit('gas', size, write)
+    
+    def darkmatter(self, mass, pos, vel, phi, softening, size, mass_scale=1.0, velocity_scale=1.0):
+        def write(offset, start, stop):
+            s = lambda a: _slab(a, start, stop)
+            fields = _dark_fields(s(mass), s(pos), s(vel), s(phi), softening, stop - start, mass_scale, velocity_scale)
+            self.lib.tipsy_pwrite_dark_fields(self.handle, offset, fields, stop - start, self.buffer_size)
+        self._submit('dark', size, write)
+    
+    def stars(self, mass, pos, vel, metals, tform, phi, softening, size, is_blackhole=False, mass_scale=1.0,
+              velocity_scale=1.0):
+        def write(offset, start, stop):
+            s = lambda a: _slab(a, start, stop)
+            fields = _star_fields(s(mass), s(pos), s(vel), s(metals), s(tform), s(phi), softening, is_blackhole,
+                                  stop - start, mass_scale, velocity_scale)
+            self.lib.tipsy_pwrite_star_fields(self.handle, offset, fields, stop - start, self.buffer_size)
+        self._submit('star', size, write)
+    
+    def sync(self):
+        """Wait for the writes queued so far and make sure they are on disk"""
+        self._wait()
+        self.lib.tipsy_file_sync(self.handle)
+
+    def close(self):
+        self._close()
+        _check_written({kind: self.counts[kind] - self.cursor[kind] for kind in self.counts})
+    
+    def _close(self):
+        """Wait for the writes and close the file without checking that every particle was written.
+        For internal use only
+        """
+        if self.handle is None:
+            return
+        try:
+            self._wait()
+        finally:
+            self.pool.shutdown()
+            self.closed_stats = get_io_stats(self.handle)
+            self.lib.tipsy_close(self.handle)
+            self.handle = None
+            self.fd = None
+    
+    def io_stats(self):
+        """Time and bytes of the pwrites made by the C library so far, as a dict (see tipsy_io_stats)
+        
+        The write time is summed over the workers, so it can exceed the elapsed time.
+        """
+        return get_io_stats(self.handle) if self.handle is not None else self.closed_stats
+
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An interrupted file is left as it is, to be resumed
+        if exc_type is None:
+            self.close()
+        else:
+            self._close()
         return False  # always re-raise exceptions
+
+# Sections of a tipsy file, in file order
+sections = ('gas', 'darkmatter', 'stars')
+
+def _select(block, box, downsample, rng):
+    """Mask of the particles of 'block' to keep. For internal use only"""
+    mask = np.ones(len(block), dtype=bool)
+    if box is not None:
+        pos = block['pos']
+        for d in range(3):
+            mask &= pos[:, d] >= box[0][d]
+            mask &= pos[:, d] < box[1][d]
+    if downsample > 1:
+        # Drawn for every block, so the selection does not depend on the other criteria
+        mask &= rng.random(len(block)) < 1.0 / downsample
+    return mask
+
+def subset(source, destination, species=sections, box=None, downsample=1, seed=None, conserve_mass=False,
+           standard=None, block_size=1 << 20):
+    """Copy a selection of the particles of the tipsy file 'source' to 'destination'
+    
+    Only the sections named in 'species' (see 'sections') are kept. If 'box' is
+    given as (lower corner, upper corner), only particles with lower <= pos < upper
+    are kept. If 'downsample' is N > 1, each particle is kept with probability 1/N,
+    using a generator seeded with 'seed'; with 'conserve_mass', the masses of
+    the particles kept are multiplied by N.
+    
+    The source is memory-mapped and read 'block_size' particles at a time, and
+    the particles kept from each block are appended to the destination, so the
+    memory used is bounded by the block size however large the files are (pages
+    of the source already read are clean page cache the OS can reclaim). The
+    header is written last, once the counts are known. The destination has the
+    format of the source unless 'standard' is given.
+    
+    Returns the numbers of gas, dark matter, and star particles written.
+    """
+    for name in species:
+        if name not in sections:
+            raise ValueError('unknown tipsy section "{0:s}"'.format(name))
+    if box is not None:
+        box = (np.asarray(box[0], dtype=np.float64), np.asarray(box[1], dtype=np.float64))
+    downsample = int(downsample)
+    rng = np.random.default_rng(seed)
+    
+    with File(source, memmap=True) as src, open(destination, 'wb') as out:
+        if standard is None:
+            standard = src.standard
+        dtypes = {
+            'header'    : tipsy_standard_header_dtype if standard else tipsy_header_dtype,
+            'gas'       : tipsy_standard_gas_dtype if standard else tipsy_gas_dtype,
+            'darkmatter': tipsy_standard_dark_dtype if standard else tipsy_dark_dtype,
+            'stars'     : tipsy_standard_star_dtype if standard else tipsy_star_dtype
+        }
+        
+        # Reserve the header; it is written once the counts are known
+        out.write(bytes(dtypes['header'].itemsize))
+        
+        counts = dict.fromkeys(sections, 0)
+        for name in sections:
+            if name not in species:
+                continue
+            particles = getattr(src, name)
+            for start in range(0, len(particles), block_size):
+                block = particles[start:start + block_size]
+                kept = block[_select(block, box, downsample, rng)].astype(dtypes[name], copy=False)
+                if conserve_mass and downsample > 1:
+                    kept['mass'] *= downsample
+                out.write(kept.tobytes())
+                counts[name] += len(kept)
+        
+        ngas, ndark, nstars = (counts[name] for name in sections)
+        h = np.zeros(1, dtype=dtypes['header'])
+        h[0] = (src.header.time, ngas + ndark + nstars, 3, ngas, ndark, nstars)
+        out.seek(0)
+        out.write(h.tobytes())
+    
+    return ngas, ndark, nstars
@@ -1,6 +1,7 @@
 import numpy as np
 import numpy.ctypeslib as npct
 import ctypes
+import threading
 
 float_p = ctypes.POINTER(ctypes.c_float)
 
@@ -83,7 +84,7 @@ class tipsy_gas_data(tipsy_struct):
     
     def __init__(self, size):
         super().__init__()
-        tipsy_init_basic_particles(self, size)
+        tipsy_init_basic_particle(self, size)
         
         self.rho        = tipsy_make_array(size)
         self.rho_p      = self.rho.ctypes.data_as(float_p)
@@ -142,67 +143,291 @@ class tipsy_blackhole_data(tipsy_struct):
         super().__init__()
         tipsy_init_basic_particle(self, size)
 
+# Input types of tipsy_field
+TIPSY_FLOAT  = 0
+TIPSY_DOUBLE = 1
+
+class tipsy_field(ctypes.Structure):
+    _fields_ = [
+        ('data'            , ctypes.c_void_p),
+        ('stride'          , ctypes.c_long),
+        ('component_stride', ctypes.c_long),
+        ('type'            , ctypes.c_int),
+        ('scale'           , ctypes.c_double)
+    ]
+
+class tipsy_gas_fields(ctypes.Structure):
+    _fields_ = [
+        ('mass'   , tipsy_field),
+        ('pos'    , tipsy_field),
+        ('vel'    , tipsy_field),
+        ('rho'    , tipsy_field),
+        ('temp'   , tipsy_field),
+        ('hsmooth', tipsy_field),
+        ('metals' , tipsy_field),
+        ('phi'    , tipsy_field)
+    ]
+
+class tipsy_dark_fields(ctypes.Structure):
+    _fields_ = [
+        ('mass'     , tipsy_field),
+        ('pos'      , tipsy_field),
+        ('vel'      , tipsy_field),
+        ('phi'      , tipsy_field),
+        ('softening', ctypes.c_float)
+    ]
+
+class tipsy_star_fields(ctypes.Structure):
+    _fields_ = [
+        ('mass'        , tipsy_field),
+        ('pos'         , tipsy_field),
+        ('vel'         , tipsy_field),
+        ('metals'      , tipsy_field),
+        ('tform'       , tipsy_field),
+        ('phi'         , tipsy_field),
+        ('softening'   , ctypes.c_float),
+        ('is_blackhole', ctypes.c_int)
+    ]
+
+def tipsy_make_field(a, scale=1.0):
+    """Describe the array or scalar 'a' to the C writers, which apply 'scale'
+    
+    float32 and float64 arrays of any stride are used in place; anything else is
+    first converted to float32. A scalar is given to every particle. Returns the
+    field and the array it refers to, which must be kept alive while it is used.
+    """
+    field = tipsy_field(None, 0, 0, TIPSY_FLOAT, float(scale))
+    if a is None:
+        return field, None
+    
+    a = np.asarray(a)
+    if a.dtype != np.float32 and a.dtype != np.float64:
+        a = a.astype(np.float32)
+    if a.ndim == 0:
+        a = a.reshape(1)
+    elif a.ndim > 2:
+        raise ValueError('tipsy only supports 1d and 2d arrays')
+    elif a.shape[0] > 0:
+        field.stride = a.strides[0]
+    
+    field.data = a.ctypes.data
+    field.component_stride = a.strides[1] if a.ndim == 2 else 0
+    field.type = TIPSY_DOUBLE if a.dtype == np.float64 else TIPSY_FLOAT
+    return field, a
+
+# Fields with x, y, and z components
+tipsy_vector_fields = ('pos', 'vel')
+
+def tipsy_make_fields(kind, scales, size, **values):
+    """Build the fields structure 'kind' of 'size' particles from 'values'. For internal use only
+    
+    Fields are scaled by the factor of the same name in 'scales', if any. The
+    arrays referred to are kept in the 'arrays' attribute of the result.
+    """
+    fields = kind()
+    fields.arrays = []
+    for name, type in kind._fields_:
+        if type is tipsy_field:
+            # The C writers read 'size' rows of every array, with three columns for the vector fields
+            shape = np.shape(values[name])
+            if name in tipsy_vector_fields:
+                if values[name] is not None and shape[1:] != (3,):
+                    raise ValueError('{0:s} must have 3 columns, not shape {1}'.format(name, shape))
+            elif len(shape) > 1:
+                raise ValueError('{0:s} must be a scalar or 1d array, not shape {1}'.format(name, shape))
+            if len(shape) >= 1 and shape[0] < size:
+                raise ValueError('{0:s} has {1:d} values for {2:d} particles'.format(name, shape[0], size))
+            field, array = tipsy_make_field(values[name], scales.get(name, 1.0))
+            setattr(fields, name, field)
+            fields.arrays.append(array)
+        else:
+            setattr(fields, name, values[name])
+    return fields
+
+# NumPy equivalents of the on-disk structures in tipsy.h
+tipsy_header_dtype = np.dtype([
+    ('time'   , np.float64),
+    ('nbodies', np.int32),
+    ('ndim'   , np.int32),
+    ('ngas'   , np.int32),
+    ('ndark'  , np.int32),
+    ('nstar'  , np.int32)
+], align=True)
+
+tipsy_gas_dtype = np.dtype([
+    ('mass'   , np.float32),
+    ('pos'    , np.float32, 3),
+    ('vel'    , np.float32, 3),
+    ('rho'    , np.float32),
+    ('temp'   , np.float32),
+    ('hsmooth', np.float32),
+    ('metals' , np.float32),
+    ('phi'    , np.float32)
+])
+
+tipsy_dark_dtype = np.dtype([
+    ('mass'     , np.float32),
+    ('pos'      , np.float32, 3),
+    ('vel'      , np.float32, 3),
+    ('softening', np.float32),
+    ('phi'      , np.float32)
+])
+
+tipsy_star_dtype = np.dtype([
+    ('mass'     , np.float32),
+    ('pos'      , np.float32, 3),
+    ('vel'      , np.float32, 3),
+    ('metals'   , np.float32),
+    ('tform'    , np.float32),
+    ('softening', np.float32),
+    ('phi'      , np.float32)
+])
+
+# The big-endian "standard" tipsy format. The header is padded to 32 bytes as above
+tipsy_standard_header_dtype = tipsy_header_dtype.newbyteorder('>')
+tipsy_standard_gas_dtype = tipsy_gas_dtype.newbyteorder('>')
+tipsy_standard_dark_dtype = tipsy_dark_dtype.newbyteorder('>')
+tipsy_standard_star_dtype = tipsy_star_dtype.newbyteorder('>')
+
+# On-disk formats (tipsy_format_t)
+TIPSY_NATIVE   = 0
+TIPSY_STANDARD = 1
+
+class tipsy_io_stats(ctypes.Structure):
+    """Time and bytes of a file's fread/fwrite/pwrite calls"""
+    _fields_ = [
+        ('read_seconds' , ctypes.c_double),
+        ('write_seconds', ctypes.c_double),
+        ('bytes_read'   , ctypes.c_ulonglong),
+        ('bytes_written', ctypes.c_ulonglong),
+        ('reads'        , ctypes.c_ulonglong),
+        ('writes'       , ctypes.c_ulonglong)
+    ]
+    
+    def as_dict(self):
+        return {name: getattr(self, name) for name, _ in self._fields_}
+
+# Opaque 'tipsy_file *' handle
+tipsy_file_p = ctypes.c_void_p
+
 def load_tipsy():
-    """Load the tipsy module. For internal use only """
-    if load_tipsy.lib is not None:
-        return load_tipsy.lib
+    """Load the tipsy module. For internal use only
     
-    def decode_err(err):
+    The library is loaded with ctypes.CDLL semantics, so the GIL is released
+    for the duration of every call into it.
+    """
+    with load_tipsy.lock:
+        if load_tipsy.lib is None:
+            load_tipsy.lib = _load_tipsy()
+        return load_tipsy.lib
+load_tipsy.lib = None
+load_tipsy.lock = threading.Lock()
+
+def _load_tipsy():
+    """For internal use only"""
+    def decode_err(err, func, args):
         if err < 0:
             # Tipsy error
             raise IOError(lib.tipsy_strerror(err).decode('utf-8'))
         
         if err > 0:
-            # system error
+            # system error; the first argument is always the file handle
             raise IOError('{0:s}: {1:s}'.format(
-                    lib.tipsy_get_last_system_error().decode('utf-8'),
+                    lib.tipsy_error(args[0]).decode('utf-8'),
                     lib.tipsy_strerror(err).decode('utf-8')
                 ))
+        return err
+    
+    def declare(name, argtypes):
+        func = getattr(lib, name)
+        func.restype = ctypes.c_int
+        func.argtypes = [tipsy_file_p] + argtypes
+        func.errcheck = decode_err
     
     lib = npct.load_library("libtipsy", "")
     
     # Force parameter type-checking and return-value error checking
-    lib.tipsy_get_last_system_error.restype = ctypes.c_char_p
-    lib.tipsy_get_last_system_error.argtypes = []
-    
     lib.tipsy_strerror.restype = ctypes.c_char_p
     lib.tipsy_strerror.argtypes = [ctypes.c_int]
     
-    lib.tipsy_open_file.restype = None
-    lib.tipsy_open_file.argtypes = [ctypes.c_char_p]
+    lib.tipsy_set_buffer_size.restype = None
+    lib.tipsy_set_buffer_size.argtypes = [ctypes.c_size_t]
     
-    lib.tipsy_close_file.restype = None
-    lib.tipsy_close_file.argtypes = []
+    lib.tipsy_open.restype = ctypes.c_int
+    lib.tipsy_open.argtypes = [ctypes.POINTER(tipsy_file_p), ctypes.c_char_p, ctypes.c_char_p]
     
-    lib.tipsy_write_header.restype = decode_err
-    lib.tipsy_write_header.argtypes = [ctypes.c_double, ctypes.c_int, ctypes.c_int, ctypes.c_int]
-
-    lib.tipsy_write_gas_particles.restype = decode_err
-    lib.tipsy_write_gas_particles.argtypes = [array_1d_float, array_2d_float, array_2d_float,
-                                              array_1d_float, array_1d_float, array_1d_float,
-                                              array_1d_float, array_1d_float, ctypes.c_size_t]
-
-    lib.tipsy_write_dark_particles.restype = decode_err
-    lib.tipsy_write_dark_particles.argtypes = [array_1d_float, array_2d_float, array_2d_float,
-                                               array_1d_float, ctypes.c_float, ctypes.c_size_t]
+    lib.tipsy_close.restype = None
+    lib.tipsy_close.argtypes = [tipsy_file_p]
+    
+    lib.tipsy_error.restype = ctypes.c_char_p
+    lib.tipsy_error.argtypes = [tipsy_file_p]
+    
+    lib.tipsy_fileno.restype = ctypes.c_int
+    lib.tipsy_fileno.argtypes = [tipsy_file_p]
+    
+    lib.tipsy_set_file_buffer_size.restype = None
+    lib.tipsy_set_file_buffer_size.argtypes = [tipsy_file_p, ctypes.c_size_t]
+    
+    lib.tipsy_set_file_format.restype = None
+    lib.tipsy_set_file_format.argtypes = [tipsy_file_p, ctypes.c_int]
+    
+    lib.tipsy_file_format.restype = ctypes.c_int
+    lib.tipsy_file_format.argtypes = [tipsy_file_p]
+    
+    lib.tipsy_file_io_stats.restype = None
+    lib.tipsy_file_io_stats.argtypes = [tipsy_file_p, ctypes.POINTER(tipsy_io_stats)]
     
-    lib.tipsy_write_star_particles.restype = decode_err
-    lib.tipsy_write_star_particles.argtypes = [array_1d_float, array_2d_float, array_2d_float,
+    lib.tipsy_reset_io_stats.restype = None
+    lib.tipsy_reset_io_stats.argtypes = [tipsy_file_p]
+    
+    declare('tipsy_file_seek', [ctypes.c_long])
+    declare('tipsy_file_sync', [])
+    
+    declare('tipsy_file_write_header', [ctypes.c_double, ctypes.c_int, ctypes.c_int, ctypes.c_int])
+
+    declare('tipsy_file_write_gas_particles', [array_1d_float, ctypes.c_size_t, array_2d_float, array_2d_float,
                                                array_1d_float, array_1d_float, array_1d_float,
-                                               ctypes.c_float, ctypes.c_size_t, ctypes.c_int]
+                                               array_1d_float, array_1d_float, ctypes.c_size_t])
+
+    declare('tipsy_file_write_dark_particles', [array_1d_float, ctypes.c_size_t, array_2d_float, array_2d_float,
+                                                array_1d_float, ctypes.c_float, ctypes.c_size_t])
     
-    lib.tipsy_read_header.restype = decode_err
-    lib.tipsy_read_header.argtypes = [ctypes.POINTER(tipsy_header)]
+    declare('tipsy_file_write_star_particles', [array_1d_float, ctypes.c_size_t, array_2d_float, array_2d_float,
+                                                array_1d_float, array_1d_float, array_1d_float,
+                                                ctypes.c_float, ctypes.c_size_t, ctypes.c_int])
     
-    lib.tipsy_read_star_particles.restype = decode_err
-    lib.tipsy_read_star_particles.argtypes = [ctypes.POINTER(tipsy_star_data)]
+    declare('tipsy_file_write_gas_fields', [ctypes.POINTER(tipsy_gas_fields), ctypes.c_size_t])
+    declare('tipsy_file_write_dark_fields', [ctypes.POINTER(tipsy_dark_fields), ctypes.c_size_t])
+    declare('tipsy_file_write_star_fields', [ctypes.POINTER(tipsy_star_fields), ctypes.c_size_t])
     
-    lib.tipsy_read_dark_particles.restype = decode_err
-    lib.tipsy_read_dark_particles.argtypes = [ctypes.POINTER(tipsy_dark_data)]
+    declare('tipsy_pwrite_gas_fields', [ctypes.c_long, ctypes.POINTER(tipsy_gas_fields), ctypes.c_size_t,
+                                        ctypes.c_size_t])
+    declare('tipsy_pwrite_dark_fields', [ctypes.c_long, ctypes.POINTER(tipsy_dark_fields), ctypes.c_size_t,
+                                         ctypes.c_size_t])
+    declare('tipsy_pwrite_star_fields', [ctypes.c_long, ctypes.POINTER(tipsy_star_fields), ctypes.c_size_t,
+                                         ctypes.c_size_t])
     
-    lib.tipsy_read_gas_particles.restype = decode_err
-    lib.tipsy_read_gas_particles.argtypes = [ctypes.POINTER(tipsy_gas_data)]
+    declare('tipsy_file_read_header', [ctypes.POINTER(tipsy_header)])
+    declare('tipsy_file_read_star_particles', [ctypes.POINTER(tipsy_star_data)])
+    declare('tipsy_file_read_dark_particles', [ctypes.POINTER(tipsy_dark_data)])
+    declare('tipsy_file_read_gas_particles', [ctypes.POINTER(tipsy_gas_data)])
     
-    load_tipsy.lib = lib
     return lib
-load_tipsy.lib = None
\ No newline at end of file
+
+def get_io_stats(handle):
+    """The tipsy_io_stats of an open file as a dict. For internal use only"""
+    stats = tipsy_io_stats()
+    load_tipsy().tipsy_file_io_stats(handle, ctypes.byref(stats))
+    return stats.as_dict()
+
+def open_tipsy_file(filename, mode):
+    """Open a tipsy file and return its handle. For internal use only"""
+    lib = load_tipsy()
+    handle = tipsy_file_p()
+    err = lib.tipsy_open(ctypes.byref(handle), ctypes.c_char_p(bytes(filename, 'utf-8')),
+                         ctypes.c_char_p(bytes(mode, 'utf-8')))
+    if err:
+        msg = '{0:s}: {1:s}'.format(lib.tipsy_error(handle).decode('utf-8'), lib.tipsy_strerror(err).decode('utf-8'))
+        lib.tipsy_close(handle)
+        raise IOError(msg)
+    return handle
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import sys
+
+if sys.version_info.major < 3:
+    print('python3 required!')
+    exit()
+
+import tipsy
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a subset of the particles of a tipsy file to a new tipsy file')
+    parser.add_argument('input', metavar='INPUT', help='tipsy file to read')
+    parser.add_argument('output', metavar='OUTPUT', help='tipsy file to write')
+    parser.add_argument('--species', nargs='+', choices=tipsy.sections, default=list(tipsy.sections),
+                        help='Keep only these particle types')
+    parser.add_argument('--box', nargs=6, type=float, metavar=('X0', 'Y0', 'Z0', 'X1', 'Y1', 'Z1'),
+                        help='Keep only particles with X0 <= x < X1, Y0 <= y < Y1, and Z0 <= z < Z1')
+    parser.add_argument('--downsample', type=int, default=1, metavar='N', help='Keep a random 1/N of the particles')
+    parser.add_argument('--seed', type=int, help='Seed of the random selection made by --downsample')
+    parser.add_argument('--conserve-mass', action='store_true', help='Multiply the masses kept by --downsample by N')
+    format = parser.add_mutually_exclusive_group()
+    format.add_argument('--standard', action='store_const', const=True, dest='standard',
+                        help='Write a big-endian "standard" tipsy file (default: the format of INPUT)')
+    format.add_argument('--native', action='store_const', const=False, dest='standard',
+                        help='Write a tipsy file in the byte order of this machine')
+    parser.add_argument('--block-size', type=int, default=1 << 20, metavar='N',
+                        help='Read at most N particles at a time (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.downsample < 1:
+        parser.error('--downsample must be at least 1')
+    if args.block_size < 1:
+        parser.error('--block-size must be positive')
+
+    box = None if args.box is None else (args.box[:3], args.box[3:])
+    ngas, ndark, nstars = tipsy.subset(args.input, args.output, args.species, box, args.downsample, args.seed,
+                                       args.conserve_mass, args.standard, args.block_size)
+    print('Wrote {0:d} gas, {1:d} dark matter, and {2:d} star particles'.format(ngas, ndark, nstars))
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,152 @@
+#define _POSIX_C_SOURCE 200809L
+
 #include "tipsyio.h"
 #include <errno.h>
+#include <pthread.h>
+#include <stdint.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
+#include <time.h>
+#include <unistd.h>
 
-static const char *tipsy_system_error = NULL;
-static FILE *tipsy_fd = NULL;
-static tipsy_header hdr;
+struct tipsy_file {
+	FILE *       fd;
+	tipsy_header hdr;
 
-static void tipsy_reset_fd(long offset) {
-	rewind(tipsy_fd);
-	int i = fseek(tipsy_fd, offset, SEEK_SET);
-	(void)i;
+	/* Staging buffer used to read or write many particles with a single call */
+	void * buffer;
+	size_t buffer_capacity;
+	size_t buffer_size;
+
+	/* Non-zero if the file is in the opposite byte order to this machine */
+	int swap;
+
+	/* Time and bytes spent in fread/fwrite/pwrite; the lock guards them and 'error' from concurrent pwrites */
+	tipsy_io_stats  stats;
+	pthread_mutex_t stats_lock;
+
+	char error[256];
+};
+
+static size_t tipsy_default_buffer_size = TIPSY_DEFAULT_BUFFER_SIZE;
+
+/* Record the current errno as the last system error of 'f' */
+static int tipsy_fail(tipsy_file *f, int err) {
+	const int e = errno;
+	pthread_mutex_lock(&f->stats_lock);
+	if (e == 0 || strerror_r(e, f->error, sizeof(f->error)) != 0) {
+		snprintf(f->error, sizeof(f->error), "%s", (err == TIPSY_BAD_READ) ? "Unexpected end of file" : "Unknown error");
+	}
+	pthread_mutex_unlock(&f->stats_lock);
+	return err;
+}
+
+/**
+ *	Make sure the staging buffer can hold at least one particle of size 'elem_size'
+ *	and return the number of particles it holds in 'count'.
+ */
+static int tipsy_reserve_buffer(tipsy_file *f, size_t elem_size, size_t *count) {
+	const size_t nbytes = (f->buffer_size > elem_size) ? f->buffer_size : elem_size;
+
+	if (f->buffer_capacity < nbytes) {
+		void *p = realloc(f->buffer, nbytes);
+		if (!p) { return tipsy_fail(f, TIPSY_BAD_ALLOC); }
+		f->buffer          = p;
+		f->buffer_capacity = nbytes;
+	}
+
+	*count = nbytes / elem_size;
+	return 0;
+}
+
+static int tipsy_little_endian() {
+	const uint16_t one = 1;
+	return *(const unsigned char *)&one == 1;
+}
+
+/**
+ *	Reverse the byte order of 'count' 32-bit words at 'buf'. Every particle field
+ *	is a float, so whole blocks of particles are swapped with one call. This is a
+ *	simple loop of shifts that compilers turn into (vectorised) byte swaps.
+ */
+static void tipsy_swap32(void *buf, size_t count) {
+	unsigned char *p = buf;
+	for (size_t i = 0; i < count; ++i, p += 4) {
+		uint32_t w;
+		memcpy(&w, p, 4);
+		w = (w >> 24) | ((w >> 8) & 0xff00u) | ((w << 8) & 0xff0000u) | (w << 24);
+		memcpy(p, &w, 4);
+	}
+}
+
+static void tipsy_swap64(void *buf) {
+	unsigned char *p = buf;
+	for (int i = 0; i < 4; ++i) {
+		const unsigned char c = p[i];
+		p[i]                  = p[7 - i];
+		p[7 - i]              = c;
+	}
+}
+
+/* Convert a header between this machine's byte order and the other */
+static void tipsy_swap_header(tipsy_header *h) {
+	tipsy_swap64(&h->time);
+	tipsy_swap32(&h->nbodies, 5);
+}
+
+static double tipsy_now() {
+	struct timespec t;
+	clock_gettime(CLOCK_MONOTONIC, &t);
+	return (double)t.tv_sec + 1e-9 * (double)t.tv_nsec;
+}
+
+/* Account for a read (or write) of 'nbytes' that started at time 'start' */
+static void tipsy_count_read(tipsy_file *f, double start, size_t nbytes) {
+	f->stats.read_seconds += tipsy_now() - start;
+	f->stats.bytes_read += nbytes;
+	f->stats.reads++;
+}
+
+static void tipsy_count_write(tipsy_file *f, double start, size_t nbytes) {
+	f->stats.write_seconds += tipsy_now() - start;
+	f->stats.bytes_written += nbytes;
+	f->stats.writes++;
+}
+
+/* Read or write whole elements, recording the time spent in the call */
+static size_t tipsy_fread(tipsy_file *f, void *buf, size_t elem_size, size_t count) {
+	const double start = tipsy_now();
+	const size_t n     = fread(buf, elem_size, count, f->fd);
+	tipsy_count_read(f, start, n * elem_size);
+	return n;
+}
+
+static size_t tipsy_fwrite(tipsy_file *f, const void *buf, size_t elem_size, size_t count) {
+	const double start = tipsy_now();
+	const size_t n     = fwrite(buf, elem_size, count, f->fd);
+	tipsy_count_write(f, start, n * elem_size);
+	return n;
+}
+
+static int tipsy_flush_buffer(tipsy_file *f, size_t elem_size, size_t count) {
+	if (f->swap) { tipsy_swap32(f->buffer, elem_size * count / 4); }
+	if (tipsy_fwrite(f, f->buffer, elem_size, count) != count) { return tipsy_fail(f, TIPSY_BAD_WRITE); }
+	return 0;
+}
+
+static int tipsy_fill_buffer(tipsy_file *f, size_t elem_size, size_t count) {
+	errno = 0;
+	if (tipsy_fread(f, f->buffer, elem_size, count) != count) { return tipsy_fail(f, TIPSY_BAD_READ); }
+	if (f->swap) { tipsy_swap32(f->buffer, elem_size * count / 4); }
+	return 0;
 }
 
-const char *tipsy_get_last_system_error() { return tipsy_system_error; }
+static void tipsy_reset_fd(tipsy_file *f, long offset) {
+	rewind(f->fd);
+	int i = fseek(f->fd, offset, SEEK_SET);
+	(void)i;
+}
 
 const char *tipsy_strerror(tipsy_error_t err) {
 	switch (err) {
@@ -27,148 +160,576 @@ const char *tipsy_strerror(tipsy_error_t err) {
 		return "Error writing to Tipsy file";
 	case TIPSY_BAD_READ:
 		return "Error reading from Tipsy file";
+	case TIPSY_BAD_ALLOC:
+		return "Error allocating Tipsy staging buffer";
 	}
 	return "";
 }
 
-int tipsy_open_file(const char *filename, const char *mode) {
-	if (tipsy_fd) return 0;
+/*************************************************************************************************************/
 
-	tipsy_fd = fopen(filename, mode);
+int tipsy_open(tipsy_file **file, const char *filename, const char *mode) {
+	tipsy_file *f = calloc(1, sizeof(tipsy_file));
+	*file         = f;
+	if (!f) { return TIPSY_BAD_ALLOC; }
 
-	if (!tipsy_fd) {
-		tipsy_system_error = strerror(errno);
-		return TIPSY_BAD_OPEN;
-	}
+	f->buffer_size = tipsy_default_buffer_size;
+	pthread_mutex_init(&f->stats_lock, NULL);
+	f->fd = fopen(filename, mode);
+
+	if (!f->fd) { return tipsy_fail(f, TIPSY_BAD_OPEN); }
 
 	return 0;
 }
 
-void tipsy_close_file() {
-	if (tipsy_fd) {
-		fclose(tipsy_fd);
-		tipsy_fd = NULL;
-	}
+void tipsy_close(tipsy_file *f) {
+	if (!f) { return; }
+	if (f->fd) { fclose(f->fd); }
+	pthread_mutex_destroy(&f->stats_lock);
+	free(f->buffer);
+	free(f);
+}
+
+const char *tipsy_error(const tipsy_file *f) { return (f) ? f->error : "Out of memory"; }
+
+int tipsy_fileno(const tipsy_file *f) { return (f && f->fd) ? fileno(f->fd) : -1; }
+
+void tipsy_set_file_buffer_size(tipsy_file *f, size_t nbytes) { f->buffer_size = nbytes; }
+
+void tipsy_set_buffer_size(size_t nbytes) { tipsy_default_buffer_size = nbytes; }
+
+int tipsy_file_seek(tipsy_file *f, long offset) {
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
+
+	errno = 0;
+	if (fseek(f->fd, offset, SEEK_SET) != 0) { return tipsy_fail(f, TIPSY_BAD_WRITE); }
+	return 0;
+}
+
+int tipsy_file_sync(tipsy_file *f) {
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
+
+	errno = 0;
+	if (fflush(f->fd) != 0 || fsync(fileno(f->fd)) != 0) { return tipsy_fail(f, TIPSY_BAD_WRITE); }
+	return 0;
+}
+
+void tipsy_set_file_format(tipsy_file *f, tipsy_format_t format) {
+	f->swap = (format == TIPSY_STANDARD) == tipsy_little_endian();
+}
+
+tipsy_format_t tipsy_file_format(const tipsy_file *f) {
+	return (f->swap == tipsy_little_endian()) ? TIPSY_STANDARD : TIPSY_NATIVE;
+}
+
+void tipsy_file_io_stats(tipsy_file *f, tipsy_io_stats *stats) {
+	pthread_mutex_lock(&f->stats_lock);
+	*stats = f->stats;
+	pthread_mutex_unlock(&f->stats_lock);
 }
 
-FILE *tipsy_get_fd() { return tipsy_fd; }
+void tipsy_reset_io_stats(tipsy_file *f) {
+	pthread_mutex_lock(&f->stats_lock);
+	memset(&f->stats, 0, sizeof(tipsy_io_stats));
+	pthread_mutex_unlock(&f->stats_lock);
+}
 
 /*************************************************************************************************************/
 
-int tipsy_read_header(tipsy_header *h) {
-	if (!tipsy_fd) { return TIPSY_READ_UNOPENED; }
+int tipsy_file_read_header(tipsy_file *f, tipsy_header *h) {
+	if (!f || !f->fd) { return TIPSY_READ_UNOPENED; }
 
-	tipsy_reset_fd(0);
-	if (fread(h, sizeof(tipsy_header), 1, tipsy_fd) != 1) {
-		tipsy_system_error = strerror(errno);
-		return TIPSY_BAD_READ;
-	}
+	tipsy_reset_fd(f, 0);
+	errno = 0;
+	if (tipsy_fread(f, h, sizeof(tipsy_header), 1) != 1) { return tipsy_fail(f, TIPSY_BAD_READ); }
 
-	memcpy(&hdr, h, sizeof(tipsy_header));
+	// Files are always three-dimensional, which tells us their byte order
+	tipsy_header swapped = *h;
+	tipsy_swap_header(&swapped);
+	if (h->ndim != 3 && swapped.ndim == 3) { f->swap = 1; }
+	if (h->ndim == 3) { f->swap = 0; }
+	if (f->swap) { *h = swapped; }
+
+	memcpy(&f->hdr, h, sizeof(tipsy_header));
 
 	return 0;
 }
 
 /**
- * 	  NOTE: These functions all assume that tipsy_read_header has already
+ * 	  NOTE: These functions all assume that tipsy_file_read_header has already
  * 	  		been called. Failure to do so results in undefined behavior.
+ *
+ * 	  Particles are read into the staging buffer one block at a time and
+ * 	  de-interleaved into the output arrays.
   */
 
-int tipsy_read_star_particles(tipsy_star_data *d) {
+static long tipsy_gas_offset() { return (long)sizeof(tipsy_header); }
 
-	if (!tipsy_fd) { return TIPSY_READ_UNOPENED; }
+static long tipsy_dark_offset(const tipsy_header *h) {
+	return tipsy_gas_offset() + (long)h->ngas * (long)sizeof(tipsy_gas_particle);
+}
 
-	tipsy_star_particle p;
-	const size_t size = d->size;
-	const long offset = (int)sizeof(tipsy_header) +
-						hdr.ngas * (int)sizeof(tipsy_gas_particle) +
-					    hdr.ndark * (int)sizeof(tipsy_dark_particle);
-	tipsy_reset_fd(offset);
-	for (size_t i = 0; i < size; ++i) {
-		if (fread(&p, sizeof(tipsy_star_particle), 1, tipsy_fd) != 1) {
-			tipsy_system_error = strerror(errno);
-			return TIPSY_BAD_READ;
+static long tipsy_star_offset(const tipsy_header *h) {
+	return tipsy_dark_offset(h) + (long)h->ndark * (long)sizeof(tipsy_dark_particle);
+}
+
+int tipsy_file_read_star_particles(tipsy_file *f, tipsy_star_data *d) {
+
+	if (!f || !f->fd) { return TIPSY_READ_UNOPENED; }
+
+	size_t count = 0;
+	int    err   = tipsy_reserve_buffer(f, sizeof(tipsy_star_particle), &count);
+	if (err) { return err; }
+
+	const size_t               size = d->size;
+	const tipsy_star_particle *buf  = f->buffer;
+	tipsy_reset_fd(f, tipsy_star_offset(&f->hdr));
+	for (size_t start = 0; start < size; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		if ((err = tipsy_fill_buffer(f, sizeof(tipsy_star_particle), n))) { return err; }
+		for (size_t j = 0; j < n; ++j) {
+			const size_t               i = start + j;
+			const tipsy_star_particle *p = &buf[j];
+			d->mass[i]   = p->mass;
+			d->pos[i][0] = p->pos[0];
+			d->pos[i][1] = p->pos[1];
+			d->pos[i][2] = p->pos[2];
+			d->vel[i][0] = p->vel[0];
+			d->vel[i][1] = p->vel[1];
+			d->vel[i][2] = p->vel[2];
+			d->metals[i] = p->metals;
+			d->tform[i]  = p->tform;
+			d->phi[i]    = p->phi;
 		}
-		d->mass[i]   = p.mass;
-		d->pos[i][0] = p.pos[0];
-		d->pos[i][1] = p.pos[1];
-		d->pos[i][2] = p.pos[2];
-		d->vel[i][0] = p.vel[0];
-		d->vel[i][1] = p.vel[1];
-		d->vel[i][2] = p.vel[2];
-		d->metals[i] = p.metals;
-		d->tform[i]  = p.tform;
-		d->phi[i]    = p.phi;
 	}
+	if (size > 0) { d->soft = buf[0].softening; }
 
 	return 0;
 }
 
-int tipsy_read_dark_particles(tipsy_dark_data *d) {
+int tipsy_file_read_dark_particles(tipsy_file *f, tipsy_dark_data *d) {
+
+	if (!f || !f->fd) { return TIPSY_READ_UNOPENED; }
+
+	size_t count = 0;
+	int    err   = tipsy_reserve_buffer(f, sizeof(tipsy_dark_particle), &count);
+	if (err) { return err; }
+
+	const size_t               size = d->size;
+	const tipsy_dark_particle *buf  = f->buffer;
+	tipsy_reset_fd(f, tipsy_dark_offset(&f->hdr));
+	for (size_t start = 0; start < size; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		if ((err = tipsy_fill_buffer(f, sizeof(tipsy_dark_particle), n))) { return err; }
+		for (size_t j = 0; j < n; ++j) {
+			const size_t               i = start + j;
+			const tipsy_dark_particle *p = &buf[j];
+			d->mass[i]   = p->mass;
+			d->pos[i][0] = p->pos[0];
+			d->pos[i][1] = p->pos[1];
+			d->pos[i][2] = p->pos[2];
+			d->vel[i][0] = p->vel[0];
+			d->vel[i][1] = p->vel[1];
+			d->vel[i][2] = p->vel[2];
+			d->phi[i]    = p->phi;
+		}
+	}
+	if (size > 0) { d->soft = buf[0].softening; }
 
-	if (!tipsy_fd) { return TIPSY_READ_UNOPENED; }
+	return 0;
+}
 
-	tipsy_dark_particle p;
-	const size_t size = d->size;
-	tipsy_reset_fd((int)sizeof(tipsy_header) + hdr.ngas * (int)sizeof(tipsy_gas_particle));
-	for (size_t i = 0; i < size; ++i) {
-		if (fread(&p, sizeof(tipsy_dark_particle), 1, tipsy_fd) != 1) {
-			tipsy_system_error = strerror(errno);
-			return TIPSY_BAD_READ;
+int tipsy_file_read_gas_particles(tipsy_file *f, tipsy_gas_data *d) {
+
+	if (!f || !f->fd) { return TIPSY_READ_UNOPENED; }
+
+	size_t count = 0;
+	int    err   = tipsy_reserve_buffer(f, sizeof(tipsy_gas_particle), &count);
+	if (err) { return err; }
+
+	const size_t              size = d->size;
+	const tipsy_gas_particle *buf  = f->buffer;
+	tipsy_reset_fd(f, tipsy_gas_offset());
+	for (size_t start = 0; start < size; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		if ((err = tipsy_fill_buffer(f, sizeof(tipsy_gas_particle), n))) { return err; }
+		for (size_t j = 0; j < n; ++j) {
+			const size_t              i = start + j;
+			const tipsy_gas_particle *p = &buf[j];
+			d->mass[i]    = p->mass;
+			d->pos[i][0]  = p->pos[0];
+			d->pos[i][1]  = p->pos[1];
+			d->pos[i][2]  = p->pos[2];
+			d->vel[i][0]  = p->vel[0];
+			d->vel[i][1]  = p->vel[1];
+			d->vel[i][2]  = p->vel[2];
+			d->rho[i]     = p->rho;
+			d->temp[i]    = p->temp;
+			d->hsmooth[i] = p->hsmooth;
+			d->metals[i]  = p->metals;
+			d->phi[i]     = p->phi;
 		}
-		d->mass[i]   = p.mass;
-		d->pos[i][0] = p.pos[0];
-		d->pos[i][1] = p.pos[1];
-		d->pos[i][2] = p.pos[2];
-		d->vel[i][0] = p.vel[0];
-		d->vel[i][1] = p.vel[1];
-		d->vel[i][2] = p.vel[2];
-		d->phi[i]    = p.phi;
 	}
 
 	return 0;
 }
 
-int tipsy_read_gas_particles(tipsy_gas_data *d) {
+/*************************************************************************************************************/
+
+int tipsy_file_write_header(tipsy_file *f, double time, int ngas, int ndark, int nstar) {
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
+
+	// Zero the structure padding so the output is reproducible
+	tipsy_header h;
+	memset(&h, 0, sizeof(tipsy_header));
+	h.time    = time;
+	h.nbodies = ngas + ndark + nstar;
+	h.ndim    = 3;
+	h.ngas    = ngas;
+	h.ndark   = ndark;
+	h.nstar   = nstar;
+	if (f->swap) { tipsy_swap_header(&h); }
+	if (tipsy_fwrite(f, &h, sizeof(tipsy_header), 1) != 1) { return tipsy_fail(f, TIPSY_BAD_WRITE); }
 
-	if (!tipsy_fd) { return TIPSY_READ_UNOPENED; }
+	return 0;
+}
 
-	tipsy_gas_particle p;
-	const size_t size = d->size;
-	tipsy_reset_fd(sizeof(tipsy_header));
-	for (size_t i = 0; i < size; ++i) {
-		if (fread(&p, sizeof(tipsy_gas_particle), 1, tipsy_fd) != 1) {
-			tipsy_system_error = strerror(errno);
-			return TIPSY_BAD_READ;
-		}
-		d->mass[i]   = p.mass;
-		d->pos[i][0] = p.pos[0];
-		d->pos[i][1] = p.pos[1];
-		d->pos[i][2] = p.pos[2];
-		d->vel[i][0] = p.vel[0];
-		d->vel[i][1] = p.vel[1];
-		d->vel[i][2] = p.vel[2];
-		d->metals[i] = p.metals;
-		d->phi[i]    = p.phi;
+/**
+ *	The particle writers convert the input fields into the staging buffer and
+ *	write it out one block at a time. With a buffer size of zero, each block
+ *	holds a single particle.
+ */
+
+/* Component 'c' of particle 'i' of 'f', or 'missing' if the field is absent */
+static inline float tipsy_get(const tipsy_field *f, size_t i, long c, float missing) {
+	if (!f->data) { return missing; }
+	const char *p = (const char *)f->data + (long)i * f->stride + c * f->component_stride;
+	// Scale in double precision so the result is rounded to float only once
+	const double v = (f->type == TIPSY_DOUBLE) ? *(const double *)p : (double)*(const float *)p;
+	return (float)(v * f->scale);
+}
+
+static void tipsy_pack_gas(tipsy_gas_particle *buf, const size_t start, const size_t n, const tipsy_gas_fields *d) {
+	for (size_t j = 0; j < n; ++j) {
+		const size_t        i = start + j;
+		tipsy_gas_particle *p = &buf[j];
+		p->mass    = tipsy_get(&d->mass, i, 0, 0.0f);
+		p->pos[0]  = tipsy_get(&d->pos, i, 0, 0.0f);
+		p->pos[1]  = tipsy_get(&d->pos, i, 1, 0.0f);
+		p->pos[2]  = tipsy_get(&d->pos, i, 2, 0.0f);
+		p->vel[0]  = tipsy_get(&d->vel, i, 0, 0.0f);
+		p->vel[1]  = tipsy_get(&d->vel, i, 1, 0.0f);
+		p->vel[2]  = tipsy_get(&d->vel, i, 2, 0.0f);
+		p->rho     = tipsy_get(&d->rho, i, 0, 0.0f);
+		p->temp    = tipsy_get(&d->temp, i, 0, 0.0f);
+		p->hsmooth = tipsy_get(&d->hsmooth, i, 0, 0.0f);
+		p->metals  = tipsy_get(&d->metals, i, 0, 0.0f);
+		p->phi     = tipsy_get(&d->phi, i, 0, 0.0f);
+	}
+}
+
+static void tipsy_pack_dark(tipsy_dark_particle *buf, const size_t start, const size_t n, const tipsy_dark_fields *d) {
+	for (size_t j = 0; j < n; ++j) {
+		const size_t         i = start + j;
+		tipsy_dark_particle *p = &buf[j];
+		p->mass      = tipsy_get(&d->mass, i, 0, 0.0f);
+		p->pos[0]    = tipsy_get(&d->pos, i, 0, 0.0f);
+		p->pos[1]    = tipsy_get(&d->pos, i, 1, 0.0f);
+		p->pos[2]    = tipsy_get(&d->pos, i, 2, 0.0f);
+		p->vel[0]    = tipsy_get(&d->vel, i, 0, 0.0f);
+		p->vel[1]    = tipsy_get(&d->vel, i, 1, 0.0f);
+		p->vel[2]    = tipsy_get(&d->vel, i, 2, 0.0f);
+		p->softening = d->softening;
+		p->phi       = tipsy_get(&d->phi, i, 0, 0.0f);
+	}
+}
+
+static void tipsy_pack_star(tipsy_star_particle *buf, const size_t start, const size_t n, const tipsy_star_fields *d) {
+	// Negative tForm signals black hole to GASOLINE
+	const float tform_default = (d->is_blackhole) ? -1.0f : 0.0f;
+
+	for (size_t j = 0; j < n; ++j) {
+		const size_t         i = start + j;
+		tipsy_star_particle *p = &buf[j];
+		p->mass      = tipsy_get(&d->mass, i, 0, 0.0f);
+		p->pos[0]    = tipsy_get(&d->pos, i, 0, 0.0f);
+		p->pos[1]    = tipsy_get(&d->pos, i, 1, 0.0f);
+		p->pos[2]    = tipsy_get(&d->pos, i, 2, 0.0f);
+		p->vel[0]    = tipsy_get(&d->vel, i, 0, 0.0f);
+		p->vel[1]    = tipsy_get(&d->vel, i, 1, 0.0f);
+		p->vel[2]    = tipsy_get(&d->vel, i, 2, 0.0f);
+		p->softening = d->softening;
+		p->metals    = tipsy_get(&d->metals, i, 0, 0.0f);
+		p->tform     = tipsy_get(&d->tform, i, 0, tform_default);
+		p->phi       = tipsy_get(&d->phi, i, 0, 0.0f);
+	}
+}
+
+int tipsy_file_write_gas_fields(tipsy_file *f, const tipsy_gas_fields *d, const size_t size) {
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
+
+	size_t count = 0;
+	int    err   = tipsy_reserve_buffer(f, sizeof(tipsy_gas_particle), &count);
+	if (err) { return err; }
+
+	for (size_t start = 0; start < size; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		tipsy_pack_gas(f->buffer, start, n, d);
+		if ((err = tipsy_flush_buffer(f, sizeof(tipsy_gas_particle), n))) { return err; }
 	}
 
 	return 0;
 }
 
-/*************************************************************************************************************/
+int tipsy_file_write_dark_fields(tipsy_file *f, const tipsy_dark_fields *d, const size_t size) {
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
 
-int tipsy_write_header(double time, int ngas, int ndark, int nstar) {
-	if (!tipsy_fd) { return TIPSY_WRITE_UNOPENED; }
+	size_t count = 0;
+	int    err   = tipsy_reserve_buffer(f, sizeof(tipsy_dark_particle), &count);
+	if (err) { return err; }
+
+	for (size_t start = 0; start < size; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		tipsy_pack_dark(f->buffer, start, n, d);
+		if ((err = tipsy_flush_buffer(f, sizeof(tipsy_dark_particle), n))) { return err; }
+	}
 
-	tipsy_header h = {time, ngas + ndark + nstar, 3, ngas, ndark, nstar};
-	if (fwrite(&h, sizeof(tipsy_header), 1, tipsy_fd) != 1) {
-		tipsy_system_error = strerror(errno);
-		return TIPSY_BAD_WRITE;
+	return 0;
+}
+
+int tipsy_file_write_star_fields(tipsy_file *f, const tipsy_star_fields *d, const size_t size) {
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
+
+	size_t count = 0;
+	int    err   = tipsy_reserve_buffer(f, sizeof(tipsy_star_particle), &count);
+	if (err) { return err; }
+
+	for (size_t start = 0; start < size; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		tipsy_pack_star(f->buffer, start, n, d);
+		if ((err = tipsy_flush_buffer(f, sizeof(tipsy_star_particle), n))) { return err; }
 	}
 
 	return 0;
 }
 
+/* A field of contiguous floats with 'ncomp' components, or a repeated value if 'stride' is zero */
+static tipsy_field tipsy_float_field(const void *data, size_t stride, long ncomp) {
+	tipsy_field f = {data, (long)stride * ncomp * (long)sizeof(float), (long)sizeof(float), TIPSY_FLOAT, 1.0};
+	return f;
+}
+
+int tipsy_file_write_gas_particles(tipsy_file * f,
+				   const float *mass,
+				   const size_t mass_stride,
+				   const float (*pos)[3],
+				   const float (*vel)[3],
+				   const float *rho,
+				   const float *temp,
+				   const float *hsmooth,
+				   const float *metals,
+				   const float *phi,
+				   const size_t size) {
+
+	const tipsy_gas_fields d = {
+	    tipsy_float_field(mass, mass_stride, 1), tipsy_float_field(pos, 1, 3),    tipsy_float_field(vel, 1, 3),
+	    tipsy_float_field(rho, 1, 1),            tipsy_float_field(temp, 1, 1),   tipsy_float_field(hsmooth, 1, 1),
+	    tipsy_float_field(metals, 1, 1),         tipsy_float_field(phi, 1, 1),
+	};
+	return tipsy_file_write_gas_fields(f, &d, size);
+}
+
+int tipsy_file_write_dark_particles(tipsy_file * f,
+				    const float *mass,
+				    const size_t mass_stride,
+				    const float (*pos)[3],
+				    const float (*vel)[3],
+				    const float *phi,
+				    const float  softening,
+				    const size_t size) {
+
+	const tipsy_dark_fields d = {
+	    tipsy_float_field(mass, mass_stride, 1), tipsy_float_field(pos, 1, 3), tipsy_float_field(vel, 1, 3),
+	    tipsy_float_field(phi, 1, 1),            softening,
+	};
+	return tipsy_file_write_dark_fields(f, &d, size);
+}
+
+int tipsy_file_write_star_particles(tipsy_file * f,
+				    const float *mass,
+				    const size_t mass_stride,
+				    const float (*pos)[3],
+				    const float (*vel)[3],
+				    const float *metals,
+				    const float *tform,
+				    const float *phi,
+				    const float  softening,
+				    const size_t size,
+				    const int    is_blackhole) {
+
+	const tipsy_star_fields d = {
+	    tipsy_float_field(mass, mass_stride, 1), tipsy_float_field(pos, 1, 3),   tipsy_float_field(vel, 1, 3),
+	    tipsy_float_field(metals, 1, 1),         tipsy_float_field(tform, 1, 1), tipsy_float_field(phi, 1, 1),
+	    softening,                               is_blackhole,
+	};
+	return tipsy_file_write_star_fields(f, &d, size);
+}
+
+/*************************************************************************************************************/
+
+/**
+ *	Positional writers
+ *
+ *	These write particles at byte 'offset' of the file with pwrite and never touch
+ *	the stream position or staging buffer of 'f', so any number of them may run
+ *	concurrently on disjoint regions of the same file. Each call allocates its own
+ *	staging buffer of 'buffer_size' bytes.
+ */
+
+static int tipsy_pwrite_all(tipsy_file *f, const void *buf, size_t nbytes, long offset) {
+	const int    fd    = fileno(f->fd);
+	const char * p     = buf;
+	const size_t total = nbytes;
+	const double start = tipsy_now();
+	int          err   = 0;
+	while (nbytes > 0) {
+		const ssize_t n = pwrite(fd, p, nbytes, (off_t)offset);
+		if (n < 0) {
+			if (errno == EINTR) { continue; }
+			err = tipsy_fail(f, TIPSY_BAD_WRITE);
+			break;
+		}
+		p += n;
+		nbytes -= (size_t)n;
+		offset += (long)n;
+	}
+
+	pthread_mutex_lock(&f->stats_lock);
+	tipsy_count_write(f, start, total - nbytes);
+	pthread_mutex_unlock(&f->stats_lock);
+	return err;
+}
+
+static void *tipsy_alloc_buffer(tipsy_file *f, size_t elem_size, size_t buffer_size, size_t *count) {
+	const size_t nbytes = (buffer_size > elem_size) ? buffer_size : elem_size;
+	void *       buf    = malloc(nbytes);
+	if (!buf) { tipsy_fail(f, TIPSY_BAD_ALLOC); }
+	*count = nbytes / elem_size;
+	return buf;
+}
+
+int tipsy_pwrite_gas_fields(
+    tipsy_file *f, long offset, const tipsy_gas_fields *d, const size_t size, const size_t buffer_size) {
+
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
+
+	size_t              count = 0;
+	tipsy_gas_particle *buf   = tipsy_alloc_buffer(f, sizeof(tipsy_gas_particle), buffer_size, &count);
+	if (!buf) { return TIPSY_BAD_ALLOC; }
+
+	int err = 0;
+	for (size_t start = 0; start < size && !err; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		tipsy_pack_gas(buf, start, n, d);
+		if (f->swap) { tipsy_swap32(buf, n * sizeof(tipsy_gas_particle) / 4); }
+		err = tipsy_pwrite_all(f, buf, n * sizeof(tipsy_gas_particle),
+				       offset + (long)(start * sizeof(tipsy_gas_particle)));
+	}
+
+	free(buf);
+	return err;
+}
+
+int tipsy_pwrite_dark_fields(
+    tipsy_file *f, long offset, const tipsy_dark_fields *d, const size_t size, const size_t buffer_size) {
+
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
+
+	size_t               count = 0;
+	tipsy_dark_particle *buf   = tipsy_alloc_buffer(f, sizeof(tipsy_dark_particle), buffer_size, &count);
+	if (!buf) { return TIPSY_BAD_ALLOC; }
+
+	int err = 0;
+	for (size_t start = 0; start < size && !err; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		tipsy_pack_dark(buf, start, n, d);
+		if (f->swap) { tipsy_swap32(buf, n * sizeof(tipsy_dark_particle) / 4); }
+		err = tipsy_pwrite_all(f, buf, n * sizeof(tipsy_dark_particle),
+				       offset + (long)(start * sizeof(tipsy_dark_particle)));
+	}
+
+	free(buf);
+	return err;
+}
+
+int tipsy_pwrite_star_fields(
+    tipsy_file *f, long offset, const tipsy_star_fields *d, const size_t size, const size_t buffer_size) {
+
+	if (!f || !f->fd) { return TIPSY_WRITE_UNOPENED; }
+
+	size_t               count = 0;
+	tipsy_star_particle *buf   = tipsy_alloc_buffer(f, sizeof(tipsy_star_particle), buffer_size, &count);
+	if (!buf) { return TIPSY_BAD_ALLOC; }
+
+	int err = 0;
+	for (size_t start = 0; start < size && !err; start += count) {
+		const size_t n = (size - start < count) ? size - start : count;
+		tipsy_pack_star(buf, start, n, d);
+		if (f->swap) { tipsy_swap32(buf, n * sizeof(tipsy_star_particle) / 4); }
+		err = tipsy_pwrite_all(f, buf, n * sizeof(tipsy_star_particle),
+				       offset + (long)(start * sizeof(tipsy_star_particle)));
+	}
+
+	free(buf);
+	return err;
+}
+
+/*************************************************************************************************************/
+
+/**
+ *	Single-file interface
+ *
+ *	These operate on one process-wide file and are kept for existing callers.
+ *	They are not thread-safe; use the tipsy_file functions above instead.
+ */
+
+static tipsy_file *tipsy_global = NULL;
+static char        tipsy_open_error[256];
+
+int tipsy_open_file(const char *filename, const char *mode) {
+	if (tipsy_global) return 0;
+
+	const int err = tipsy_open(&tipsy_global, filename, mode);
+	if (err) {
+		snprintf(tipsy_open_error, sizeof(tipsy_open_error), "%s", tipsy_error(tipsy_global));
+		tipsy_close(tipsy_global);
+		tipsy_global = NULL;
+	}
+
+	return err;
+}
+
+void tipsy_close_file() {
+	tipsy_close(tipsy_global);
+	tipsy_global = NULL;
+}
+
+FILE *tipsy_get_fd() { return (tipsy_global) ? tipsy_global->fd : NULL; }
+
+const char *tipsy_get_last_system_error() { return (tipsy_global) ? tipsy_global->error : tipsy_open_error; }
+
+int tipsy_read_header(tipsy_header *h) { return tipsy_file_read_header(tipsy_global, h); }
+
+int tipsy_read_star_particles(tipsy_star_data *d) { return tipsy_file_read_star_particles(tipsy_global, d); }
+
+int tipsy_read_dark_particles(tipsy_dark_data *d) { return tipsy_file_read_dark_particles(tipsy_global, d); }
+
+int tipsy_read_gas_particles(tipsy_gas_data *d) { return tipsy_file_read_gas_particles(tipsy_global, d); }
+
+int tipsy_write_header(double time, int ngas, int ndark, int nstar) {
+	return tipsy_file_write_header(tipsy_global, time, ngas, ndark, nstar);
+}
+
 int tipsy_write_gas_particles(const float *mass,
 			      const float (*pos)[3],
 			      const float (*vel)[3],
@@ -176,63 +737,18 @@ int tipsy_write_gas_particles(const float *mass,
 			      const float *temp,
 			      const float *hsmooth,
 			      const float *metals,
-				  const float *phi,
+			      const float *phi,
 			      const size_t size) {
-
-	if (!tipsy_fd) { return TIPSY_WRITE_UNOPENED; }
-
-	tipsy_gas_particle p;
-	for (size_t i = 0; i < size; ++i) {
-		p.mass    = mass[i];
-		p.pos[0]  = pos[i][0];
-		p.pos[1]  = pos[i][1];
-		p.pos[2]  = pos[i][2];
-		p.vel[0]  = vel[i][0];
-		p.vel[1]  = vel[i][1];
-		p.vel[2]  = vel[i][2];
-		p.rho     = rho[i];
-		p.temp    = temp[i];
-		p.hsmooth = hsmooth[i];
-		p.metals  = (metals) ? metals[i] : 0.0f;
-		p.phi     = (phi) ? phi[i] : 0.0f;
-
-		if (fwrite(&p, sizeof(tipsy_gas_particle), 1, tipsy_fd) != 1) {
-			tipsy_system_error = strerror(errno);
-			return TIPSY_BAD_WRITE;
-		}
-	}
-
-	return 0;
+	return tipsy_file_write_gas_particles(tipsy_global, mass, 1, pos, vel, rho, temp, hsmooth, metals, phi, size);
 }
 
 int tipsy_write_dark_particles(const float *mass,
 			       const float (*pos)[3],
 			       const float (*vel)[3],
-				   const float *phi,
+			       const float *phi,
 			       const float  softening,
 			       const size_t size) {
-
-	if (!tipsy_fd) { return TIPSY_WRITE_UNOPENED; }
-
-	tipsy_dark_particle p;
-	for (size_t i = 0; i < size; ++i) {
-		p.mass      = mass[i];
-		p.pos[0]    = pos[i][0];
-		p.pos[1]    = pos[i][1];
-		p.pos[2]    = pos[i][2];
-		p.vel[0]    = vel[i][0];
-		p.vel[1]    = vel[i][1];
-		p.vel[2]    = vel[i][2];
-		p.softening = softening;
-		p.phi       = (phi) ? phi[i] : 0.0f;
-
-		if (fwrite(&p, sizeof(tipsy_dark_particle), 1, tipsy_fd) != 1) {
-			tipsy_system_error = strerror(errno);
-			return TIPSY_BAD_WRITE;
-		}
-	}
-
-	return 0;
+	return tipsy_file_write_dark_particles(tipsy_global, mass, 1, pos, vel, phi, softening, size);
 }
 
 int tipsy_write_star_particles(const float *mass,
@@ -240,36 +756,10 @@ int tipsy_write_star_particles(const float *mass,
 			       const float (*vel)[3],
 			       const float *metals,
 			       const float *tform,
-				   const float *phi,
-			       const float	softening,
+			       const float *phi,
+			       const float  softening,
 			       const size_t size,
-				   const int	is_blackhole) {
-
-	if (!tipsy_fd) { return TIPSY_WRITE_UNOPENED; }
-
-	// Negative tForm signals black hole to GASOLINE
-	const float tform_default = (is_blackhole) ? -1.0 : 0.0;
-
-	tipsy_star_particle p;
-	for (size_t i = 0; i < size; ++i) {
-		p.mass      = mass[i];
-		p.pos[0]    = pos[i][0];
-		p.pos[1]    = pos[i][1];
-		p.pos[2]    = pos[i][2];
-		p.vel[0]    = vel[i][0];
-		p.vel[1]    = vel[i][1];
-		p.vel[2]    = vel[i][2];
-		p.softening = softening;
-		p.metals    = (metals) ? metals[i] : 0.0f;
-		p.tform     = (tform) ? tform[i] : tform_default;
-		p.phi       = (phi) ? phi[i] : 0.0f;
-
-		if (fwrite(&p, sizeof(tipsy_star_particle), 1, tipsy_fd) != 1) {
-			tipsy_system_error = strerror(errno);
-			return TIPSY_BAD_WRITE;
-		}
-	}
-
-	return 0;
+			       const int    is_blackhole) {
+	return tipsy_file_write_star_particles(tipsy_global, mass, 1, pos, vel, metals, tform, phi, softening, size,
+					       is_blackhole);
 }
-
@@ -4,20 +4,189 @@
 #include <stdio.h>
 #include <stddef.h>
 
+// Default size (in bytes) of the staging buffer used for block I/O
+#define TIPSY_DEFAULT_BUFFER_SIZE (4u << 20)
+
 // Convention: Positive are system errors, negative are Tipsy errors
 typedef enum {
 	TIPSY_BAD_OPEN       = 1,  /* Error opening file */
 	TIPSY_BAD_WRITE      = 2,  /* Bad write to file */
 	TIPSY_BAD_READ       = 3,  /* Bad read from file */
+	TIPSY_BAD_ALLOC      = 4,  /* Error allocating staging buffer */
 	TIPSY_READ_UNOPENED  = -1, /* Read from unopened file */
 	TIPSY_WRITE_UNOPENED = -2, /* Write to unopened file */
 } tipsy_error_t;
 
+/**
+ *	On-disk formats. Native files use this machine's byte order; standard files
+ *	are big-endian, as read by ChaNGa and pynbody by default. Both have a 28-byte
+ *	header padded to 32 bytes.
+ */
+typedef enum {
+	TIPSY_NATIVE   = 0,
+	TIPSY_STANDARD = 1,
+} tipsy_format_t;
+
+const char *tipsy_strerror(tipsy_error_t);
+void	tipsy_set_buffer_size(size_t);
+
+/**
+ *	Handle-based interface
+ *
+ *	Each open file has its own stream, header, staging buffer, and error message,
+ *	so different files can be used concurrently from different threads. A single
+ *	tipsy_file must not be used by more than one thread at a time, except through
+ *	the tipsy_pwrite_* functions.
+ *
+ *	tipsy_open always stores a handle in its first argument, even on failure, so
+ *	that tipsy_error can report why. It must be released with tipsy_close.
+ */
+typedef struct tipsy_file tipsy_file;
+
+int	 tipsy_open(tipsy_file **, const char *filename, const char *mode);
+void	tipsy_close(tipsy_file *);
+const char *tipsy_error(const tipsy_file *);
+int	 tipsy_fileno(const tipsy_file *);
+void	tipsy_set_file_buffer_size(tipsy_file *, size_t);
+
+/**
+ *	Move the stream of 'f' to byte 'offset', e.g. to continue writing a file
+ *	opened with mode "r+b" after the particles already in it.
+ */
+int tipsy_file_seek(tipsy_file *, long offset);
+
+/**
+ *	Write everything written to 'f' so far through to the disk (fflush and
+ *	fsync), so that it survives the process or the machine failing.
+ */
+int tipsy_file_sync(tipsy_file *);
+
+/**
+ *	Files are written in the native format unless set otherwise before writing.
+ *	tipsy_file_read_header detects the format of the file being read.
+ */
+void	   tipsy_set_file_format(tipsy_file *, tipsy_format_t);
+tipsy_format_t tipsy_file_format(const tipsy_file *);
+
+/**
+ *	Time spent in, and bytes moved by, the fread/fwrite/pwrite calls made for a
+ *	file since it was opened or the statistics were last reset. Times are wall
+ *	times in seconds; concurrent pwrites each count their own time.
+ */
+typedef struct {
+	double             read_seconds;
+	double             write_seconds;
+	unsigned long long bytes_read;
+	unsigned long long bytes_written;
+	unsigned long long reads;
+	unsigned long long writes;
+} tipsy_io_stats;
+
+void tipsy_file_io_stats(tipsy_file *, tipsy_io_stats *);
+void tipsy_reset_io_stats(tipsy_file *);
+
+int tipsy_file_read_header(tipsy_file *, tipsy_header *);
+int tipsy_file_read_star_particles(tipsy_file *, tipsy_star_data *);
+int tipsy_file_read_dark_particles(tipsy_file *, tipsy_dark_data *);
+int tipsy_file_read_gas_particles(tipsy_file *, tipsy_gas_data *);
+
+int tipsy_file_write_header(tipsy_file *, double time, int ngas, int ndark, int nstar);
+
+/**
+ *	Input fields of the *_fields writers
+ *
+ *	Component c of particle i is read from 'data' + i * 'stride' + c * 'component_stride'
+ *	(in bytes) as a float or double, multiplied by 'scale', and stored as a float.
+ *	A stride of zero gives every particle the same value, and a NULL 'data' gives
+ *	the default for the field (zero, or -1 for the tform of black holes).
+ */
+typedef enum {
+	TIPSY_FLOAT  = 0,
+	TIPSY_DOUBLE = 1,
+} tipsy_type_t;
+
+typedef struct {
+	const void *data;
+	long        stride;
+	long        component_stride;
+	int         type;
+	double      scale;
+} tipsy_field;
+
+typedef struct {
+	tipsy_field mass, pos, vel, rho, temp, hsmooth, metals, phi;
+} tipsy_gas_fields;
+
+typedef struct {
+	tipsy_field mass, pos, vel, phi;
+	float       softening;
+} tipsy_dark_fields;
+
+typedef struct {
+	tipsy_field mass, pos, vel, metals, tform, phi;
+	float       softening;
+	int         is_blackhole;
+} tipsy_star_fields;
+
+int tipsy_file_write_gas_fields(tipsy_file *, const tipsy_gas_fields *, const size_t size);
+int tipsy_file_write_dark_fields(tipsy_file *, const tipsy_dark_fields *, const size_t size);
+int tipsy_file_write_star_fields(tipsy_file *, const tipsy_star_fields *, const size_t size);
+
+/**
+ *	Writers for contiguous float arrays. Particle i has mass mass[i * mass_stride];
+ *	a 'mass_stride' of zero gives every particle the mass mass[0].
+ */
+int tipsy_file_write_gas_particles(tipsy_file * f,
+				   const float *mass,
+				   const size_t mass_stride,
+				   const float (*pos)[3],
+				   const float (*vel)[3],
+				   const float *rho,
+				   const float *temp,
+				   const float *hsmooth,
+				   const float *metals,
+				   const float *phi,
+				   const size_t size);
+
+int tipsy_file_write_dark_particles(tipsy_file * f,
+				    const float *mass,
+				    const size_t mass_stride,
+				    const float (*pos)[3],
+				    const float (*vel)[3],
+				    const float *phi,
+				    const float  softening,
+				    const size_t size);
+
+int tipsy_file_write_star_particles(tipsy_file * f,
+				    const float *mass,
+				    const size_t mass_stride,
+				    const float (*pos)[3],
+				    const float (*vel)[3],
+				    const float *metals,
+				    const float *tform,
+				    const float *phi,
+				    const float  softening,
+				    const size_t size,
+				    const int    is_blackhole);
+
+/**
+ *	Thread-safe positional writers. 'offset' is the byte offset in the file
+ *	at which to write the first particle.
+ */
+int tipsy_pwrite_gas_fields(tipsy_file *, long offset, const tipsy_gas_fields *, const size_t size,
+			    const size_t buffer_size);
+int tipsy_pwrite_dark_fields(tipsy_file *, long offset, const tipsy_dark_fields *, const size_t size,
+			     const size_t buffer_size);
+int tipsy_pwrite_star_fields(tipsy_file *, long offset, const tipsy_star_fields *, const size_t size,
+			     const size_t buffer_size);
+
+/**
+ *	Single-file interface (not thread-safe)
+ */
 int	 tipsy_open_file(const char *, const char *);
 void	tipsy_close_file();
 FILE *      tipsy_get_fd();
 const char *tipsy_get_last_system_error();
-const char *tipsy_strerror(tipsy_error_t);
 
 int tipsy_read_header(tipsy_header *);
 int tipsy_read_star_particles(tipsy_star_data *);
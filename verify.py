@@ -0,0 +1,225 @@
+"""
+    Check a tipsy file written by gadget2changa against its GADGET snapshot
+
+    The particle types of the snapshot are split into blocks, and a pool of
+    worker processes each read a block from both files. A worker converts its
+    GADGET particles exactly as gadget2changa does, but hands them to a
+    comparer (which has the interface of tipsy.streaming_writer) rather than
+    a writer. The comparer checks every field against the tipsy records at
+    the same place. Errors are measured against the scaled values in double
+    precision, before they are rounded to the float32 of the tipsy file.
+    Meanwhile, the main process computes the SHA-256 of the tipsy file.
+"""
+
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+
+import gadget
+import gadget2changa
+import tipsy
+
+class comparer:
+    """Compare particles with the records of a tipsy file, with the interface of tipsy.streaming_writer
+
+    Particles given to gas, darkmatter, or stars are compared with the records
+    of that section from record 'first' on. A value is wrong if it differs
+    from the expected one by more than 'atol' + 'rtol' * |expected|. For each
+    field, 'errors' holds the largest absolute and relative errors, the number
+    of wrong values, and the number of values compared.
+    """
+    def __init__(self, tipsy_file, first, rtol=1e-6, atol=0.0):
+        self.file = tipsy_file
+        self.first = first
+        self.rtol = rtol
+        self.atol = atol
+        self.errors = {}
+
+    def _compare(self, records, field, value, scale=1.0, missing=0.0):
+        """For internal use only"""
+        actual = records[field].astype(np.float64)
+        if value is None:
+            # The writers store 'missing' for absent fields
+            expected = np.full(actual.shape, missing)
+        else:
+            expected = np.broadcast_to(np.asarray(value, dtype=np.float64) * scale, actual.shape)
+
+        diff = np.abs(actual - expected)
+        magnitude = np.abs(expected)
+        relative = np.divide(diff, magnitude, out=np.zeros_like(diff), where=magnitude > 0.0)
+        same = (actual == expected) | (np.isnan(actual) & np.isnan(expected))
+        wrong = ~same & ~(diff <= self.atol + self.rtol * magnitude)
+
+        e = self.errors.setdefault(field, [0.0, 0.0, 0, 0])
+        e[0] = float(np.fmax(e[0], np.nanmax(diff, initial=0.0)))
+        e[1] = float(np.fmax(e[1], np.nanmax(relative, initial=0.0)))
+        e[2] += int(np.count_nonzero(wrong))
+        e[3] += diff.size
+
+    def _records(self, section, size):
+        """For internal use only"""
+        records = getattr(self.file, section)[self.first:self.first + size]
+        if len(records) != size:
+            raise ValueError('the tipsy file has fewer {0:s} particles than the snapshot'.format(section))
+        return records
+
+    def gas(self, mass, pos, vel, rho, temp, hsmooth, metals, phi, size, mass_scale=1.0, velocity_scale=1.0):
+        r = self._records('gas', size)
+        self._compare(r, 'mass', mass, mass_scale)
+        self._compare(r, 'pos', pos)
+        self._compare(r, 'vel', vel, velocity_scale)
+        self._compare(r, 'rho', rho)
+        self._compare(r, 'temp', temp)
+        self._compare(r, 'hsmooth', hsmooth)
+        self._compare(r, 'metals', metals)
+        self._compare(r, 'phi', phi)
+
+    def darkmatter(self, mass, pos, vel, phi, softening, size, mass_scale=1.0, velocity_scale=1.0):
+        r = self._records('darkmatter', size)
+        self._compare(r, 'mass', mass, mass_scale)
+        self._compare(r, 'pos', pos)
+        self._compare(r, 'vel', vel, velocity_scale)
+        self._compare(r, 'softening', np.float32(softening))
+        self._compare(r, 'phi', phi)
+
+    def stars(self, mass, pos, vel, metals, tform, phi, softening, size, is_blackhole=False, mass_scale=1.0,
+              velocity_scale=1.0):
+        r = self._records('stars', size)
+        self._compare(r, 'mass', mass, mass_scale)
+        self._compare(r, 'pos', pos)
+        self._compare(r, 'vel', vel, velocity_scale)
+        self._compare(r, 'metals', metals)
+        # Negative formation times mark black holes
+        self._compare(r, 'tform', tform, missing=-1.0 if is_blackhole else 0.0)
+        self._compare(r, 'softening', np.float32(softening))
+        self._compare(r, 'phi', phi)
+
+def merge(errors, more):
+    """Add the errors of a comparer ('more') to 'errors'"""
+    for field, (max_abs, max_rel, wrong, count) in more.items():
+        e = errors.setdefault(field, [0.0, 0.0, 0, 0])
+        e[0] = max(e[0], max_abs)
+        e[1] = max(e[1], max_rel)
+        e[2] += wrong
+        e[3] += count
+
+# The open files and conversion jobs of a worker process
+_worker = {}
+
+def _open_worker(gadget_fname, gadget_params, mass_scale, args, tipsy_fname, rtol, atol):
+    """Open both files in a worker process. For internal use only"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        gadget_file = gadget.File(gadget_fname)
+        _worker['jobs'] = gadget2changa.conversion_jobs(gadget_file, gadget_params, mass_scale, args)
+    _worker['gadget'] = gadget_file
+    _worker['tipsy'] = tipsy.File(tipsy_fname, memmap=True)
+    _worker['tolerances'] = (rtol, atol)
+
+def _verify_block(index, start, stop, first):
+    """Compare particles [start, stop) of job 'index' with the tipsy records from 'first' on. For internal use only"""
+    _, particles, _, extra, write = _worker['jobs'][index]
+    block = type(particles)(particles.data, particles.mass_table_entry, particles.header, start, stop)
+    compare = comparer(_worker['tipsy'], first, *_worker['tolerances'])
+    # Fields missing from the snapshot have already been reported by the main process
+    with contextlib.redirect_stdout(io.StringIO()):
+        out = None if extra is None else extra(block, np.empty(block.size, dtype=np.float32))
+        write(compare, block, out)
+    return compare.errors
+
+def checksum(fname, block_size=16 << 20):
+    """SHA-256 of the file 'fname', as hex"""
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def verify(gadget_file, gadget_params, mass_scale, basename, args, workers=None, block_size=1 << 20, rtol=1e-6,
+           atol=0.0):
+    """Compare the tipsy file 'basename' with the open gadget.File it was converted from
+
+    'mass_scale' and 'args' are as given to gadget2changa.convert. Returns a
+    dict with the problems found with the header ('header'), the errors of
+    each field of each particle type ('errors', see comparer), the SHA-256 of
+    the tipsy file, and whether it matched ('ok').
+    """
+    begin = time.perf_counter()
+    header_time = float(gadget_file.header['Time'])
+    is_cosmological = int(gadget_params['ComovingIntegrationOn']) == 1
+    counts = gadget2changa.count_particles(gadget_file, is_cosmological, args.convert_bh)
+
+    problems = []
+    with tipsy.File(basename, memmap=True) as f:
+        h = f.header
+        if (h.ngas, h.ndark, h.nstar) != counts:
+            problems.append('particle counts {0} instead of {1}'.format((h.ngas, h.ndark, h.nstar), counts))
+        if len(f.map) != tipsy.file_size(*counts):
+            problems.append('{0:d} bytes instead of {1:d}'.format(len(f.map), tipsy.file_size(*counts)))
+        # The records of a file of the wrong shape do not line up with the particles of the snapshot
+        comparable = not problems
+        if h.time != header_time:
+            problems.append('time {0!r} instead of {1!r}'.format(h.time, header_time))
+
+    # Blocks of each particle type, with the index of their first record in its section of the tipsy file
+    jobs = gadget2changa.conversion_jobs(gadget_file, gadget_params, mass_scale, args)
+    first = {}
+    tasks = []
+    for index, (name, particles, itemsize, _, _) in enumerate(jobs if comparable else []):
+        offset = first.get(itemsize, 0)
+        tasks += [(index, start, min(start + block_size, particles.size), offset + start)
+                  for start in range(0, particles.size, block_size)]
+        first[itemsize] = offset + particles.size
+
+    # The checksum is computed while the workers compare
+    digest = {}
+    hasher = threading.Thread(target=lambda: digest.update(sha256=checksum(basename)))
+    hasher.start()
+
+    errors = {}
+    initargs = (gadget_file.fnames[0], gadget_params, mass_scale, args, basename, rtol, atol)
+    try:
+        if workers is None or workers > 1:
+            # Workers must not inherit the HDF5 library state of this process
+            context = multiprocessing.get_context('spawn')
+            with concurrent.futures.ProcessPoolExecutor(workers, context, initializer=_open_worker,
+                                                        initargs=initargs) as pool:
+                futures = [pool.submit(_verify_block, *task) for task in tasks]
+                for task, future in zip(tasks, futures):
+                    merge(errors.setdefault(jobs[task[0]][0], {}), future.result())
+        else:
+            _open_worker(*initargs)
+            try:
+                for task in tasks:
+                    merge(errors.setdefault(jobs[task[0]][0], {}), _verify_block(*task))
+            finally:
+                _worker['tipsy'].close()
+                _worker['gadget'].close()
+                _worker.clear()
+    finally:
+        hasher.join()
+
+    ok = not problems and all(e[2] == 0 for fields in errors.values() for e in fields.values())
+    return {'file': basename, 'ok': ok, 'header': problems, 'errors': errors, 'sha256': digest.get('sha256'),
+            'seconds': time.perf_counter() - begin}
+
+def report(result, out=None):
+    """Print the result of verify() as a table"""
+    write = print if out is None else lambda line: out.write(line + '\n')
+    for problem in result['header']:
+        write('Header: ' + problem)
+
+    write('{0:10s} {1:10s} {2:>13s} {3:>13s} {4:>12s} {5:>12s}'.format('Type', 'Field', 'Max abs err', 'Max rel err',
+                                                                         'Wrong', 'Compared'))
+    for name, fields in result['errors'].items():
+        for field, (max_abs, max_rel, wrong, count) in fields.items():
+            write('{0:10s} {1:10s} {2:13.6g} {3:13.6g} {4:12d} {5:12d}'.format(name, field, max_abs, max_rel, wrong,
+                                                                               count))
+    write('SHA-256: {0:s}  {1:s}'.format(result['sha256'], result['file']))
+    write('{0:s}: {1:s} in {2:.1f} s'.format(result['file'], 'matches the snapshot' if result['ok'] else 'DOES NOT MATCH',
+                                            result['seconds']))